@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Cart, CartItem
+from .models import Cart, CartItem, StockReservation, cart_totals
 
 
 class CartItemInline(admin.TabularInline):
@@ -10,18 +10,49 @@ class CartItemInline(admin.TabularInline):
 
 @admin.register(Cart)
 class CartAdmin(admin.ModelAdmin):
-    list_display = ('session_key', 'total_items', 'subtotal', 'created_at',
+    list_display = ('session_key', 'user', 'total_items', 'subtotal', 'created_at',
                     'updated_at')
     list_filter = ('created_at', 'updated_at')
-    search_fields = ('session_key',)
+    list_select_related = ('user',)
+    search_fields = ('session_key', 'user__email')
+    raw_id_fields = ('user',)
     inlines = [CartItemInline]
     readonly_fields = ('total_items', 'subtotal')
 
 
+    def get_queryset(self, request):
+        # Итоги всех корзин страницы одним GROUP BY, а не aggregate на строку
+        totals = cart_totals('items__')
+        return super().get_queryset(request).annotate(
+            items_total=totals['total_items'], items_subtotal=totals['subtotal']
+        )
+
+
+    def total_items(self, obj):
+        return obj.items_total
+    total_items.short_description = 'Total items'
+    total_items.admin_order_field = 'items_total'
+
+
+    def subtotal(self, obj):
+        return obj.items_subtotal
+    subtotal.short_description = 'Subtotal'
+    subtotal.admin_order_field = 'items_subtotal'
+
+
 @admin.register(CartItem)
 class CartItemAdmin(admin.ModelAdmin):
     list_display = ('cart', 'product', 'product_size',
                     'quantity', 'total_price', 'added_at')
     list_filter = ('added_at',)
     search_fields = ('product__name', 'cart__session_key')
-    readonly_fields = ('total_price',)
\ No newline at end of file
+    readonly_fields = ('total_price',)
+
+
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = ('product_size', 'quantity', 'cart', 'order', 'expires_at')
+    list_filter = ('expires_at',)
+    list_select_related = ('product_size__product', 'product_size__size',
+                           'cart', 'order')
+    raw_id_fields = ('cart', 'order', 'product_size')
@@ -2,14 +2,13 @@ from .models import Cart
 
 
 def cart_processor(request):
-    if not request.session.session_key:
-        request.session.create()
-
-    cart, created = Cart.objects.get_or_create(
-        session_key = request.session.session_key
-    )
+    cart = getattr(request, 'cart', None)
+    if cart is None:
+        cart = Cart.objects.for_request(request)
 
+    # Шаблоны вызывают callables сами, так что запрос выполняется
+    # только если шаблон действительно выводит корзину
     return {
-        'cart_total_items': cart.total_items,
-        'cart_subtotal': cart.subtotal,
-    }
\ No newline at end of file
+        'cart_total_items': lambda: cart.total_items,
+        'cart_subtotal': lambda: cart.subtotal,
+    }
@@ -10,20 +10,32 @@ class AddToCartForm(forms.Form):
     def __init__(self, *args, product=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.product = product
+        # Размеры берутся из prefetch_related('product_sizes__size') во view
+        self.product_sizes = list(product.product_sizes.all()) if product else []
 
-        if product:
+        if self.product_sizes:
             # Включаем ВСЕ размеры в choices, а проверку остатка делаем в view
-            all_sizes = product.product_sizes.all()
-            if all_sizes.exists():
-                self.fields['size_id'] = forms.ChoiceField(
-                    choices=[(ps.id, ps.size.name) for ps in all_sizes],
-                    required=False,
-                    initial=all_sizes.filter(stock__gt=0).first().id if all_sizes.filter(stock__gt=0).exists() else None
-                )
-            else:
-                # Если нет размеров, удаляем поле size_id совсем или делаем его полностью опциональным
-                self.fields['size_id'] = forms.CharField(required=False)
-                print(f"DEBUG: Product {product.name} has no sizes, made size_id optional CharField")
+            in_stock = next((ps for ps in self.product_sizes if ps.stock > 0), None)
+            self.fields['size_id'] = forms.TypedChoiceField(
+                choices=[(ps.id, ps.size.name) for ps in self.product_sizes],
+                coerce=int,
+                required=False,
+                empty_value=None,
+                initial=in_stock.id if in_stock else None
+            )
+        elif product:
+            # Если нет размеров, делаем size_id полностью опциональным
+            self.fields['size_id'] = forms.CharField(required=False)
+
+
+    def clean(self):
+        cleaned_data = super().clean()
+        size_id = cleaned_data.get('size_id')
+        # Сам ProductSize, уже загруженный, чтобы view не искала его повторно
+        cleaned_data['product_size'] = next(
+            (ps for ps in self.product_sizes if ps.id == size_id), None
+        ) if size_id else None
+        return cleaned_data
     
 
 class UpdateCartItemForm(forms.ModelForm):
@@ -0,0 +1,45 @@
+import time
+from importlib import import_module
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from cart.models import Cart
+
+
+class Command(BaseCommand):
+    help = ('Delete expired sessions, then carts whose session is gone in small '
+            'keyset batches, returning their held stock')
+
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=int, default=60 * 60,
+                            help='Keep carts touched within this many seconds')
+        parser.add_argument('--batch', type=int, default=500)
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Pause between batches to go easy on the database')
+
+
+    def handle(self, *args, **options):
+        engine = import_module(settings.SESSION_ENGINE)
+        sessions = engine.SessionStore.clear_expired()
+        self.stdout.write(f'Deleted {sessions or 0} expired sessions')
+
+        started = time.monotonic()
+        carts = units = 0
+        batch_started = started
+        for deleted, released in Cart.objects.collect_abandoned(options['min_age'],
+                                                                options['batch']):
+            carts += deleted
+            units += released
+            if options['verbosity'] > 1:
+                self.stdout.write(f'  {deleted} carts, {released} units '
+                                  f'in {time.monotonic() - batch_started:.3f}s')
+            if options['sleep']:
+                time.sleep(options['sleep'])
+            batch_started = time.monotonic()
+
+        seconds = time.monotonic() - started
+        rate = carts / seconds if seconds else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {carts} abandoned carts, released {units} units '
+            f'in {seconds:.2f}s ({rate:.0f} carts/s)'
+        ))
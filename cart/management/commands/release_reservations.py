@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from cart.models import StockReservation
+
+
+class Command(BaseCommand):
+    help = 'Return the stock of expired cart and unpaid order holds to the shelf'
+
+
+    def handle(self, *args, **options):
+        released = StockReservation.objects.release_expired()
+        self.stdout.write(self.style.SUCCESS(f'Released {released} units'))
@@ -1,13 +1,11 @@
 from django.utils.deprecation import MiddlewareMixin
+from django.utils.functional import SimpleLazyObject
 from .models import Cart
 
 
 class CartMiddleware(MiddlewareMixin):
     def process_request(self, request):
-        if not request.session.session_key:
-            request.session.create()
-
-        request.cart, created = Cart.objects.get_or_create(
-            session_key=request.session.session_key
-        )
-        return None
\ No newline at end of file
+        # Корзина загружается только когда view/шаблон к ней обращается,
+        # сессия и запись Cart создаются при первом добавлении товара
+        request.cart = SimpleLazyObject(lambda: Cart.objects.for_request(request))
+        return None
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.8 on 2026-10-18 18:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0001_initial'),
+        ('main', '0003_product_created_id_idx'),
+        ('orders', '0003_alter_order_options_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('cart', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='reservations', to='cart.cart')),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='reservations', to='orders.order')),
+                ('product_size', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='main.productsize')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('cart', 'product_size'), name='unique_cart_reservation')],
+            },
+        ),
+    ]
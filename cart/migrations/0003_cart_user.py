@@ -0,0 +1,26 @@
+# Generated by Django 5.2.8 on 2026-10-18 18:31
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0002_stockreservation'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='user',
+            field=models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='cart', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='cart',
+            name='session_key',
+            field=models.CharField(blank=True, max_length=40, null=True, unique=True),
+        ),
+    ]
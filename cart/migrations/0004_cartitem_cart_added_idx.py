@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 18:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0003_cart_user'),
+        ('main', '0006_product_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cartitem',
+            index=models.Index(fields=['cart', '-added_at'], name='cartitem_cart_added_idx'),
+        ),
+    ]
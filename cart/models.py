@@ -1,30 +1,279 @@
-from django.db import models
+from collections import Counter
+from datetime import timedelta
+from functools import partial, reduce
+from operator import or_
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import DecimalField, Exists, F, OuterRef, Q, Sum, Value
+from django.db.models.functions import Coalesce, Now
+from django.conf import settings
+from django.core.cache import cache
 from django.contrib.sessions.models import Session
+from django.utils import timezone
+from main.cache import bump_catalog_version
 from main.models import Product, ProductSize
+from main.summary import refresh_category_summary
 from decimal import Decimal
 
 
+CART_CACHE_KEY = 'cart:session:{}'
+CART_USER_CACHE_KEY = 'cart:user:{}'
+CART_CACHE_TIMEOUT = getattr(settings, 'CART_CACHE_TIMEOUT', 60)
+# Маркер "у сессии нет корзины" - 0 не может быть id записи
+NO_CART = 0
+# Сколько секунд держится резерв корзины и резерв заказа, ожидающего оплаты
+STOCK_RESERVATION_TTL = getattr(settings, 'STOCK_RESERVATION_TTL', 30 * 60)
+STOCK_CHECKOUT_TTL = getattr(settings, 'STOCK_CHECKOUT_TTL', 60 * 60)
+# Строка сессии обновляется не чаще раза в SESSION_DB_REFRESH (enf/sessions.py),
+# её expire_date может отставать на столько же
+SESSION_DB_REFRESH = getattr(settings, 'SESSION_DB_REFRESH', 0)
+
+
+class CartManager(models.Manager):
+    def for_request(self, request):
+        """Resolve the visitor's cart without creating rows or sessions.
+
+        Signed-in users own one cart across devices, found by ``user``;
+        anonymous carts are bound to the session. Returns an unsaved
+        ``Cart`` when there is no cart yet.
+        """
+        session = request.session
+        session_key = session.session_key
+        if not session_key:
+            return self.model()
+
+        cart_id = session.get('cart_id')
+        if cart_id:
+            # Остальные поля подгрузятся только если к ним обратятся
+            return self.model.from_db(self.db, ['id'], [cart_id])
+
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            owner = {'user_id': user.pk}
+            cache_key = CART_USER_CACHE_KEY.format(user.pk)
+        else:
+            owner = {'session_key': session_key}
+            cache_key = CART_CACHE_KEY.format(session_key)
+        cart_id = cache.get(cache_key)
+        if cart_id is None:
+            cart_id = self.filter(**owner).values_list(
+                'id', flat=True
+            ).first() or NO_CART
+            cache.set(cache_key, cart_id, CART_CACHE_TIMEOUT)
+
+        if cart_id == NO_CART:
+            return self.model(**owner)
+        session['cart_id'] = cart_id
+        return self.model.from_db(self.db, ['id'], [cart_id])
+
+
+    def materialize(self, request):
+        """Return a saved cart for the request, creating it on first use."""
+        cart = getattr(request, 'cart', None)
+        if cart is not None and cart.pk:
+            return cart
+
+        if request.user.is_authenticated:
+            cart, created = self.get_or_create(user=request.user)
+            cache_key = CART_USER_CACHE_KEY.format(request.user.pk)
+        else:
+            if not request.session.session_key:
+                request.session.create()
+            session_key = request.session.session_key
+            cart, created = self.get_or_create(session_key=session_key)
+            cache_key = CART_CACHE_KEY.format(session_key)
+        cache.set(cache_key, cart.id, CART_CACHE_TIMEOUT)
+        request.session['cart_id'] = cart.id
+        request.cart = cart
+        return cart
+
+
+    def claim(self, request, user):
+        """Hand the anonymous cart of ``request`` over to ``user`` after login.
+
+        The session cart becomes the user's cart, or is merged into the cart
+        the user already has (e.g. from another device) and deleted.
+        """
+        session = request.session
+        user_cart_id = self.filter(user=user).values_list('id', flat=True).first()
+        cart_id = session.get('cart_id')
+        if cart_id and cart_id != user_cart_id and self.filter(
+            id=cart_id, user__isnull=True
+        ).exists():
+            if user_cart_id:
+                self.merge(cart_id, user_cart_id)
+            else:
+                self.filter(id=cart_id).update(user=user, session_key=None)
+                user_cart_id = cart_id
+
+        if user_cart_id:
+            session['cart_id'] = user_cart_id
+            request.cart = self.model.from_db(self.db, ['id'], [user_cart_id])
+        else:
+            session.pop('cart_id', None)
+            request.cart = self.model(user=user)
+        cache.set(CART_USER_CACHE_KEY.format(user.pk), user_cart_id or NO_CART,
+                  CART_CACHE_TIMEOUT)
+        return request.cart
+
+
+    def merge(self, source_id, target_id):
+        """Move every line and hold of one cart into another, then drop it.
+
+        Two ``INSERT ... SELECT ... ON CONFLICT`` statements add quantities of
+        lines/holds both carts have, whatever the size of the carts.
+        """
+        item_table = CartItem._meta.db_table
+        hold_table = StockReservation._meta.db_table
+        expires_at = timezone.now() + timedelta(seconds=STOCK_RESERVATION_TTL)
+        with transaction.atomic(), connection.cursor() as cursor:
+            # WHERE обязателен: без него SQLite путает ON CONFLICT с JOIN
+            cursor.execute(
+                f'INSERT INTO {item_table} (cart_id, product_id, product_size_id, quantity, added_at) '
+                f'SELECT %s, product_id, product_size_id, quantity, added_at FROM {item_table} '
+                f'WHERE cart_id = %s '
+                f'ON CONFLICT (cart_id, product_id, product_size_id) '
+                f'DO UPDATE SET quantity = {item_table}.quantity + excluded.quantity',
+                [target_id, source_id],
+            )
+            cursor.execute(
+                f'INSERT INTO {hold_table} (cart_id, product_size_id, quantity, expires_at, created_at) '
+                f'SELECT %s, product_size_id, quantity, %s, created_at FROM {hold_table} '
+                f'WHERE cart_id = %s '
+                f'ON CONFLICT (cart_id, product_size_id) '
+                f'DO UPDATE SET quantity = {hold_table}.quantity + excluded.quantity, '
+                f'expires_at = excluded.expires_at',
+                [target_id, expires_at, source_id],
+            )
+            StockReservation.objects.filter(cart_id=source_id).delete()
+            self.filter(id=source_id).delete()
+
+
+    def abandoned(self, min_age):
+        """Carts untouched for ``min_age`` seconds whose session is gone or expired."""
+        now = timezone.now()
+        live_session = Session.objects.filter(
+            session_key=OuterRef('session_key'),
+            expire_date__gte=now - timedelta(seconds=SESSION_DB_REFRESH),
+        )
+        # Корзины пользователей живут без сессии
+        return self.filter(
+            user__isnull=True, updated_at__lt=now - timedelta(seconds=min_age)
+        ).exclude(Exists(live_session))
+
+
+    def collect(self, carts):
+        """Delete ``carts`` and give back their held stock; returns (carts, units).
+
+        Rows already locked by another collector are skipped, and every cart
+        is re-checked under the lock, so this is safe to run next to traffic
+        and to other collectors.
+        """
+        with transaction.atomic():
+            locked = list(carts.select_for_update(skip_locked=True).values_list(
+                'id', 'session_key'
+            ))
+            if not locked:
+                return 0, 0
+            ids = [cart_id for cart_id, _ in locked]
+            units = StockReservation.objects.release(
+                StockReservation.objects.filter(cart_id__in=ids)
+            )
+            deleted = self.filter(id__in=ids).delete()[1].get(self.model._meta.label, 0)
+        cache.delete_many([CART_CACHE_KEY.format(key) for _, key in locked])
+        return deleted, units
+
+
+    def collect_abandoned(self, min_age, batch_size=500):
+        """Collect abandoned carts in keyset chunks, yielding (carts, units) per batch.
+
+        Walking by ``id > last`` keeps each chunk an index range scan however
+        far the walk has gone, and every batch is its own short transaction.
+        """
+        last_id = 0
+        while True:
+            ids = list(self.abandoned(min_age).filter(id__gt=last_id)
+                       .order_by('id').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return
+            last_id = ids[-1]
+            yield self.collect(self.abandoned(min_age).filter(id__in=ids))
+
+
+def cart_totals(prefix=''):
+    """``total_items`` and ``subtotal`` expressions over cart items.
+
+    ``prefix`` is the path to the items: empty for an aggregate over
+    ``cart.items``, ``'items__'`` to annotate a cart queryset.
+    """
+    price_field = DecimalField(max_digits=12, decimal_places=2)
+    return {
+        'total_items': Coalesce(Sum(f'{prefix}quantity'), 0),
+        'subtotal': Coalesce(
+            Sum(F(f'{prefix}quantity') * F(f'{prefix}product__price'),
+                output_field=price_field),
+            Value(Decimal('0.00')),
+            output_field=price_field,
+        ),
+    }
+
+
 class Cart(models.Model):
-    session_key = models.CharField(max_length=40, unique=True)
+    # У корзины пользователя session_key нет: она общая для всех его устройств
+    session_key = models.CharField(max_length=40, unique=True, null=True, blank=True)
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, related_name='cart',
+                                null=True, blank=True, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = CartManager()
+
 
     def __str__(self):
-        return f"Cart {self.session_key}"
+        return f"Cart {self.session_key or self.user_id}"
     
 
+    def get_items(self):
+        # Несохранённая корзина не может использовать related manager
+        if self.pk is None:
+            return CartItem.objects.none()
+        return self.items.all()
+
+
+    def get_totals(self):
+        """Item count and subtotal in one aggregate query, memoized."""
+        if self.pk is None:
+            return {'total_items': 0, 'subtotal': Decimal('0.00')}
+        if not hasattr(self, '_totals'):
+            self._totals = self.items.aggregate(**cart_totals())
+        return self._totals
+
+
+    def invalidate_totals(self):
+        self.__dict__.pop('_totals', None)
+
+
+    def touch(self):
+        """Mark the cart as just used, see ``CartManager.abandoned``."""
+        # Через UPDATE: корзина из кэша загружена без updated_at
+        if self.pk is not None:
+            Cart.objects.filter(pk=self.pk).update(updated_at=Now())
+
+
     @property
     def total_items(self):
-        return sum(item.quantity for item in self.items.all())
+        return self.get_totals()['total_items']
     
     
     @property
     def subtotal(self):
-        return sum(item.total_price for item in self.items.all())
+        return self.get_totals()['subtotal']
     
 
     def add_product(self, product, product_size, quantity=1):
+        """Reserve stock and add it to the cart; ``None`` if it ran out."""
+        if not StockReservation.objects.reserve(self, product_size.pk, quantity):
+            return None
+
         cart_item, created = CartItem.objects.get_or_create(
             cart=self,
             product=product,
@@ -36,33 +285,52 @@ class Cart(models.Model):
             cart_item.quantity += quantity
             cart_item.save()
 
+        self.invalidate_totals()
+        self.touch()
         return cart_item
     
 
     def remove_item(self, item_id):
         try:
-            item = self.items.get(id=item_id)
-            item.delete()
-            return True
+            item = self.get_items().get(id=item_id)
+            return self.set_item_quantity(item, 0)
         except CartItem.DoesNotExist:
             return False
         
     
+    def set_item_quantity(self, item, quantity):
+        """Resize ``item`` and its stock hold; ``False`` if stock ran out."""
+        delta = quantity - item.quantity
+        reservations = StockReservation.objects
+        if delta > 0 and not reservations.reserve(self, item.product_size_id, delta):
+            return False
+        if delta < 0:
+            reservations.release_quantity(self, item.product_size_id, -delta)
+
+        if quantity > 0:
+            item.quantity = quantity
+            item.save()
+        else:
+            item.delete()
+        self.invalidate_totals()
+        self.touch()
+        return True
+
+
     def update_item_quantity(self, item_id, quantity):
         try:
-            item = self.items.get(id=item_id)
-            if quantity > 0:
-                item.quantity = quantity
-                item.sav()
-            else:
-                item.delete()
-            return True
+            item = self.get_items().get(id=item_id)
+            return self.set_item_quantity(item, quantity)
         except CartItem.DoesNotExist:
             return False
         
     
     def clear(self):
-        self.items.all().delete()
+        if self.pk is not None:
+            StockReservation.objects.release(self.reservations.all())
+        self.get_items().delete()
+        self.invalidate_totals()
+        self.touch()
 
 
 class CartItem(models.Model):
@@ -75,6 +343,10 @@ class CartItem(models.Model):
 
     class Meta:
         unique_together = ('cart', 'product', 'product_size')
+        indexes = [
+            # Корзина показывается от последних добавленных
+            models.Index(fields=['cart', '-added_at'], name='cartitem_cart_added_idx'),
+        ]
 
     
     def __str__(self):
@@ -83,4 +355,179 @@ class CartItem(models.Model):
 
     @property
     def total_price(self):
-        return Decimal(str(self.product.price)) * self.quantity
\ No newline at end of file
+        return Decimal(str(self.product.price)) * self.quantity
+
+
+def _availability_changed(expected):
+    """Refresh catalog caches, on commit, for sizes that just sold out or came back.
+
+    ``expected`` maps product size ids to the stock they have only if the
+    move flipped their availability: 0 after a reservation, the returned
+    quantity after a release. Callers hold the row locks, so one query
+    tells. Pages render availability, not counts (disabled size buttons,
+    ``?size=`` filters, in-stock facets), so other moves leave the cached
+    fragments and summaries valid.
+    """
+    condition = reduce(or_, (Q(pk=pk, stock=stock) for pk, stock in expected.items()))
+    category_ids = set(ProductSize.objects.filter(condition).values_list(
+        'product__category_id', flat=True
+    ))
+    if category_ids:
+        # После коммита: сводку не пересчитываем на горячем пути корзины,
+        # а фрагмент новой версии иначе соберётся по старым остаткам
+        transaction.on_commit(partial(_refresh_catalog, category_ids))
+
+
+def _refresh_catalog(category_ids):
+    for category_id in category_ids:
+        refresh_category_summary(category_id)
+    bump_catalog_version()
+
+
+class StockReservationManager(models.Manager):
+    def reserve(self, cart, product_size_id, quantity):
+        """Move ``quantity`` units of a product size from the shelf to ``cart``.
+
+        The conditional UPDATE is the stock check: it row-locks the size and
+        matches nothing when fewer units are left, so concurrent buyers can
+        never take the same units. Returns ``False`` when stock ran out.
+        """
+        if quantity <= 0:
+            return True
+        expires_at = timezone.now() + timedelta(seconds=STOCK_RESERVATION_TTL)
+        with transaction.atomic():
+            taken = ProductSize.objects.filter(
+                pk=product_size_id, stock__gte=quantity
+            ).update(stock=F('stock') - quantity, updated_at=Now())
+            if not taken:
+                return False
+            _availability_changed({product_size_id: 0})
+
+            extend = dict(quantity=F('quantity') + quantity, expires_at=expires_at)
+            if not self.filter(cart=cart, product_size_id=product_size_id).update(**extend):
+                try:
+                    with transaction.atomic():
+                        self.create(cart=cart, product_size_id=product_size_id,
+                                    quantity=quantity, expires_at=expires_at)
+                except IntegrityError:
+                    # Параллельный запрос той же корзины успел создать резерв
+                    self.filter(cart=cart, product_size_id=product_size_id).update(**extend)
+        return True
+
+
+    def release_quantity(self, cart, product_size_id, quantity):
+        """Give back up to ``quantity`` held units of one size."""
+        with transaction.atomic():
+            hold = self.select_for_update().filter(
+                cart=cart, product_size_id=product_size_id
+            ).first()
+            if hold is None:
+                return 0
+            quantity = min(quantity, hold.quantity)
+            ProductSize.objects.filter(pk=product_size_id).update(
+                stock=F('stock') + quantity, updated_at=Now()
+            )
+            _availability_changed({product_size_id: quantity})
+            if quantity == hold.quantity:
+                hold.delete()
+            else:
+                self.filter(pk=hold.pk).update(quantity=F('quantity') - quantity)
+        return quantity
+
+
+    def release(self, reservations):
+        """Return the stock of ``reservations`` to the shelf and drop them.
+
+        Rows locked by a concurrent release are skipped instead of waited on,
+        so two workers never give the same units back twice.
+        """
+        with transaction.atomic():
+            holds = list(reservations.select_for_update(skip_locked=True).values_list(
+                'id', 'product_size_id', 'quantity'
+            ))
+            if not holds:
+                return 0
+            returned = Counter()
+            for hold_id, product_size_id, quantity in holds:
+                returned[product_size_id] += quantity
+            for product_size_id, quantity in returned.items():
+                ProductSize.objects.filter(pk=product_size_id).update(
+                    stock=F('stock') + quantity, updated_at=Now()
+                )
+            _availability_changed(returned)
+            self.filter(id__in=[hold[0] for hold in holds]).delete()
+        return sum(returned.values())
+
+
+    def release_expired(self):
+        return self.release(self.filter(expires_at__lte=timezone.now()))
+
+
+    def hold_cart(self, cart, items=None):
+        """Back every cart line with a live hold before checkout.
+
+        Lines whose hold expired are re-reserved; returns the items that
+        could not be (their stock has been sold in the meantime).
+        """
+        if items is None:
+            items = cart.get_items().select_related('product', 'product_size__size')
+        held = dict(self.filter(cart=cart).values_list('product_size_id', 'quantity'))
+        missing = []
+        for item in items:
+            shortfall = item.quantity - held.get(item.product_size_id, 0)
+            if shortfall > 0 and not self.reserve(cart, item.product_size_id, shortfall):
+                missing.append(item)
+        self.filter(cart=cart).update(
+            expires_at=timezone.now() + timedelta(seconds=STOCK_RESERVATION_TTL)
+        )
+        return missing
+
+
+    def attach_to_order(self, cart, order):
+        """Hand the cart's holds over to ``order`` until it is paid."""
+        return self.filter(cart=cart).update(
+            cart=None, order=order,
+            expires_at=timezone.now() + timedelta(seconds=STOCK_CHECKOUT_TTL),
+        )
+
+
+    def commit(self, order):
+        """Payment went through: the held units are sold for good."""
+        return self.filter(order=order).delete()[0]
+
+
+    def release_order(self, order):
+        return self.release(self.filter(order=order))
+
+
+class StockReservation(models.Model):
+    """Units taken off ``ProductSize.stock`` and held for a cart or an order.
+
+    ``ProductSize.stock`` is what is still free to sell; a hold gives its
+    units back when it is released or expires, and simply disappears when
+    the order is paid.
+    """
+    # При удалении корзины/заказа резерв остаётся и истекает сам
+    cart = models.ForeignKey(Cart, related_name='reservations', null=True,
+                             blank=True, on_delete=models.SET_NULL)
+    order = models.ForeignKey('orders.Order', related_name='reservations',
+                              null=True, blank=True, on_delete=models.SET_NULL)
+    product_size = models.ForeignKey(ProductSize, related_name='reservations',
+                                     on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = StockReservationManager()
+
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product_size'],
+                                    name='unique_cart_reservation'),
+        ]
+
+
+    def __str__(self):
+        holder = f"order {self.order_id}" if self.order_id else f"cart {self.cart_id}"
+        return f"ProductSize {self.product_size_id} x {self.quantity} for {holder}"
@@ -0,0 +1,10 @@
+from django.contrib.auth.signals import user_logged_in
+from django.dispatch import receiver
+from .models import Cart
+
+
+@receiver(user_logged_in)
+def claim_cart(sender, request, user, **kwargs):
+    # login() уже сменил ключ сессии, cart_id в ней сохранился
+    if request is not None and hasattr(request, 'session'):
+        Cart.objects.claim(request, user)
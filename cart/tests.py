@@ -1,3 +1,459 @@
+import io
+from contextlib import redirect_stdout
+from datetime import timedelta
+from decimal import Decimal
+from django.contrib.sessions.models import Session
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from main.cache import get_catalog_version
+from main.models import Category, CategorySummary, Product, ProductSize, Size
+from main.benchmark import QueryBudgetMixin
+from orders.models import Order
+from enf.sessions import SESSION_DB_REFRESH, SessionStore
+from users.models import CustomUser
+from .models import CART_CACHE_KEY, Cart, StockReservation
 
-# Create your tests here.
+
+class CartTestMixin:
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Shirts', slug='shirts')
+        cls.size = Size.objects.create(name='M')
+        cls.product = Product.objects.create(
+            name='Shirt', slug='shirt', category=cls.category,
+            color='black', price='10.00', main_image='products/main/shirt.jpg'
+        )
+        cls.product_size = ProductSize.objects.create(
+            product=cls.product, size=cls.size, stock=5
+        )
+
+
+    def add_to_cart(self, quantity=1):
+        return self.client.post(
+            reverse('cart:add_to_cart', args=[self.product.slug]),
+            {'size_id': self.product_size.id, 'quantity': quantity}
+        )
+
+
+class LazyCartTests(CartTestMixin, TestCase):
+    def test_anonymous_visit_creates_no_session_or_cart(self):
+        self.client.get(reverse('cart:cart_count'))
+        self.assertEqual(Cart.objects.count(), 0)
+        self.assertEqual(Session.objects.count(), 0)
+
+
+    def test_first_add_materializes_cart(self):
+        response = self.add_to_cart(2)
+        self.assertEqual(response.status_code, 200)
+        cart = Cart.objects.get()
+        self.assertEqual(cart.session_key, self.client.session.session_key)
+        self.assertEqual(self.client.session['cart_id'], cart.id)
+        self.assertEqual(cart.total_items, 2)
+
+
+    def test_cart_resolved_from_session_without_lookup(self):
+        self.add_to_cart()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('cart:cart_count'))
+        self.assertEqual(response.json()['total_items'], 1)
+        self.assertFalse(any('"cart_cart"' in q['sql'] for q in ctx.captured_queries))
+
+
+class CartTotalsTests(CartTestMixin, TestCase):
+    def test_totals_cost_one_query_regardless_of_size(self):
+        self.add_to_cart(3)
+        cart = Cart.objects.get()
+        with self.assertNumQueries(1):
+            self.assertEqual(cart.total_items, 3)
+            self.assertEqual(cart.subtotal, Decimal('30.00'))
+
+
+    def test_totals_refresh_after_changes(self):
+        self.add_to_cart(2)
+        cart = Cart.objects.get()
+        self.assertEqual(cart.total_items, 2)
+        cart.add_product(self.product, self.product_size, 1)
+        self.assertEqual(cart.total_items, 3)
+        cart.clear()
+        self.assertEqual(cart.total_items, 0)
+        self.assertEqual(cart.subtotal, Decimal('0.00'))
+
+
+    def test_unsaved_cart_totals_need_no_queries(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(Cart().total_items, 0)
+
+
+class StockReservationTests(CartTestMixin, TestCase):
+    def stock(self):
+        self.product_size.refresh_from_db()
+        return self.product_size.stock
+
+
+    def test_add_takes_units_off_the_shelf(self):
+        self.add_to_cart(2)
+        self.add_to_cart(1)
+        self.assertEqual(self.stock(), 2)
+        hold = StockReservation.objects.get()
+        self.assertEqual((hold.cart, hold.quantity), (Cart.objects.get(), 3))
+
+
+    def test_cannot_reserve_more_than_stock(self):
+        self.add_to_cart(4)
+        response = self.add_to_cart(2)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'Only 1 items available')
+        self.assertEqual(self.stock(), 1)
+        self.assertEqual(Cart.objects.get().total_items, 4)
+
+
+    def test_update_and_clear_return_stock(self):
+        self.add_to_cart(3)
+        item = Cart.objects.get().items.get()
+        self.client.post(reverse('cart:update_item', args=[item.id]), {'quantity': 1})
+        self.assertEqual(self.stock(), 4)
+        self.client.post(reverse('cart:clear_cart'))
+        self.assertEqual(self.stock(), 5)
+        self.assertFalse(StockReservation.objects.exists())
+
+
+    def test_selling_out_and_restocking_refresh_catalog_caches(self):
+        cart = Cart.objects.create()
+        url = reverse('main:catalog_all') + '?size=M'
+        self.assertContains(self.client.get(url, HTTP_HX_REQUEST='true'), self.product.name)
+        version = get_catalog_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            StockReservation.objects.reserve(cart, self.product_size.id, 4)
+        # Размер ещё в продаже - кэшированные фрагменты остаются
+        self.assertEqual(get_catalog_version(), version)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            StockReservation.objects.reserve(cart, self.product_size.id, 1)
+        # Сводка пересчитывается после коммита, а не внутри добавления в корзину
+        self.assertNotEqual(CategorySummary.objects.get(category=self.category).sizes, [])
+        for callback in callbacks:
+            callback()
+        self.assertGreater(get_catalog_version(), version)
+        self.assertNotContains(self.client.get(url, HTTP_HX_REQUEST='true'), self.product.name)
+        self.assertEqual(CategorySummary.objects.get(category=self.category).sizes, [])
+
+        version = get_catalog_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            StockReservation.objects.release_quantity(cart, self.product_size.id, 2)
+        self.assertGreater(get_catalog_version(), version)
+        self.assertContains(self.client.get(url, HTTP_HX_REQUEST='true'), self.product.name)
+
+
+    def test_expired_holds_are_released_and_retaken_at_checkout(self):
+        self.add_to_cart(2)
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(StockReservation.objects.release_expired(), 2)
+        self.assertEqual(self.stock(), 5)
+
+        cart = Cart.objects.get()
+        self.assertEqual(StockReservation.objects.hold_cart(cart), [])
+        self.assertEqual(self.stock(), 3)
+        ProductSize.objects.update(stock=0)
+        StockReservation.objects.all().delete()
+        self.assertEqual(len(StockReservation.objects.hold_cart(cart)), 1)
+
+
+    def test_order_holds_survive_cart_clear_until_payment(self):
+        self.add_to_cart(2)
+        cart = Cart.objects.get()
+        user = CustomUser.objects.create_user('buyer@example.com', 'B', 'U',
+                                              password='x')
+        order = Order.objects.create(user=user, first_name='B', last_name='U',
+                                     email=user.email, total_price='20.00')
+        StockReservation.objects.attach_to_order(cart, order)
+        cart.clear()
+        self.assertEqual(self.stock(), 3)
+
+        StockReservation.objects.commit(order)
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertEqual(self.stock(), 3)
+
+
+    def test_cancel_redirect_keeps_holds_until_they_expire(self):
+        self.add_to_cart(2)
+        user = CustomUser.objects.create_user('buyer@example.com', 'B', 'U',
+                                              password='x')
+        order = Order.objects.create(user=user, first_name='B', last_name='U',
+                                     email=user.email, total_price='20.00')
+        StockReservation.objects.attach_to_order(Cart.objects.get(), order)
+        # Сессию у провайдера ещё можно оплатить, поэтому резерв не снимается
+        self.client.get(reverse('payment:stripe_cancel'), {'order_id': order.id})
+        self.assertEqual(self.stock(), 3)
+
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        StockReservation.objects.release_expired()
+        self.assertEqual(self.stock(), 5)
+
+
+def session_queries(ctx):
+    return [q['sql'] for q in ctx.captured_queries if '"django_session"' in q['sql']]
+
+
+class WriteBehindSessionTests(CartTestMixin, TestCase):
+    def test_unchanged_session_is_not_written_on_every_request(self):
+        self.add_to_cart()
+        self.client.get(reverse('cart:cart_count'))
+        with CaptureQueriesContext(connection) as ctx:
+            for _ in range(3):
+                self.client.get(reverse('cart:cart_count'))
+        self.assertEqual(session_queries(ctx), [])
+
+
+    def test_changed_data_is_written_through(self):
+        session = SessionStore()
+        session['step'] = 1
+        session.save()
+        session = SessionStore(session.session_key)
+        session['step'] = 2
+        with CaptureQueriesContext(connection) as ctx:
+            session.save()
+        self.assertTrue(session_queries(ctx)[-1].startswith('UPDATE'))
+        self.assertEqual(Session.objects.get().get_decoded(), {'step': 2})
+
+
+    def test_idle_session_row_refreshed_after_interval(self):
+        session = SessionStore()
+        session['step'] = 1
+        session.save()
+        expire_date = Session.objects.get().expire_date
+
+        session = SessionStore(session.session_key)
+        self.assertEqual(session['step'], 1)
+        session._persisted_at -= SESSION_DB_REFRESH
+        with CaptureQueriesContext(connection) as ctx:
+            session.save()
+        self.assertEqual(len(session_queries(ctx)), 1)
+        self.assertGreater(Session.objects.get().expire_date, expire_date)
+
+
+    def test_falls_back_to_database_when_cache_is_lost(self):
+        session = SessionStore()
+        session['step'] = 1
+        session.save()
+        caches['sessions'].delete(session.cache_key)
+        self.assertEqual(SessionStore(session.session_key)['step'], 1)
+
+
+    def test_cleanup_removes_expired_sessions_and_orphaned_carts(self):
+        self.add_to_cart(2)
+        live_cart = Cart.objects.get()
+        self.client = self.client_class()
+        self.add_to_cart(1)
+        old = timezone.now() - timedelta(seconds=SESSION_DB_REFRESH + 2 * 86400)
+        Session.objects.exclude(session_key=live_cart.session_key).update(expire_date=old)
+        Cart.objects.exclude(id=live_cart.id).update(updated_at=old)
+
+        out = io.StringIO()
+        call_command('cleanup_sessions', stdout=out)
+        self.assertIn('Deleted 1 abandoned carts, released 1 units', out.getvalue())
+        self.assertEqual(list(Cart.objects.all()), [live_cart])
+        self.assertEqual(Session.objects.count(), 1)
+        self.product_size.refresh_from_db()
+        self.assertEqual(self.product_size.stock, 3)
+
+
+class CartOwnershipTests(CartTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user = CustomUser.objects.create_user('buyer@example.com', 'Buyer',
+                                                  'User', password='secret-pass')
+        cls.other_size = ProductSize.objects.create(
+            product=cls.product, size=Size.objects.create(name='L'), stock=5
+        )
+
+
+    def setUp(self):
+        cache.clear()
+
+
+    def login(self, client=None):
+        client = client or self.client
+        return client.post(reverse('users:login'), {'username': self.user.email,
+                                                    'password': 'secret-pass'})
+
+
+    def test_login_hands_anonymous_cart_to_user(self):
+        self.add_to_cart(2)
+        cart = Cart.objects.get()
+        self.login()
+        cart.refresh_from_db()
+        self.assertEqual((cart.user, cart.session_key), (self.user, None))
+        self.assertEqual(self.client.session['cart_id'], cart.id)
+        self.assertEqual(self.client.get(reverse('cart:cart_count')).json()['total_items'], 2)
+
+
+    def test_cart_follows_user_across_devices(self):
+        self.login()
+        self.add_to_cart(1)
+        other_device = self.client_class()
+        self.login(other_device)
+        response = other_device.get(reverse('cart:cart_count'))
+        self.assertEqual(response.json()['total_items'], 1)
+
+        self.client.post(reverse('users:logout'))
+        self.assertEqual(self.client.get(reverse('cart:cart_count')).json()['total_items'], 0)
+        self.login()
+        self.assertEqual(self.client.get(reverse('cart:cart_count')).json()['total_items'], 1)
+
+
+    def test_login_merges_carts_without_reading_items(self):
+        user_cart = Cart.objects.create(user=self.user)
+        user_cart.add_product(self.product, self.product_size, 1)
+        self.add_to_cart(2)
+        self.client.post(reverse('cart:add_to_cart', args=[self.product.slug]),
+                         {'size_id': self.other_size.id, 'quantity': 3})
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.login()
+        self.assertFalse(any('"cart_cartitem"' in q['sql'] and 'SELECT "cart_cartitem"' in q['sql']
+                             for q in ctx.captured_queries))
+
+        self.assertEqual(list(Cart.objects.all()), [user_cart])
+        self.assertEqual(dict(user_cart.items.values_list('product_size_id', 'quantity')),
+                         {self.product_size.id: 3, self.other_size.id: 3})
+        self.assertEqual(dict(StockReservation.objects.values_list('product_size_id', 'quantity')),
+                         {self.product_size.id: 3, self.other_size.id: 3})
+        self.assertEqual(StockReservation.objects.get(product_size=self.other_size).cart, user_cart)
+        self.product_size.refresh_from_db()
+        self.assertEqual(self.product_size.stock, 2)
+        self.assertEqual(self.client.get(reverse('cart:cart_count')).json()['total_items'], 6)
+
+
+    def test_user_carts_are_not_garbage(self):
+        cart = Cart.objects.create(user=self.user)
+        Cart.objects.filter(pk=cart.pk).update(updated_at=timezone.now() - timedelta(days=30))
+        self.assertEqual(list(Cart.objects.collect_abandoned(60)), [])
+
+
+class CartGarbageCollectorTests(CartTestMixin, TestCase):
+    def make_cart(self, session_key, quantity=1, session_expires=None, age=2 * 86400):
+        cart = Cart.objects.create(session_key=session_key)
+        cart.add_product(self.product, self.product_size, quantity)
+        if session_expires is not None:
+            Session.objects.create(session_key=session_key, session_data='',
+                                   expire_date=timezone.now() + session_expires)
+        Cart.objects.filter(pk=cart.pk).update(updated_at=timezone.now() - timedelta(seconds=age))
+        cache.set(CART_CACHE_KEY.format(session_key), cart.id)
+        return cart
+
+
+    def test_abandoned_carts_collected_in_batches(self):
+        self.product_size.stock = 20
+        self.product_size.save()
+        abandoned = [self.make_cart(f'gone{i}', quantity=2) for i in range(3)]
+        abandoned.append(self.make_cart('expired', session_expires=-timedelta(days=2)))
+        live = self.make_cart('live', session_expires=timedelta(days=1))
+        recent = self.make_cart('recent', age=60)
+
+        out = io.StringIO()
+        call_command('cleanup_sessions', '--batch', '2', '--verbosity', '2', stdout=out)
+        lines = out.getvalue().splitlines()[1:]
+        self.assertEqual(len(lines), 3, lines)
+        self.assertIn('Deleted 4 abandoned carts, released 7 units', lines[-1])
+        self.assertRegex(lines[-1], r'\(\d+ carts/s\)')
+
+        self.assertEqual(set(Cart.objects.all()), {live, recent})
+        self.assertFalse(StockReservation.objects.filter(cart__isnull=True).exists())
+        self.product_size.refresh_from_db()
+        self.assertEqual(self.product_size.stock, 18)
+        self.assertIsNone(cache.get(CART_CACHE_KEY.format('gone0')))
+        self.assertEqual(cache.get(CART_CACHE_KEY.format('live')), live.id)
+
+
+    def test_changing_items_keeps_cart_alive(self):
+        cart = self.make_cart('busy')
+        item = cart.add_product(self.product, self.product_size, 1)
+        self.assertEqual(list(Cart.objects.collect_abandoned(3600)), [])
+
+        Cart.objects.filter(pk=cart.pk).update(updated_at=timezone.now() - timedelta(days=2))
+        cart.set_item_quantity(item, 1)
+        self.assertEqual(list(Cart.objects.collect_abandoned(3600)), [])
+
+
+    def test_order_holds_of_collected_cart_are_kept(self):
+        cart = self.make_cart('gone', quantity=2)
+        user = CustomUser.objects.create_user('buyer@example.com', 'Buyer', 'User')
+        order = Order.objects.create(user=user, first_name='Buyer', last_name='User',
+                                     email=user.email, total_price='20.00')
+        StockReservation.objects.attach_to_order(cart, order)
+        self.assertEqual(list(Cart.objects.collect_abandoned(86400)), [(1, 0)])
+        self.assertEqual(StockReservation.objects.get().order, order)
+
+
+class AddToCartViewTests(CartTestMixin, TestCase):
+    def test_sizes_are_loaded_once(self):
+        ProductSize.objects.create(product=self.product, size=Size.objects.create(name='L'),
+                                   stock=0)
+        self.add_to_cart()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.add_to_cart()
+        self.assertEqual(response.status_code, 200)
+        # Проверка доступности после резерва размеры не перечисляет
+        size_selects = [q['sql'] for q in ctx.captured_queries
+                        if q['sql'].startswith('SELECT') and 'FROM "main_productsize"' in q['sql']
+                        and 'JOIN "main_size"' in q['sql']]
+        self.assertEqual(len(size_selects), 1)
+
+
+    def test_diagnostics_go_to_debug_log(self):
+        stdout = io.StringIO()
+        with redirect_stdout(stdout), self.assertLogs('cart.views', 'DEBUG') as logs:
+            self.add_to_cart()
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertIn(f"({self.product_size.id}, 'M', 5)", logs.output[0])
+
+
+    def test_unknown_size_is_rejected(self):
+        response = self.client.post(reverse('cart:add_to_cart', args=[self.product.slug]),
+                                    {'size_id': self.product_size.id + 100, 'quantity': 1})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('size_id', response.json()['errors'])
+        self.assertNotIn('debug_info', response.json())
+
+
+    def test_first_size_in_stock_is_used_without_size(self):
+        self.product_size.stock = 0
+        self.product_size.save()
+        in_stock = ProductSize.objects.create(product=self.product,
+                                              size=Size.objects.create(name='L'), stock=2)
+        response = self.client.post(reverse('cart:add_to_cart', args=[self.product.slug]),
+                                    {'quantity': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Cart.objects.get().get_items().get().product_size, in_stock)
+
+
+class CartAdminTests(CartTestMixin, TestCase):
+    def test_changelist_totals_do_not_cost_a_query_per_cart(self):
+        staff = CustomUser.objects.create_superuser('staff@example.com', 'Staff', 'User',
+                                                    password='staff-password-123')
+        self.client.force_login(staff)
+
+        def changelist_selects():
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(reverse('admin:cart_cart_changelist'))
+            return response, len(ctx.captured_queries)
+
+        cart = Cart.objects.create(session_key='a' * 32)
+        cart.items.create(product=self.product, product_size=self.product_size, quantity=3)
+        response, one = changelist_selects()
+        self.assertContains(response, '<td class="field-total_items">3</td>', html=True)
+        for i in range(5):
+            Cart.objects.create(session_key=str(i) * 32).items.create(
+                product=self.product, product_size=self.product_size, quantity=1
+            )
+        self.assertEqual(changelist_selects()[1], one)
+
+
+class CartQueryBudgetTests(QueryBudgetMixin, TestCase):
+    namespace = 'cart'
@@ -1,45 +1,29 @@
+from django.conf import settings
 from django.shortcuts import get_object_or_404, redirect
 from django.views.generic import View
-from django.http import JsonResponse, HttpResponse
+from django.http import Http404, JsonResponse, HttpResponse
 from django.template.response import TemplateResponse
 from django.contrib import messages
 from django.db import transaction
-from main.models import Product, ProductSize
+from django.db.models import Prefetch
+from main.models import Product, ProductSize, Size
 from .models import Cart, CartItem
 from .forms import AddToCartForm
 import json
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 class CartMixin:
     def get_cart(self, request):
-        if hasattr(request, 'cart'):
-            return request.cart
-    
-        if not request.session.session_key:
-            request.session.create()
+        if not hasattr(request, 'cart'):
+            request.cart = Cart.objects.for_request(request)
+        return request.cart
 
-        # Try to get existing cart first
-        cart_id = request.session.get('cart_id')
-        cart = None
-        
-        if cart_id:
-            try:
-                cart = Cart.objects.get(id=cart_id, session_key=request.session.session_key)
-                print(f"DEBUG: Found existing cart {cart.id}")
-            except Cart.DoesNotExist:
-                print(f"DEBUG: Cart {cart_id} not found, creating new one")
-                pass
 
-        if not cart:
-            cart, created = Cart.objects.get_or_create(
-                session_key=request.session.session_key
-            )
-            print(f"DEBUG: Cart created/found: {cart.id} (created: {created})")
-            request.session['cart_id'] = cart.id
-            request.session.modified = True
-
-        request.cart = cart
-        return cart
+    def get_or_create_cart(self, request):
+        return Cart.objects.materialize(request)
     
 
 class CartModalView(CartMixin, View):
@@ -47,7 +31,7 @@ class CartModalView(CartMixin, View):
         cart = self.get_cart(request)
         context = {
             'cart': cart,
-            'cart_items': cart.items.select_related(
+            'cart_items': cart.get_items().select_related(
                 'product',
                 'product_size__size'
             ).order_by('-added_at')
@@ -58,126 +42,82 @@ class CartModalView(CartMixin, View):
 class AddToCartView(CartMixin, View):
     @transaction.atomic
     def post(self, request, slug):
-        print(f"DEBUG: POST request to add product {slug} to cart")
-        print(f"DEBUG: POST data: {request.POST}")
-        print(f"DEBUG: Session key: {request.session.session_key}")
-        
-        cart = self.get_cart(request)
-        print(f"DEBUG: Cart ID: {cart.id if cart else 'None'}")
-        
-        product = get_object_or_404(Product, slug=slug)
-        
-        # Debug: Check product sizes
-        available_sizes = product.product_sizes.filter(stock__gt=0)
-        print(f"DEBUG: Product {product.name} has {available_sizes.count()} available sizes")
-        for size in available_sizes:
-            print(f"  - Size {size.size.name}: {size.stock} in stock, ProductSize ID: {size.id}")
-
+        # Товар и все его размеры: один запрос на размеры, общий с формой
+        product = get_object_or_404(
+            Product.objects.prefetch_related(
+                Prefetch('product_sizes', queryset=ProductSize.objects.select_related('size'))
+            ),
+            slug=slug
+        )
         form = AddToCartForm(request.POST, product=product)
-        
-        # Debug: Check all product sizes (not just available)
-        all_product_sizes = product.product_sizes.all()
-        print(f"DEBUG: Product {product.name} has {all_product_sizes.count()} total sizes:")
-        for size in all_product_sizes:
-            print(f"  - Size {size.size.name}: {size.stock} in stock, ProductSize ID: {size.id}")
-        
-        # Debug: Check form choices
-        if hasattr(form.fields.get('size_id'), 'choices'):
-            print(f"DEBUG: Form size_id choices: {form.fields['size_id'].choices}")
-        else:
-            print(f"DEBUG: size_id field type: {type(form.fields.get('size_id'))}")
-            
-        # Debug: Check what was actually received
-        print(f"DEBUG: Received size_id: {request.POST.get('size_id')}")
-        print(f"DEBUG: Received quantity: {request.POST.get('quantity')}")
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Add to cart: product=%s size_id=%s quantity=%s sizes=%s",
+                product.slug, request.POST.get('size_id'), request.POST.get('quantity'),
+                [(ps.id, ps.size.name, ps.stock) for ps in form.product_sizes],
+                extra={'product_id': product.id,
+                       'session_key': request.session.session_key}
+            )
 
         if not form.is_valid():
-            print(f"DEBUG: Form errors: {form.errors}")
-            print(f"DEBUG: Form data: {form.data}")
-            return JsonResponse({
+            logger.info("Add to cart rejected: product=%s errors=%s",
+                        product.slug, form.errors.as_json())
+            data = {
                 'error': 'Invalid form data',
                 'errors': form.errors,
-                'debug_info': {
+            }
+            if settings.DEBUG:
+                data['debug_info'] = {
                     'post_data': dict(request.POST),
                     'form_data': form.data,
                 }
-            }, status=400)
+            return JsonResponse(data, status=400)
         
         size_id = form.cleaned_data.get('size_id')
+        product_size = form.cleaned_data['product_size']
         
         if size_id:
-            product_size = get_object_or_404(
-                ProductSize,
-                id=size_id,
-                product=product
-            )
-            # Проверяем наличие товара после получения product_size
-            if product_size.stock == 0:
-                return JsonResponse({
-                    'error': f'Размер "{product_size.size.name}" временно отсутствует на складе'
-                }, status=400)
+            if product_size is None:
+                raise Http404('No ProductSize matches the given query.')
         else:
-            product_size = product.product_sizes.filter(stock__gt=0).first()
+            product_size = next((ps for ps in form.product_sizes if ps.stock > 0), None)
             if not product_size:
-                # Check if product has any sizes at all
-                all_sizes = product.product_sizes.all()
-                if all_sizes.exists():
+                if form.product_sizes:
                     # Product has sizes but no stock
-                    # print(f"DEBUG: No stock for product {product.name}")
                     return JsonResponse({
                         'error': f'Товар "{product.name}" временно отсутствует на складе'
                     }, status=400)
-                else:
-                    # Product has no sizes - check if default ProductSize already exists
-                    print(f"DEBUG: Product has no sizes, checking existing ProductSize")
-                    existing_product_size = product.product_sizes.first()
-                    if existing_product_size:
-                        print(f"DEBUG: Using existing ProductSize: {existing_product_size}")
-                        product_size = existing_product_size
-                    else:
-                        # Create a default size and ProductSize for this product
-                        print(f"DEBUG: Creating new default size for product")
-                        from main.models import Size
-                        try:
-                            default_size, created = Size.objects.get_or_create(
-                                name='Универсальный',
-                                defaults={'display_order': 0}
-                            )
-                            print(f"DEBUG: Default size created/found: {default_size} (created: {created})")
-                            product_size = ProductSize.objects.create(
-                                product=product,
-                                size=default_size,
-                                stock=100  # Default stock
-                            )
-                            print(f"DEBUG: ProductSize created: {product_size}")
-                        except Exception as e:
-                            print(f"ERROR: Failed to create size/product_size: {e}")
-                            return JsonResponse({'error': f'Failed to create size: {str(e)}'}, status=500)
-            
+                # Product has no sizes - create a default size and ProductSize for it
+                logger.info("Creating default size for product=%s", product.slug)
+                try:
+                    default_size, created = Size.objects.get_or_create(
+                        name='Универсальный',
+                        defaults={'display_order': 0}
+                    )
+                    product_size = ProductSize.objects.create(
+                        product=product,
+                        size=default_size,
+                        stock=100  # Default stock
+                    )
+                except Exception as e:
+                    logger.exception("Failed to create default size for product=%s", product.slug)
+                    return JsonResponse({'error': f'Failed to create size: {str(e)}'}, status=500)
 
         quantity = form.cleaned_data['quantity']
-        if product_size.stock < quantity:
+        cart = self.get_or_create_cart(request)
+        # Остаток проверяет сам условный UPDATE резерва, а не Python
+        cart_item = cart.add_product(product, product_size, quantity)
+        if cart_item is None:
+            product_size.refresh_from_db(fields=['stock'])
+            if product_size.stock == 0:
+                return JsonResponse({
+                    'error': f'Размер "{product_size.size.name}" временно отсутствует на складе'
+                }, status=400)
             return JsonResponse({
                 'error': f'Only {product_size.stock} items available'
             }, status=400)
 
-        existing_item = cart.items.filter(
-            product=product,
-            product_size=product_size,
-        ).first()
-
-        if existing_item:
-            total_quantity = existing_item.quantity + quantity
-            if total_quantity > product_size.stock:
-                return JsonResponse({
-                    'error': f"Cannot add {quantity} items. Only {product_size.stock - existing_item.quantity} more available."
-                }, status=400)
-            
-        cart_item = cart.add_product(product, product_size, quantity)
-
-        request.session['cart_id'] = cart.id
-        request.session.modified = True
-
         if request.headers.get('HX-Request'):
             return redirect('cart:cart_modal')
         else:
@@ -193,7 +133,7 @@ class UpdateCartItemView(CartMixin, View):
     @transaction.atomic
     def post(self, request, item_id):
         cart = self.get_cart(request)
-        cart_item = get_object_or_404(CartItem, id=item_id, cart=cart)
+        cart_item = get_object_or_404(cart.get_items(), id=item_id)
 
         data = json.loads(request.body) if request.content_type == 'application/json' else request.POST
         quantity = int(data.get('quantity', 1))
@@ -201,19 +141,13 @@ class UpdateCartItemView(CartMixin, View):
         if quantity < 0:
             return JsonResponse({'error': 'Invalid quantity'}, status=400)
         
-        if quantity == 0:
-            cart_item.delete()
-        else:
-            if quantity > cart_item.product_size.stock:
-                return JsonResponse({
-                    'error': f'Only {cart_item.product_size.stock} items available'
-                }, status=400)
-            
-            cart_item.quantity = quantity
-            cart_item.save()
-
-        request.session['cart_id'] = cart.id
-        request.session.modified = True
+        if not cart.set_item_quantity(cart_item, quantity):
+            available = cart_item.quantity + ProductSize.objects.values_list(
+                'stock', flat=True
+            ).get(pk=cart_item.product_size_id)
+            return JsonResponse({
+                'error': f'Only {available} items available'
+            }, status=400)
 
         return JsonResponse({
             'success': True,
@@ -226,27 +160,21 @@ class RemoveCartItemView(CartMixin, View):
     def post(self, request, item_id):
         cart = self.get_cart(request)
 
-        try:
-            cart_item = cart.items.get(id=item_id)
-            cart_item.delete()
-
-            request.session['cart_id'] = cart.id
-            request.session.modified = True
+        if not cart.remove_item(item_id):
+            return JsonResponse({'error': 'Item not found'}, status=400)
 
-            # If it's an HTMX request, return HTML
-            if request.headers.get('HX-Request'):
-                return TemplateResponse(request, 'cart/cart_modal.html', {
-                    'cart': cart,
-                })
-            
-            # Otherwise return JSON
-            return JsonResponse({
-                'success': True,
-                'total_items': cart.total_items,
-                'message': 'Item removed from cart'
+        # If it's an HTMX request, return HTML
+        if request.headers.get('HX-Request'):
+            return TemplateResponse(request, 'cart/cart_modal.html', {
+                'cart': cart,
             })
-        except CartItem.DoesNotExist:
-            return JsonResponse({'error': 'Item not found'}, status=400)
+        
+        # Otherwise return JSON
+        return JsonResponse({
+            'success': True,
+            'total_items': cart.total_items,
+            'message': 'Item removed from cart'
+        })
         
     
 class CartCountView(CartMixin, View):
@@ -263,9 +191,6 @@ class ClearCartView(CartMixin, View):
         cart = self.get_cart(request)
         cart.clear()
 
-        request.session['cart_id'] = cart.id
-        request.session.modified = True
-
         if request.headers.get('HX-Request'):
             return TemplateResponse(request, 'cart/cart_empty.html', {
                 'cart': cart
@@ -281,7 +206,7 @@ class CartSummaryView(CartMixin, View):
         cart = self.get_cart(request)
         context = {
             'cart': cart,
-            'cart_items': cart.items.select_related(
+            'cart_items': cart.get_items().select_related(
                 'product',
                 'product_size__size'
             ).order_by('-added_at')
@@ -0,0 +1,109 @@
+"""Read-replica routing.
+
+Views marked with ``read_from_replica`` (catalog pages, order history) and
+the admin changelists read products, categories and past orders from one
+of ``REPLICA_DATABASES``. Everything else - writes, other views, management
+commands and workers - stays on ``default``.
+
+A client that has just written (any unsafe request: add to cart,
+checkout, admin save) gets a cookie that keeps its reads on ``default``
+for ``REPLICA_PIN_SECONDS``, so it sees its own order and stock changes
+before the replicas catch up.
+
+Without ``REPLICA_DATABASES`` the router returns ``None`` and Django uses
+``default`` as before.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+REPLICA_PIN_SECONDS = getattr(settings, 'REPLICA_PIN_SECONDS', 15)
+REPLICA_PIN_COOKIE = 'db_pinned'
+
+# Модели, которые можно читать с отставанием реплики
+REPLICA_MODELS = {
+    'main.category', 'main.categorysummary', 'main.product', 'main.productimage',
+    'main.productsize', 'main.size',
+    'orders.order', 'orders.orderitem',
+}
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Разрешено ли текущему запросу читать с реплики; вне запросов - нет
+_replica_reads = ContextVar('replica_reads', default=False)
+
+
+@contextmanager
+def use_replicas(enabled=True):
+    token = _replica_reads.set(enabled)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def read_from_replica(view_func):
+    """Mark a read-only view whose model reads may lag behind ``default``."""
+    view_func.read_from_replica = True
+    return view_func
+
+
+class ReplicaRouter:
+    def __init__(self):
+        self.replicas = list(getattr(settings, 'REPLICA_DATABASES', ()))
+
+
+    def db_for_read(self, model, **hints):
+        if not self.replicas or not _replica_reads.get():
+            return None
+        if model._meta.label_lower not in REPLICA_MODELS:
+            return None
+        return random.choice(self.replicas)
+
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики содержат те же строки, что и default
+        databases = {DEFAULT_DB_ALIAS, *self.replicas}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in self.replicas:
+            return False
+        return None
+
+
+class ReplicaMiddleware:
+    """Turn replica reads on for marked views, pin clients that just wrote."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+
+    def __call__(self, request):
+        with use_replicas(False):
+            response = self.get_response(request)
+        if request.method not in SAFE_METHODS:
+            response.set_cookie(REPLICA_PIN_COOKIE, '1', max_age=REPLICA_PIN_SECONDS,
+                                httponly=True, samesite='Lax')
+        return response
+
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method not in SAFE_METHODS or REPLICA_PIN_COOKIE in request.COOKIES:
+            return None
+        match = request.resolver_match
+        if getattr(view_func, 'read_from_replica', False) or (
+                match.namespace == 'admin' and match.url_name
+                and match.url_name.endswith('_changelist')):
+            # Сбрасывается вместе с use_replicas(False) в __call__
+            _replica_reads.set(True)
+        return None
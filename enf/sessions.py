@@ -0,0 +1,93 @@
+"""Write-behind session engine.
+
+``SESSION_SAVE_EVERY_REQUEST`` makes Django save the session on every
+response to push its expiry forward. Here the cache (``SESSION_CACHE_ALIAS``)
+takes those saves, and the ``django_session`` row is only written when the
+session data actually changed or when the row is older than
+``SESSION_DB_REFRESH`` seconds. Reads come from the cache and fall back to
+the database when the cache was cleared or evicted.
+
+Because an idle row is refreshed at most every ``SESSION_DB_REFRESH``
+seconds, its ``expire_date`` may lag behind the cached session by that much,
+so ``clear_expired`` (``manage.py clearsessions``) keeps that grace period.
+"""
+import logging
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'enf.sessions.'
+SESSION_DB_REFRESH = getattr(settings, 'SESSION_DB_REFRESH', 60 * 60)
+
+
+class SessionStore(CachedDBStore):
+    cache_key_prefix = KEY_PREFIX
+
+
+    def __init__(self, session_key=None):
+        super().__init__(session_key)
+        # Состояние строки в БД: что в ней лежит и когда она записана
+        self._persisted_state = None
+        self._persisted_at = None
+
+
+    @property
+    def persisted_key(self):
+        return self.cache_key + ':db'
+
+
+    def _state(self, data):
+        return self.serializer().dumps(data)
+
+
+    def load(self):
+        try:
+            cached = self._cache.get_many([self.cache_key, self.persisted_key])
+        except Exception:
+            cached = {}
+        data = cached.get(self.cache_key)
+        if data is None:
+            # Из БД: строка заведомо свежая
+            data = super().load()
+            self._persisted_at = time.time()
+        else:
+            self._persisted_at = cached.get(self.persisted_key)
+        self._persisted_state = self._state(data)
+        return data
+
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        data = self._get_session(no_load=must_create)
+        state = self._state(data)
+        now = time.time()
+        stale = self._persisted_at is None or now - self._persisted_at >= SESSION_DB_REFRESH
+        if must_create or state != self._persisted_state or stale:
+            # Минуя cached_db: в кэш пишем ниже, вместе с отметкой о записи
+            super(CachedDBStore, self).save(must_create)
+            self._persisted_state, self._persisted_at = state, now
+        try:
+            self._cache.set_many({self.cache_key: data,
+                                  self.persisted_key: self._persisted_at},
+                                 self.get_expiry_age())
+        except Exception:
+            logger.exception("Error saving session to cache (%s)", self._cache)
+
+
+    def delete(self, session_key=None):
+        if session_key is None and self.session_key is not None:
+            session_key = self.session_key
+        super().delete(session_key)
+        if session_key is not None:
+            self._cache.delete(self.cache_key_prefix + session_key + ':db')
+
+
+    @classmethod
+    def clear_expired(cls):
+        grace = timezone.now() - timedelta(seconds=SESSION_DB_REFRESH)
+        return cls.get_model_class().objects.filter(expire_date__lt=grace).delete()[0]
@@ -55,6 +55,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 
     'main',
     'users',
@@ -73,8 +74,20 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 
     'cart.middleware.CartMiddleware',
+    'main.profiling.ProfilingMiddleware',
+    'enf.routers.ReplicaMiddleware',
 ]
 
+# Доля запросов, которые профилирует main.profiling (0 - выключено);
+# агрегаты на /metrics/, последние запросы на /metrics/samples.jsonl
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', '0.01'))
+PROFILING_BUFFER_SIZE = 1000
+PROFILING_VIEW_WINDOW = 200
+PROFILING_JSONL_PATH = os.getenv('PROFILING_JSONL_PATH') or None
+# За nginx REMOTE_ADDR - всегда адрес прокси, поэтому Prometheus приходит
+# с заголовком "Authorization: Bearer <PROFILING_TOKEN>" (bearer_token в scrape config)
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN') or None
+
 ROOT_URLCONF = 'enf.urls'
 
 TEMPLATES = [
@@ -108,9 +121,67 @@ DATABASES = {
         'HOST': os.getenv('POSTGRES_HOST', 'db'),
         'PORT': os.getenv('POSTGRES_PORT', '5432'),
         'ATOMIC_REQUESTS': True,
+        # Воркер держит соединение между запросами вместо подключения на каждый
+        # запрос; перед повторным использованием Django проверяет его
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', '60')),
+        'CONN_HEALTH_CHECKS': True,
+        # За pgbouncer в режиме transaction серверные курсоры (.iterator())
+        # не переживают смену соединения между транзакциями
+        'DISABLE_SERVER_SIDE_CURSORS': os.getenv('DB_PGBOUNCER') == '1',
     }
 }
 
+# Пул psycopg 3 (pip install "psycopg[pool]") вместо постоянных соединений:
+# DB_POOL_SIZE - максимум соединений на процесс. Django не совмещает пул с
+# CONN_MAX_AGE, соединение возвращается в пул в конце запроса.
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '0'))
+if DB_POOL_SIZE:
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['OPTIONS'] = {
+        'pool': {'min_size': 1, 'max_size': DB_POOL_SIZE, 'timeout': 10},
+    }
+
+# Реплики только для чтения (enf.routers): POSTGRES_REPLICA_HOSTS - хосты через
+# запятую. На них идут каталог, история заказов и списки в админке; клиент,
+# только что сделавший запись, REPLICA_PIN_SECONDS читает с default.
+REPLICA_DATABASES = []
+for i, host in enumerate(h for h in os.getenv('POSTGRES_REPLICA_HOSTS', '').split(',') if h):
+    alias = 'replica' if i == 0 else f'replica{i + 1}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'ATOMIC_REQUESTS': False,
+        'TEST': {'MIRROR': 'default'},
+    }
+    REPLICA_DATABASES.append(alias)
+REPLICA_PIN_SECONDS = 15
+DATABASE_ROUTERS = ['enf.routers.ReplicaRouter']
+
+
+# Cache
+# Файловый кэш общий для всех воркеров gunicorn в контейнере;
+# версия каталога и кэш фрагментов должны быть видны всем процессам
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND',
+                             'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', '/tmp/enf_cache'),
+    },
+    # Отдельно от кэша фрагментов: его очистка не должна разлогинивать,
+    # а отсечение по MAX_ENTRIES - терять корзины. В проде - Redis
+    # (SESSION_CACHE_BACKEND=django.core.cache.backends.redis.RedisCache)
+    'sessions': {
+        'BACKEND': os.getenv('SESSION_CACHE_BACKEND',
+                             'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.getenv('SESSION_CACHE_LOCATION', '/tmp/enf_sessions'),
+    },
+}
+if CACHES['sessions']['BACKEND'].endswith('FileBasedCache'):
+    CACHES['sessions']['OPTIONS'] = {'MAX_ENTRIES': 100000}
+
+FRAGMENT_CACHE_TIMEOUT = 60 * 60
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -152,6 +223,10 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# WebP копии фото товаров для srcset (main/images.py)
+IMAGE_DERIVATIVE_WIDTHS = (320, 640, 1024)
+IMAGE_DERIVATIVE_QUALITY = 80
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
@@ -161,6 +236,19 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 SESSION_COOKIE_AGE = 86400  # 30 дней в секундах
 SESSION_SAVE_EVERY_REQUEST = True
+# Сессии в кэше, строка в БД пишется при изменении данных
+# или раз в SESSION_DB_REFRESH секунд (enf/sessions.py)
+SESSION_ENGINE = 'enf.sessions'
+SESSION_CACHE_ALIAS = 'sessions'
+SESSION_DB_REFRESH = 60 * 60
+
+# Сколько секунд кэшируется id корзины сессии (в т.ч. "корзины нет")
+CART_CACHE_TIMEOUT = 60
+
+# Резерв товара: корзина держит его 30 минут, неоплаченный заказ - час
+# (Stripe принимает срок жизни сессии оплаты от 30 минут до суток)
+STOCK_RESERVATION_TTL = 30 * 60
+STOCK_CHECKOUT_TTL = 60 * 60
 
 AUTH_USER_MODEL = 'users.CustomUser'
 
@@ -168,4 +256,14 @@ AUTH_USER_MODEL = 'users.CustomUser'
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY') 
 STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
 HELEKET_API_KEY = os.getenv('HELEKET_API_KEY', '')
-HELEKET_SECRET_KEY = os.getenv('HELEKET_SECRET_KEY', '')
\ No newline at end of file
+HELEKET_SECRET_KEY = os.getenv('HELEKET_SECRET_KEY', '')
+HELEKET_MERCHANT_ID = os.getenv('HELEKET_MERCHANT_ID', '')
+# Например http://localhost:8765 для payment.stubs
+HELEKET_BASE_URL = os.getenv('HELEKET_BASE_URL', 'https://api.heleket.com/v1')
+
+# Например http://localhost:12111 для stripe-mock
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE', 'https://api.stripe.com')
+
+# Outbox платежей: потоки для вызовов провайдера и число попыток
+PAYMENT_WORKERS = int(os.getenv('PAYMENT_WORKERS', 4))
+PAYMENT_MAX_ATTEMPTS = 3
\ No newline at end of file
@@ -0,0 +1,370 @@
+"""Query-count and latency budget harness.
+
+Seeds a catalog, replays every route from ``enf/urls.py`` (full page and
+``HX-Request`` variants) and compares the query count and render time of
+each one with ``perf_budgets.json``. Used by the ``QueryBudget*`` tests in
+every app and by ``manage.py bench`` for the full-size run.
+"""
+import json
+import math
+import statistics
+import time
+from decimal import Decimal
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from cart.models import Cart, CartItem
+from orders.models import Order, OrderItem
+from payment.models import PaymentRequest
+from .models import Category, Product, ProductImage, ProductSize, Size
+from .search import rebuild_search_index
+from .summary import refresh_category_summary
+
+
+BUDGET_FILE = getattr(settings, 'PERF_BUDGET_FILE',
+                      settings.BASE_DIR / 'perf_budgets.json')
+
+COLORS = ['black', 'white', 'red', 'blue', 'green', 'beige', 'grey', 'navy']
+SIZE_NAMES = ['XS', 'S', 'M', 'L', 'XL', 'XXL', '3XL', '4XL']
+
+# Прогон чистит кэш перед каждым замером и оставляет свои данные,
+# поэтому каждый алиас подменяется собственным LocMemCache
+BENCH_CACHES = {
+    alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': f'bench-{alias}'}
+    for alias in settings.CACHES
+}
+
+
+def isolated_caches():
+    """Point every cache alias at a private LocMemCache for the run."""
+    return override_settings(CACHES=BENCH_CACHES)
+
+
+class BenchmarkFixture:
+    password = 'bench-password-123'
+
+
+    def __init__(self, products=2000, sizes_per_product=6, images_per_product=3,
+                 categories=8, orders=20, items_per_order=5, cart_sizes=(1, 50)):
+        self.product_count = products
+        self.sizes_per_product = min(sizes_per_product, len(SIZE_NAMES))
+        self.images_per_product = images_per_product
+        self.category_count = categories
+        self.order_count = orders
+        self.items_per_order = items_per_order
+        self.cart_sizes = cart_sizes
+        self.cart_item_ids = []
+
+
+    def seed(self):
+        self.categories = Category.objects.bulk_create([
+            Category(name=f'Category {i}', slug=f'bench-category-{i}')
+            for i in range(self.category_count)
+        ])
+        sizes = Size.objects.bulk_create([
+            Size(name=name) for name in SIZE_NAMES[:self.sizes_per_product]
+        ])
+        self.products = Product.objects.bulk_create([
+            Product(
+                name=f'Product {i}', slug=f'bench-product-{i}',
+                category=self.categories[i % self.category_count],
+                color=COLORS[i % len(COLORS)],
+                price=Decimal(10 + (i * 7) % 290),
+                description=f'Cotton {COLORS[i % len(COLORS)]} product number {i}',
+                main_image='products/main/bench.jpg',
+            )
+            for i in range(self.product_count)
+        ])
+        ProductImage.objects.bulk_create([
+            ProductImage(product=product, image=f'products/extra/bench-{i}.jpg')
+            for product in self.products
+            for i in range(self.images_per_product)
+        ])
+        self.product_sizes = ProductSize.objects.bulk_create([
+            ProductSize(product=product, size=size, stock=1000)
+            for product in self.products
+            for size in sizes
+        ])
+        # bulk_create не вызывает сигналы индексации и сводок категорий
+        rebuild_search_index()
+        for category in self.categories:
+            refresh_category_summary(category.id)
+
+        User = get_user_model()
+        self.user = User.objects.create_user(
+            'bench@example.com', 'Bench', 'User', password=self.password
+        )
+        self.staff = User.objects.create_superuser(
+            'staff@example.com', 'Staff', 'User', password=self.password
+        )
+        self.orders = Order.objects.bulk_create([
+            Order(user=self.user, first_name='Bench', last_name='User',
+                  email=self.user.email, total_price=Decimal('100.00'),
+                  payment_provider='stripe')
+            for _ in range(self.order_count)
+        ])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product_size.product,
+                      size=product_size, quantity=1,
+                      price=product_size.product.price)
+            for order in self.orders
+            for product_size in self.product_sizes[:self.items_per_order]
+        ])
+        PaymentRequest.objects.create(order=self.orders[0], provider='stripe')
+        self.product = self.products[0]
+        self.category = self.categories[0]
+        self.order = self.orders[0]
+        return self
+
+
+    def fill_cart(self, session_key, size):
+        cart, created = Cart.objects.get_or_create(session_key=session_key)
+        cart.items.all().delete()
+        # Разные товары, чтобы N+1 по product/size был заметен
+        step = self.sizes_per_product
+        items = CartItem.objects.bulk_create([
+            CartItem(cart=cart, product=product_size.product,
+                     product_size=product_size, quantity=1)
+            for product_size in self.product_sizes[::step][:size]
+        ])
+        self.cart_item_ids = [item.id for item in items]
+        return cart
+
+
+    def client_for(self, endpoint, cart_size):
+        client = Client()
+        if endpoint.get('login') == 'staff':
+            client.force_login(self.staff)
+        elif endpoint.get('login'):
+            client.force_login(self.user)
+        if endpoint.get('cart'):
+            session = client.session
+            cart = self.fill_cart(session.session_key, cart_size)
+            session['cart_id'] = cart.id
+            session.save()
+        return client
+
+
+ENDPOINTS = [
+    # main
+    {'name': 'main:index', 'url': lambda fx: reverse('main:index')},
+    {'name': 'main:catalog_all', 'url': lambda fx: reverse('main:catalog_all')},
+    {'name': 'main:catalog_all?q', 'url': lambda fx: reverse('main:catalog_all') + '?q=cotton'},
+    {'name': 'main:catalog_all?filters',
+     'url': lambda fx: reverse('main:catalog_all') + '?show_filters=true&color=black'},
+    {'name': 'main:catalog', 'url': lambda fx: reverse('main:catalog', args=[fx.category.slug])},
+    {'name': 'main:product_detail',
+     'url': lambda fx: reverse('main:product_detail', args=[fx.product.slug])},
+    # cart
+    {'name': 'cart:cart_modal', 'url': lambda fx: reverse('cart:cart_modal'), 'cart': True},
+    {'name': 'cart:cart_count', 'url': lambda fx: reverse('cart:cart_count'), 'cart': True},
+    {'name': 'cart:cart_summary', 'url': lambda fx: reverse('cart:cart_summary'), 'cart': True},
+    {'name': 'cart:add_to_cart', 'method': 'post', 'cart': True,
+     'url': lambda fx: reverse('cart:add_to_cart', args=[fx.product.slug]),
+     'data': lambda fx: {'size_id': fx.product_sizes[0].id, 'quantity': 1}},
+    {'name': 'cart:update_item', 'method': 'post', 'cart': True,
+     'url': lambda fx: reverse('cart:update_item', args=[fx.cart_item_ids[0]]),
+     'data': lambda fx: {'quantity': 2}},
+    {'name': 'cart:remove_item', 'method': 'post', 'cart': True,
+     'url': lambda fx: reverse('cart:remove_item', args=[fx.cart_item_ids[0]])},
+    {'name': 'cart:clear_cart', 'method': 'post', 'cart': True,
+     'url': lambda fx: reverse('cart:clear_cart')},
+    # orders
+    {'name': 'orders:checkout', 'url': lambda fx: reverse('orders:checkout'),
+     'login': True, 'cart': True},
+    {'name': 'orders:checkout[invalid]', 'method': 'post', 'login': True, 'cart': True,
+     'url': lambda fx: reverse('orders:checkout'),
+     'data': lambda fx: {'payment_provider': ''}},
+    {'name': 'orders:history', 'url': lambda fx: reverse('orders:history'), 'login': True},
+    # payment
+    {'name': 'payment:stripe_webhook', 'method': 'post', 'hx': False,
+     'url': lambda fx: reverse('payment:stripe_webhook')},
+    {'name': 'payment:stripe_success', 'url': lambda fx: reverse('payment:stripe_success')},
+    {'name': 'payment:stripe_cancel',
+     'url': lambda fx: reverse('payment:stripe_cancel') + f'?order_id={fx.order.id}'},
+    {'name': 'payment:heleket_webhook', 'method': 'post', 'hx': False,
+     'url': lambda fx: reverse('payment:heleket_webhook')},
+    {'name': 'payment:heleket_success',
+     'url': lambda fx: reverse('payment:heleket_success') + f'?order_id={fx.order.id}'},
+    {'name': 'payment:heleket_cancel',
+     'url': lambda fx: reverse('payment:heleket_cancel') + f'?order_id={fx.order.id}'},
+    {'name': 'payment:heleket_processing', 'url': lambda fx: reverse('payment:heleket_processing')},
+    {'name': 'payment:payment_status', 'login': True,
+     'url': lambda fx: reverse('payment:payment_status', args=[fx.order.id])},
+    # users
+    {'name': 'users:register', 'url': lambda fx: reverse('users:register')},
+    {'name': 'users:login', 'url': lambda fx: reverse('users:login')},
+    {'name': 'users:profile', 'url': lambda fx: reverse('users:profile'), 'login': True},
+    {'name': 'users:account_details', 'url': lambda fx: reverse('users:account_details'),
+     'login': True},
+    {'name': 'users:edit_account_details',
+     'url': lambda fx: reverse('users:edit_account_details'), 'login': True},
+    {'name': 'users:update_account_details',
+     'url': lambda fx: reverse('users:update_account_details'), 'login': True},
+    {'name': 'users:order_detail', 'login': True,
+     'url': lambda fx: reverse('users:order_detail', args=[fx.order.id])},
+    {'name': 'users:logout', 'url': lambda fx: reverse('users:logout'), 'login': True},
+    # admin
+    {'name': 'admin:index', 'url': lambda fx: reverse('admin:index'),
+     'login': 'staff', 'hx': False},
+    {'name': 'admin:main_product_changelist', 'login': 'staff', 'hx': False,
+     'url': lambda fx: reverse('admin:main_product_changelist')},
+    {'name': 'admin:cart_cart_changelist', 'login': 'staff', 'hx': False,
+     'url': lambda fx: reverse('admin:cart_cart_changelist')},
+    {'name': 'admin:orders_order_changelist', 'login': 'staff', 'hx': False,
+     'url': lambda fx: reverse('admin:orders_order_changelist')},
+    {'name': 'admin:orders_order_change', 'login': 'staff', 'hx': False,
+     'url': lambda fx: reverse('admin:orders_order_change', args=[fx.order.id])},
+]
+
+
+def endpoints_for(namespace=None):
+    if namespace is None:
+        return ENDPOINTS
+    return [e for e in ENDPOINTS if e['name'].split(':')[0] == namespace]
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def measure(fixture, endpoint, hx=False, cart_size=0, repeat=5):
+    method = endpoint.get('method', 'get')
+    headers = {'HTTP_HX_REQUEST': 'true'} if hx else {}
+    timings = []
+    queries = 0
+    status = None
+    for _ in range(repeat):
+        client = fixture.client_for(endpoint, cart_size)
+        url = endpoint['url'](fixture)
+        data = endpoint['data'](fixture) if 'data' in endpoint else None
+        # Меряем холодный путь: кэш фрагментов скрыл бы N+1.
+        # Это кэш прогона, см. isolated_caches()
+        cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            start = time.perf_counter()
+            response = getattr(client, method)(url, data, **headers)
+            timings.append((time.perf_counter() - start) * 1000)
+        queries = max(queries, len(ctx.captured_queries))
+        status = response.status_code
+
+    return {
+        'endpoint': endpoint['name'],
+        'variant': 'hx' if hx else 'full',
+        'cart_items': cart_size,
+        'status': status,
+        'queries': queries,
+        'p50_ms': round(statistics.median(timings), 2),
+        'p95_ms': round(percentile(timings, 95), 2),
+    }
+
+
+def run_endpoint(fixture, endpoint, repeat=5):
+    variants = [False, True] if endpoint.get('hx', True) else [False]
+    cart_sizes = fixture.cart_sizes if endpoint.get('cart') else (0,)
+    return [
+        measure(fixture, endpoint, hx=hx, cart_size=size, repeat=repeat)
+        for hx in variants
+        for size in cart_sizes
+    ]
+
+
+def measure_connection_reuse(repeat=50, alias=DEFAULT_DB_ALIAS):
+    """Per-request database overhead with and without persistent connections.
+
+    Replays what a request does to its connection: ``close_old_connections``
+    on request start and finish around one trivial query. With
+    ``CONN_MAX_AGE=0`` every iteration connects anew, with the configured
+    ``CONN_MAX_AGE`` (at least 60s here) it pays the health check instead.
+    An in-memory SQLite test database never closes, so run it on Postgres.
+    """
+    conn = connections[alias]
+    configured = conn.settings_dict['CONN_MAX_AGE']
+    results = []
+    try:
+        for label, max_age in (('per-request', 0), ('persistent', configured or 60)):
+            conn.close()
+            conn.settings_dict['CONN_MAX_AGE'] = max_age
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                conn.close_if_unusable_or_obsolete()
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                conn.close_if_unusable_or_obsolete()
+                timings.append((time.perf_counter() - start) * 1000)
+            results.append({
+                'connections': label,
+                'conn_max_age': max_age,
+                'p50_ms': round(statistics.median(timings), 3),
+                'p95_ms': round(percentile(timings, 95), 3),
+            })
+    finally:
+        conn.settings_dict['CONN_MAX_AGE'] = configured
+    return results
+
+
+def load_budgets(path=BUDGET_FILE):
+    with open(path) as f:
+        return json.load(f)
+
+
+def check_budget(result, budgets, latency=True):
+    """Return the list of budget violations for one measurement."""
+    name = f"{result['endpoint']} [{result['variant']}]"
+    budget = budgets.get(result['endpoint'], {}).get(result['variant'])
+    if budget is None:
+        return [f'{name}: no budget in {BUDGET_FILE.name}']
+
+    violations = []
+    if result['status'] >= 500:
+        violations.append(f"{name}: status {result['status']}")
+    if result['queries'] > budget['queries']:
+        violations.append(
+            f"{name} with {result['cart_items']} cart items: "
+            f"{result['queries']} queries > budget {budget['queries']}"
+        )
+    if latency and result['p95_ms'] > budget['p95_ms']:
+        violations.append(
+            f"{name}: p95 {result['p95_ms']}ms > budget {budget['p95_ms']}ms"
+        )
+    return violations
+
+
+class QueryBudgetMixin:
+    """Fails when an app's endpoints exceed their query budget.
+
+    Latency is only enforced by ``manage.py bench``: test machines are too
+    noisy for millisecond budgets, query counts are not.
+    """
+    namespace = None
+
+
+    @classmethod
+    def setUpClass(cls):
+        cls.enterClassContext(isolated_caches())
+        super().setUpClass()
+
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.fixture = BenchmarkFixture(products=60, sizes_per_product=4,
+                                       images_per_product=2, categories=3,
+                                       orders=5).seed()
+
+
+    def test_query_budgets(self):
+        budgets = load_budgets()
+        for endpoint in endpoints_for(self.namespace):
+            for result in run_endpoint(self.fixture, endpoint, repeat=1):
+                with self.subTest(endpoint=result['endpoint'],
+                                  variant=result['variant'],
+                                  cart_items=result['cart_items']):
+                    self.assertEqual(check_budget(result, budgets, latency=False), [])
@@ -0,0 +1,124 @@
+import hashlib
+import time
+from functools import partial, wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+
+CATALOG_VERSION_KEY = 'catalog:version'
+FRAGMENT_CACHE_TIMEOUT = getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 60 * 60)
+# Заголовки ответа, которые хранятся вместе с фрагментом
+FRAGMENT_HEADERS = ('ETag', 'Last-Modified', 'Cache-Control', 'Vary')
+
+
+def _seed_catalog_version():
+    # Счётчик может быть вытеснен из кэша вместе с фрагментами. Новое начало
+    # отсчёта - текущее время в наносекундах: оно больше любой прежней версии,
+    # так что старые фрагменты не оживут
+    cache.add(CATALOG_VERSION_KEY, time.time_ns(), None)
+
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        _seed_catalog_version()
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    """Invalidate every cached catalog fragment at once."""
+    try:
+        return cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        _seed_catalog_version()
+        return cache.incr(CATALOG_VERSION_KEY)
+
+
+def fragment_cache_key(request, *parts):
+    # Порядок GET параметров не должен плодить разные ключи
+    params = sorted((key, request.GET.getlist(key)) for key in request.GET)
+    digest = hashlib.md5(f"{request.path}?{params}|{parts}".encode()).hexdigest()
+    # v2: в кэше лежат ещё и заголовки ответа
+    return f"fragment:v2:{get_catalog_version()}:{digest}"
+
+
+def catalog_etag(request, *parts):
+    """Strong ETag of a catalog response.
+
+    Covers the URL, the HTMX variant and the catalog version (bumped on
+    product, category and size changes) plus ``parts``: the row timestamps
+    the page is rendered from.
+    """
+    raw = '|'.join(str(part) for part in (
+        request.get_full_path(), bool(request.headers.get('HX-Request')),
+        get_catalog_version(), *parts,
+    ))
+    return quote_etag(hashlib.md5(raw.encode()).hexdigest())
+
+
+def set_conditional_headers(response, etag, last_modified=None):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    # Страница и HTMX фрагмент живут по одному URL; браузер хранит ответ,
+    # но перед показом всегда сверяет ETag
+    patch_vary_headers(response, ('HX-Request',))
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def not_modified(request, etag, last_modified=None):
+    """A 304 response if the client's If-None-Match has ``etag``, else None.
+
+    Only the ETag is validated: Last-Modified is informational, since a
+    product leaving the page does not move any timestamp forward.
+    """
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        return None
+    return set_conditional_headers(response, etag, last_modified)
+
+
+def cache_fragment(view_func=None, *, vary_on=None):
+    """Cache HTMX partial responses until the catalog version changes.
+
+    Only HX-Request GETs are cached: the partials contain no per-user
+    data, while full pages still render the header for each visitor.
+    ``vary_on(request, *args, **kwargs)`` adds key parts computed before
+    the lookup, for fragments that follow rows which do not bump the
+    catalog version.
+    """
+    if view_func is None:
+        return partial(cache_fragment, vary_on=vary_on)
+
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        if request.method != 'GET' or not request.headers.get('HX-Request'):
+            return view_func(request, *args, **kwargs)
+
+        parts = vary_on(request, *args, **kwargs) if vary_on else ()
+        key = fragment_cache_key(request, *parts)
+        cached = cache.get(key)
+        if cached is not None:
+            content, content_type, headers = cached
+            response = HttpResponse(content, content_type=content_type)
+            for header, value in headers.items():
+                response[header] = value
+            # Совпавший ETag - 304 без запросов к базе, кроме vary_on
+            return get_conditional_response(request, etag=headers.get('ETag'),
+                                            response=response)
+
+        response = view_func(request, *args, **kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+        if response.status_code == 200:
+            headers = {header: response[header] for header in FRAGMENT_HEADERS
+                       if header in response}
+            cache.set(key, (response.content, response['Content-Type'], headers),
+                      FRAGMENT_CACHE_TIMEOUT)
+        return response
+    return wrapper
@@ -0,0 +1,101 @@
+from functools import reduce
+from operator import or_
+from django import forms
+from django.db.models import Exists, OuterRef, Q
+from django.http import QueryDict
+from .models import ProductSize
+
+# Больше значений одного фильтра в запросе не берём
+MAX_FILTER_VALUES = 20
+
+
+class MultipleValueField(forms.Field):
+    """Repeated parameters and comma separated values: ``?color=black,red&color=blue``."""
+    widget = forms.MultipleHiddenInput
+
+
+    def to_python(self, value):
+        if isinstance(value, str):
+            value = [value]
+        values = []
+        for item in value or []:
+            for part in str(item).split(','):
+                part = part.strip()
+                if part and part not in values:
+                    values.append(part)
+        return values[:MAX_FILTER_VALUES]
+
+
+class CatalogFilterForm(forms.Form):
+    """Catalog filters from the query string.
+
+    Every field has a ``filter_<name>`` method that narrows the product
+    queryset with a condition an index can serve. Invalid values are
+    dropped rather than failing the page: the catalog is then shown
+    without that filter.
+    """
+    color = MultipleValueField(required=False)
+    size = MultipleValueField(required=False)
+    min_price = forms.DecimalField(required=False, min_value=0, max_digits=10, decimal_places=2)
+    max_price = forms.DecimalField(required=False, min_value=0, max_digits=10, decimal_places=2)
+
+
+    def clean(self):
+        cleaned_data = super().clean()
+        low, high = cleaned_data.get('min_price'), cleaned_data.get('max_price')
+        if low is not None and high is not None and low > high:
+            cleaned_data['min_price'], cleaned_data['max_price'] = high, low
+        return cleaned_data
+
+
+    @property
+    def values(self):
+        """Valid, non-empty filter values by field name."""
+        self.is_valid()
+        return {name: value for name, value in self.cleaned_data.items()
+                if value not in (None, [])}
+
+
+    def filter(self, queryset):
+        for name, value in self.values.items():
+            queryset = getattr(self, f'filter_{name}')(queryset, value)
+        return queryset
+
+
+    def filter_color(self, queryset, colors):
+        # iexact в Postgres - UPPER("color") = UPPER(%s), индекс product_color_upper_idx
+        return queryset.filter(reduce(or_, (Q(color__iexact=color) for color in colors)))
+
+
+    def filter_size(self, queryset, sizes):
+        # EXISTS вместо JOIN: товар не дублируется, если подходят несколько размеров
+        in_stock = ProductSize.objects.filter(product=OuterRef('pk'), stock__gt=0,
+                                              size__name__in=sizes)
+        return queryset.filter(Exists(in_stock))
+
+
+    def filter_min_price(self, queryset, price):
+        return queryset.filter(price__gte=price)
+
+
+    def filter_max_price(self, queryset, price):
+        return queryset.filter(price__lte=price)
+
+
+    def template_values(self):
+        """Values for the filter modal inputs: colors joined, sizes as a list."""
+        values = self.values
+        return {
+            'color': ', '.join(values.get('color', [])),
+            'size': values.get('size', []),
+            'min_price': values.get('min_price', ''),
+            'max_price': values.get('max_price', ''),
+        }
+
+
+    def urlencode(self):
+        """The valid filters as a query string, for links that keep them."""
+        params = QueryDict(mutable=True)
+        for name, value in self.values.items():
+            params.setlist(name, value if isinstance(value, list) else [value])
+        return params.urlencode()
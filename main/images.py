@@ -0,0 +1,101 @@
+"""Resized WebP copies of product photos for ``srcset``.
+
+Derivatives live next to the original, ``products/main/shirt.jpg`` gets
+``products/main/shirt.w320.webp`` and so on, so a URL can be built from
+the original name without touching storage. Which widths exist is kept
+on the model (``<field>_widths``): photos narrower than a width are not
+upscaled, and templates never stat files to find out.
+"""
+import io
+import logging
+import os
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+IMAGE_DERIVATIVE_WIDTHS = tuple(getattr(settings, 'IMAGE_DERIVATIVE_WIDTHS', (320, 640, 1024)))
+IMAGE_DERIVATIVE_QUALITY = getattr(settings, 'IMAGE_DERIVATIVE_QUALITY', 80)
+
+
+def derivative_name(name, width):
+    root, _ = os.path.splitext(name)
+    return f'{root}.w{width}.webp'
+
+
+def widths_field(field_file):
+    return f'{field_file.field.name}_widths'
+
+
+def generate_derivatives(name, widths=IMAGE_DERIVATIVE_WIDTHS, storage=default_storage):
+    """Write a WebP copy of ``name`` for every width up to its own; returns the widths."""
+    with storage.open(name, 'rb') as f:
+        image = Image.open(f)
+        # Фото с телефона повернуты через EXIF - поворачиваем сами, EXIF не сохраняем
+        image = ImageOps.exif_transpose(image)
+        image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+    done = []
+    for width in sorted(widths):
+        if width > image.width:
+            break
+        height = max(1, round(image.height * width / image.width))
+        buffer = io.BytesIO()
+        image.resize((width, height), Image.LANCZOS).save(
+            buffer, 'WEBP', quality=IMAGE_DERIVATIVE_QUALITY, method=4
+        )
+        target = derivative_name(name, width)
+        # Иначе storage допишет к имени суффикс и URL не совпадет
+        if storage.exists(target):
+            storage.delete(target)
+        storage.save(target, ContentFile(buffer.getvalue()))
+        done.append(width)
+    return done
+
+
+def prepare_derivatives(instance, field_file):
+    """Build derivatives for a fresh upload before the row is written.
+
+    The file is committed to storage here rather than in ``pre_save`` so the
+    widths go out in the same INSERT/UPDATE. A broken image never fails the
+    save, it is just served without ``srcset``.
+    """
+    if not field_file or field_file._committed:
+        return
+    field_file.save(field_file.name, field_file.file, save=False)
+    try:
+        widths = generate_derivatives(field_file.name, storage=field_file.storage)
+    except Exception:
+        logger.exception("Could not build derivatives for %s", field_file.name)
+        widths = []
+    setattr(instance, widths_field(field_file), widths)
+
+
+def srcset(field_file):
+    """``url 320w, url 640w`` for the derivatives of an image field, or ''."""
+    if not field_file:
+        return ''
+    widths = getattr(field_file.instance, widths_field(field_file), None) or []
+    return ', '.join(
+        f'{field_file.storage.url(derivative_name(field_file.name, width))} {width}w'
+        for width in widths
+    )
+
+
+def derivative_url(name, widths, storage=default_storage):
+    """URL of the narrowest derivative of a stored name, the original if there is none."""
+    if not widths:
+        return storage.url(name)
+    return storage.url(derivative_name(name, min(widths)))
+
+
+def smallest_url(field_file):
+    """URL of the narrowest derivative, the original if there is none."""
+    widths = getattr(field_file.instance, widths_field(field_file), None)
+    if not widths:
+        return field_file.url
+    return derivative_url(field_file.name, widths, field_file.storage)
@@ -0,0 +1,92 @@
+import json
+import math
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import (setup_databases, setup_test_environment,
+                               teardown_databases, teardown_test_environment)
+from main.benchmark import (BUDGET_FILE, BenchmarkFixture, check_budget,
+                            endpoints_for, isolated_caches, load_budgets,
+                            measure_connection_reuse, run_endpoint)
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway test database and cache with a realistic catalog, hit every '
+            'endpoint and compare query counts and p50/p95 render times '
+            'with perf_budgets.json')
+
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=2000)
+        parser.add_argument('--sizes', type=int, default=6)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--app', help='Only endpoints of this URL namespace')
+        parser.add_argument('--budgets', default=str(BUDGET_FILE))
+        parser.add_argument('--output', help='Write raw results as JSON lines')
+        parser.add_argument('--write-budgets', action='store_true',
+                            help='Store measured query counts and p95 (x3, at least 50ms) as the new budgets')
+        parser.add_argument('--connections', type=int, default=0, metavar='N',
+                            help='Also time N request cycles with a new vs a persistent DB connection')
+
+
+    def handle(self, *args, **options):
+        with isolated_caches():
+            results = self.measure(options)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                for result in results:
+                    f.write(json.dumps(result) + '\n')
+
+        if options['write_budgets']:
+            self.write_budgets(results, options['budgets'])
+            return
+
+        budgets = load_budgets(options['budgets'])
+        violations = [v for result in results for v in check_budget(result, budgets)]
+        if violations:
+            raise CommandError('Budget exceeded:\n' + '\n'.join(violations))
+        self.stdout.write(self.style.SUCCESS(f'{len(results)} measurements within budget'))
+
+
+    def measure(self, options):
+        setup_test_environment(debug=False)
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            fixture = BenchmarkFixture(products=options['products'],
+                                       sizes_per_product=options['sizes']).seed()
+            results = []
+            for endpoint in endpoints_for(options['app']):
+                for result in run_endpoint(fixture, endpoint, options['repeat']):
+                    results.append(result)
+                    self.stdout.write(
+                        f"{result['endpoint']:<36} {result['variant']:<4} "
+                        f"cart={result['cart_items']:<3} status={result['status']} "
+                        f"queries={result['queries']:<3} p50={result['p50_ms']:>8}ms "
+                        f"p95={result['p95_ms']:>8}ms"
+                    )
+            if options['connections']:
+                for result in measure_connection_reuse(options['connections']):
+                    self.stdout.write(
+                        f"{'db connection ' + result['connections']:<36} "
+                        f"CONN_MAX_AGE={result['conn_max_age']:<4} "
+                        f"p50={result['p50_ms']:>8}ms p95={result['p95_ms']:>8}ms"
+                    )
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+        return results
+
+
+    def write_budgets(self, results, path):
+        budgets = {}
+        for result in results:
+            entry = budgets.setdefault(result['endpoint'], {}).setdefault(
+                result['variant'], {'queries': 0, 'p95_ms': 0}
+            )
+            entry['queries'] = max(entry['queries'], result['queries'])
+            # Запас x3 и минимум 50ms, чтобы шум машины не валил прогон
+            entry['p95_ms'] = max(entry['p95_ms'], 50,
+                                  math.ceil(result['p95_ms'] * 3))
+        with open(path, 'w') as f:
+            json.dump(budgets, f, indent=2)
+            f.write('\n')
+        self.stdout.write(self.style.SUCCESS(f'Budgets written to {path}'))
@@ -0,0 +1,90 @@
+import re
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from cart.models import CartItem
+from orders.models import Order
+from payment.models import WebhookEvent
+from payment.webhooks import WEBHOOK_BATCH_SIZE, WEBHOOK_MAX_ATTEMPTS
+from main.forms import CatalogFilterForm
+from main.models import Product
+
+# Запросы горячих путей в том виде, в каком их строят views; значения
+# параметров не важны, план от них почти не зависит
+CATALOG = Product.objects.order_by('-created_at', '-id')
+
+
+def catalog_filtered(**params):
+    return CatalogFilterForm(params).filter(CATALOG)[:25]
+
+
+HOT_QUERIES = [
+    ('catalog', lambda: CATALOG[:25]),
+    ('catalog next page', lambda: CATALOG.filter(
+        Q(created_at__lt=timezone.now()) | Q(created_at=timezone.now(), id__lt=1000))[:25]),
+    ('catalog category', lambda: CATALOG.filter(category_id=1)[:25]),
+    ('catalog color', lambda: catalog_filtered(color='black,white')),
+    ('catalog size in stock', lambda: catalog_filtered(size='M,L')),
+    ('catalog price range', lambda: catalog_filtered(min_price='10', max_price='100')),
+    ('order history', lambda: Order.objects.filter(user_id=1).with_summary()
+        .order_by('-created_at', '-id')[:11]),
+    ('order by stripe payment intent', lambda: Order.objects.filter(
+        stripe_payment_intent_id='pi_1')),
+    ('order by heleket payment', lambda: Order.objects.filter(heleket_payment_id='uuid')),
+    ('pending webhooks', lambda: WebhookEvent.objects.filter(
+        processed_at__isnull=True, attempts__lt=WEBHOOK_MAX_ATTEMPTS
+    ).order_by('id')[:WEBHOOK_BATCH_SIZE]),
+    ('cart modal', lambda: CartItem.objects.filter(cart_id=1).select_related(
+        'product', 'product_size__size').order_by('-added_at')),
+]
+
+# Postgres: "Seq Scan on main_product"; SQLite: "SCAN main_product" без USING INDEX
+SEQ_SCAN = {
+    'postgresql': re.compile(r'Seq Scan on (\w+)'),
+    'sqlite': re.compile(r'\bSCAN (\w+)\b(?! USING)'),
+}
+
+
+class Command(BaseCommand):
+    help = ('EXPLAIN the hot catalog, order history, webhook and cart queries '
+            'and flag the ones that scan a whole table')
+
+
+    def add_arguments(self, parser):
+        parser.add_argument('--natural', action='store_true',
+                            help="Postgres: keep seq scans enabled. By default they are "
+                                 "disabled, so a remaining Seq Scan means no index fits "
+                                 "even on a small development database")
+        parser.add_argument('--fail', action='store_true',
+                            help='Exit with an error if any query scans a table')
+
+
+    def handle(self, *args, **options):
+        pattern = SEQ_SCAN.get(connection.vendor)
+        if pattern is None:
+            raise CommandError(f'No plan parser for {connection.vendor}')
+
+        flagged = []
+        for name, build in HOT_QUERIES:
+            with transaction.atomic():
+                if connection.vendor == 'postgresql' and not options['natural']:
+                    with connection.cursor() as cursor:
+                        cursor.execute('SET LOCAL enable_seqscan = off')
+                plan = build().explain()
+            tables = sorted(set(pattern.findall(plan)))
+            if tables:
+                flagged.append(name)
+                self.stdout.write(self.style.WARNING(
+                    f"{name:<32} SEQ SCAN on {', '.join(tables)}"
+                ))
+            else:
+                self.stdout.write(f'{name:<32} ok')
+            if options['verbosity'] > 1 or tables:
+                self.stdout.write('    ' + plan.replace('\n', '\n    '))
+
+        if flagged and options['fail']:
+            raise CommandError(f"Sequential scans in: {', '.join(flagged)}")
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(HOT_QUERIES) - len(flagged)} of {len(HOT_QUERIES)} queries use indexes'
+        ))
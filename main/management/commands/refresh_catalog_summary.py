@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from main.models import Category
+from main.summary import refresh_category_summary
+
+
+class Command(BaseCommand):
+    help = ('Recompute every category summary. Signals keep them current; this '
+            'fixes drift from bulk imports and stock moved by reservations')
+
+
+    def handle(self, *args, **options):
+        category_ids = list(Category.objects.values_list('id', flat=True))
+        for category_id in category_ids:
+            refresh_category_summary(category_id)
+        self.stdout.write(self.style.SUCCESS(f'Refreshed {len(category_ids)} category summaries'))
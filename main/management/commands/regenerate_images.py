@@ -0,0 +1,60 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+from django.core.management.base import BaseCommand
+from main.cache import bump_catalog_version
+from main.images import IMAGE_DERIVATIVE_WIDTHS, generate_derivatives
+from main.models import Product, ProductImage
+
+# (модель, поле с картинкой, поле с ширинами)
+IMAGE_FIELDS = [
+    (Product, 'main_image', 'main_image_widths'),
+    (ProductImage, 'image', 'image_widths'),
+]
+
+
+def _generate(row, widths):
+    # Процессы пула работают только с файлами, в БД пишет родитель:
+    # унаследованное при fork соединение они не трогают
+    pk, name = row
+    try:
+        return pk, name, generate_derivatives(name, widths), None
+    except Exception as e:
+        return pk, name, [], str(e)
+
+
+class Command(BaseCommand):
+    help = ('Rebuild WebP derivatives of product images in a process pool '
+            'and store the available widths')
+
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--widths', type=int, nargs='+', default=list(IMAGE_DERIVATIVE_WIDTHS))
+        parser.add_argument('--missing', action='store_true',
+                            help='Only images that have no derivatives yet')
+        parser.add_argument('--batch', type=int, default=500)
+
+
+    def handle(self, *args, **options):
+        widths = sorted(options['widths'])
+        with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+            for model, image_field, widths_field in IMAGE_FIELDS:
+                queryset = model.objects.exclude(**{image_field: ''})
+                if options['missing']:
+                    queryset = queryset.filter(**{widths_field: []})
+                rows = list(queryset.values_list('id', image_field))
+                done = failed = 0
+                for start in range(0, len(rows), options['batch']):
+                    batch = rows[start:start + options['batch']]
+                    results = pool.map(_generate, batch, [widths] * len(batch))
+                    updates = []
+                    for pk, name, built, error in results:
+                        if error:
+                            failed += 1
+                            self.stderr.write(f'{name}: {error}')
+                        updates.append(model(id=pk, **{widths_field: built}))
+                    model.objects.bulk_update(updates, [widths_field])
+                    done += len(updates)
+                self.stdout.write(f'{model.__name__}.{image_field}: {done} images, {failed} failed')
+        # bulk_update не шлет сигналы, кэш каталога сбрасываем сами
+        bump_catalog_version()
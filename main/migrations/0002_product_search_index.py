@@ -0,0 +1,59 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.operations import TrigramExtension
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+
+
+FTS_TABLE = 'main_product_fts'
+
+
+def search_indexes():
+    return [
+        GinIndex(
+            SearchVector('name', 'color', 'description', config='simple'),
+            name='product_search_gin',
+        ),
+        GinIndex(fields=['name'], opclasses=['gin_trgm_ops'],
+                 name='product_name_trgm'),
+    ]
+
+
+def create_search_index(apps, schema_editor):
+    Product = apps.get_model('main', 'Product')
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        for index in search_indexes():
+            schema_editor.add_index(Product, index)
+    elif vendor == 'sqlite':
+        # Локальная замена для тестов: FTS5 таблица, синхронизируется
+        # сигналами из main.signals
+        schema_editor.execute(
+            f'CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5('
+            'name, color, description, tokenize="unicode61")'
+        )
+        schema_editor.execute(
+            f'INSERT INTO {FTS_TABLE}(rowid, name, color, description) '
+            'SELECT id, name, color, description FROM main_product'
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    Product = apps.get_model('main', 'Product')
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        for index in search_indexes():
+            schema_editor.remove_index(Product, index)
+    elif vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0001_initial'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 18:01
+
+from django.db import migrations, models
+
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_product_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['-created_at', '-id'], name='product_created_id_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-18 18:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_product_created_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='main_image_widths',
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+        migrations.AddField(
+            model_name='productimage',
+            name='image_widths',
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.8 on 2026-10-18 18:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_image_derivative_widths'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategorySummary',
+            fields=[
+                ('category', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='main.category')),
+                ('product_count', models.PositiveIntegerField(default=0)),
+                ('min_price', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('max_price', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('colors', models.JSONField(blank=True, default=list)),
+                ('sizes', models.JSONField(blank=True, default=list)),
+                ('price_buckets', models.JSONField(blank=True, default=list)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
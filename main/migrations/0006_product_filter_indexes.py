@@ -0,0 +1,26 @@
+# Generated by Django 5.2.8 on 2026-10-18 18:47
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_categorysummary'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', '-created_at', '-id'], name='product_category_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(django.db.models.functions.text.Upper('color'), name='product_color_upper_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['price'], name='product_price_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.8 on 2026-10-18 19:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_product_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productimage',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='productsize',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -1,5 +1,7 @@
 from django.db import models
+from django.db.models.functions import Upper
 from django.utils.text import slugify
+from .images import prepare_derivatives
 
 
 class Category(models.Model):
@@ -30,6 +32,8 @@ class ProductSize(models.Model):
                                 related_name='product_sizes')
     size = models.ForeignKey(Size, on_delete=models.CASCADE)
     stock = models.PositiveIntegerField(default=0)
+    # Резервы меняют stock через UPDATE и выставляют updated_at сами
+    updated_at = models.DateTimeField(auto_now=True)
 
 
     def __str__(self):
@@ -45,13 +49,31 @@ class Product(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2)
     description = models.TextField(blank=True)
     main_image = models.ImageField(upload_to='products/main/')
+    # Ширины готовых WebP копий main_image, см. main/images.py
+    main_image_widths = models.JSONField(default=list, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
 
+    class Meta:
+        indexes = [
+            # Порядок каталога и keyset пагинация по (created_at, id)
+            models.Index(fields=['-created_at', '-id'],
+                         name='product_created_id_idx'),
+            # Страница категории: тот же порядок внутри category_id
+            models.Index(fields=['category', '-created_at', '-id'],
+                         name='product_category_created_idx'),
+            # color__iexact в Postgres - UPPER("color") = UPPER(%s)
+            models.Index(Upper('color'), name='product_color_upper_idx'),
+            # Фильтры min_price/max_price
+            models.Index(fields=['price'], name='product_price_idx'),
+        ]
+
+
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.name)
+        prepare_derivatives(self, self.main_image)
         super().save(*args, **kwargs)
 
     
@@ -62,4 +84,32 @@ class Product(models.Model):
 class ProductImage(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, 
                                 related_name='images')
-    image = models.ImageField(upload_to='products/extra/')
\ No newline at end of file
+    image = models.ImageField(upload_to='products/extra/')
+    image_widths = models.JSONField(default=list, blank=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+    def save(self, *args, **kwargs):
+        prepare_derivatives(self, self.image)
+        super().save(*args, **kwargs)
+
+
+class CategorySummary(models.Model):
+    """Precomputed numbers of a category for navigation and the filter modal.
+
+    Kept up to date by signals (main/signals.py), see main/summary.py.
+    """
+    category = models.OneToOneField(Category, on_delete=models.CASCADE,
+                                    primary_key=True, related_name='summary')
+    product_count = models.PositiveIntegerField(default=0)
+    min_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    max_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    # [[значение, число товаров], ...] - как facet_counts
+    colors = models.JSONField(default=list, blank=True)
+    sizes = models.JSONField(default=list, blank=True)
+    price_buckets = models.JSONField(default=list, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+    def __str__(self):
+        return f"Summary of {self.category_id}"
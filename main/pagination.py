@@ -0,0 +1,48 @@
+import base64
+from datetime import datetime
+from django.core.exceptions import BadRequest
+from django.db.models import Q
+
+
+def encode_cursor(product):
+    raw = f"{product.created_at.isoformat()}|{product.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, pk = base64.urlsafe_b64decode(padded).decode().split('|')
+        return datetime.fromisoformat(created_at), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        raise BadRequest('Invalid cursor')
+
+
+def keyset_window(queryset, cursor=None, page_size=24):
+    """The unevaluated ``page_size + 1`` rows after ``cursor``, newest first.
+
+    Pages seek on ``(created_at, id)`` so every page costs one index range
+    scan no matter how deep the visitor has scrolled. The extra row tells
+    ``split_page`` whether there is a next page.
+    """
+    queryset = queryset.order_by('-created_at', '-id')
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+        )
+    return queryset[:page_size + 1]
+
+
+def split_page(items, page_size=24):
+    """Return ``(items, next_cursor)`` for the fetched rows of ``keyset_window``."""
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_cursor = encode_cursor(items[-1])
+    return items, next_cursor
+
+
+def paginate_keyset(queryset, cursor=None, page_size=24):
+    """Return ``(items, next_cursor)`` for newest-first keyset pagination."""
+    return split_page(list(keyset_window(queryset, cursor, page_size)), page_size)
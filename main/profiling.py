@@ -0,0 +1,287 @@
+"""Sampling request profiler.
+
+``ProfilingMiddleware`` profiles a ``PROFILING_SAMPLE_RATE`` fraction of
+requests: wall time, SQL query count and time (every connection), template
+render time and cache hits/misses, keyed by the resolved view name. Samples
+go to a bounded ring buffer (served as JSON lines, optionally appended to
+``PROFILING_JSONL_PATH``) and into per-view aggregates served in the
+Prometheus text format. Memory stays bounded: the number of views is fixed by
+the URLconf and each keeps only its last ``PROFILING_VIEW_WINDOW`` durations
+for quantiles.
+
+Numbers are per process; with several gunicorn workers scrape each one or
+collect the JSONL file.
+
+The endpoints are open to staff sessions and to scrapers that send
+``Authorization: Bearer <PROFILING_TOKEN>``. ``PROFILING_ALLOWED_IPS`` only
+helps when Django is reached directly: behind the nginx proxy
+``REMOTE_ADDR`` is always the proxy's address.
+"""
+import hmac
+import json
+import random
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+from django.template.backends.django import Template as DjangoTemplate
+
+PROFILING_SAMPLE_RATE = getattr(settings, 'PROFILING_SAMPLE_RATE', 0)
+PROFILING_BUFFER_SIZE = getattr(settings, 'PROFILING_BUFFER_SIZE', 1000)
+PROFILING_VIEW_WINDOW = getattr(settings, 'PROFILING_VIEW_WINDOW', 200)
+PROFILING_JSONL_PATH = getattr(settings, 'PROFILING_JSONL_PATH', None)
+PROFILING_ALLOWED_IPS = getattr(settings, 'PROFILING_ALLOWED_IPS', ('127.0.0.1',))
+PROFILING_TOKEN = getattr(settings, 'PROFILING_TOKEN', None)
+
+QUANTILES = (0.5, 0.95, 0.99)
+# Сами эндпоинты метрик не профилируются
+METRICS_PATH_PREFIX = '/metrics/'
+
+# Профиль текущего запроса; None - запрос не в выборке
+_current = ContextVar('profile', default=None)
+
+
+class Profile:
+    __slots__ = ('queries', 'db_time', 'template_time', 'cache_hits', 'cache_misses')
+
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+
+    def __call__(self, execute, sql, params, many, context):
+        """``connection.execute_wrapper`` hook."""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - started
+
+
+class Recorder:
+    """Ring buffer of recent samples plus per-view aggregates."""
+
+    def __init__(self, buffer_size=PROFILING_BUFFER_SIZE, window=PROFILING_VIEW_WINDOW):
+        self.lock = threading.Lock()
+        self.window = window
+        self.samples = deque(maxlen=buffer_size)
+        self.views = {}
+
+
+    def record(self, sample):
+        with self.lock:
+            self.samples.append(sample)
+            stats = self.views.get(sample['view'])
+            if stats is None:
+                stats = self.views[sample['view']] = {
+                    'count': 0, 'duration': 0.0, 'queries': 0, 'db_time': 0.0,
+                    'template_time': 0.0, 'cache_hits': 0, 'cache_misses': 0,
+                    'recent': deque(maxlen=self.window),
+                }
+            stats['count'] += 1
+            for key in ('duration', 'queries', 'db_time', 'template_time',
+                        'cache_hits', 'cache_misses'):
+                stats[key] += sample[key]
+            stats['recent'].append(sample['duration'])
+
+
+    def jsonl(self):
+        with self.lock:
+            samples = list(self.samples)
+        return ''.join(json.dumps(sample) + '\n' for sample in samples)
+
+
+    def prometheus(self):
+        with self.lock:
+            views = {view: {**stats, 'recent': sorted(stats['recent'])}
+                     for view, stats in self.views.items()}
+        lines = [
+            '# HELP enf_request_duration_seconds Duration of sampled requests.',
+            '# TYPE enf_request_duration_seconds summary',
+        ]
+        for view, stats in sorted(views.items()):
+            recent = stats['recent']
+            for q in QUANTILES:
+                value = recent[min(len(recent) - 1, int(q * len(recent)))]
+                lines.append(f'enf_request_duration_seconds{{view="{view}",quantile="{q}"}} {value:.6f}')
+            lines.append(f'enf_request_duration_seconds_sum{{view="{view}"}} {stats["duration"]:.6f}')
+            lines.append(f'enf_request_duration_seconds_count{{view="{view}"}} {stats["count"]}')
+        counters = (
+            ('enf_db_queries_total', 'SQL queries of sampled requests.', 'queries', '{}'),
+            ('enf_db_seconds_total', 'SQL time of sampled requests.', 'db_time', '{:.6f}'),
+            ('enf_template_seconds_total', 'Template render time of sampled requests.',
+             'template_time', '{:.6f}'),
+            ('enf_cache_hits_total', 'Cache hits of sampled requests.', 'cache_hits', '{}'),
+            ('enf_cache_misses_total', 'Cache misses of sampled requests.', 'cache_misses', '{}'),
+        )
+        for name, help_text, key, fmt in counters:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for view, stats in sorted(views.items()):
+                lines.append(f'{name}{{view="{view}"}} {fmt.format(stats[key])}')
+        return '\n'.join(lines) + '\n'
+
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+            self.views.clear()
+
+
+recorder = Recorder()
+
+
+# Уже пропатченные классы: бэкенды кэша могут смениться (override_settings)
+_instrumented = set()
+_instrument_lock = threading.Lock()
+
+
+def _instrument():
+    """Patch template and cache classes once each; they cost one ContextVar read when idle."""
+    backends = {type(caches[alias]) for alias in settings.CACHES}
+    if DjangoTemplate in _instrumented and backends <= _instrumented:
+        return
+    with _instrument_lock:
+        if DjangoTemplate not in _instrumented:
+            _instrument_templates()
+            _instrumented.add(DjangoTemplate)
+        for backend in backends - _instrumented:
+            _instrument_cache(backend)
+            _instrumented.add(backend)
+
+
+def _instrument_templates():
+    render = DjangoTemplate.render
+
+    def timed_render(self, *args, **kwargs):
+        profile = _current.get()
+        if profile is None:
+            return render(self, *args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return render(self, *args, **kwargs)
+        finally:
+            profile.template_time += time.perf_counter() - started
+
+    DjangoTemplate.render = timed_render
+
+
+_missing = object()
+
+
+def _instrument_cache(backend):
+    get, get_many = backend.get, backend.get_many
+
+    def timed_get(self, key, default=None, version=None, _get=get):
+        profile = _current.get()
+        if profile is None:
+            return _get(self, key, default, version)
+        value = _get(self, key, _missing, version)
+        if value is _missing:
+            profile.cache_misses += 1
+            return default
+        profile.cache_hits += 1
+        return value
+
+    def timed_get_many(self, keys, version=None, _get_many=get_many):
+        profile = _current.get()
+        if profile is None:
+            return _get_many(self, keys, version)
+        keys = list(keys)
+        # BaseCache.get_many вызывает get - не считаем ключи дважды
+        token = _current.set(None)
+        try:
+            values = _get_many(self, keys, version)
+        finally:
+            _current.reset(token)
+        profile.cache_hits += len(values)
+        profile.cache_misses += len(keys) - len(values)
+        return values
+
+    backend.get, backend.get_many = timed_get, timed_get_many
+
+
+class ProfilingMiddleware:
+    """Profile a random fraction of requests, see the module docstring."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', PROFILING_SAMPLE_RATE)
+        self.jsonl_path = getattr(settings, 'PROFILING_JSONL_PATH', PROFILING_JSONL_PATH)
+        if self.sample_rate:
+            _instrument()
+
+
+    def __call__(self, request):
+        if not self.sample_rate or random.random() >= self.sample_rate \
+                or request.path.startswith(METRICS_PATH_PREFIX):
+            return self.get_response(request)
+
+        profile = Profile()
+        token = _current.set(profile)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(profile))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        duration = time.perf_counter() - started
+
+        match = request.resolver_match
+        sample = {
+            'ts': time.time(),
+            'view': (match.view_name if match else None) or 'unresolved',
+            'method': request.method,
+            'status': response.status_code,
+            'duration': round(duration, 6),
+            'queries': profile.queries,
+            'db_time': round(profile.db_time, 6),
+            'template_time': round(profile.template_time, 6),
+            'cache_hits': profile.cache_hits,
+            'cache_misses': profile.cache_misses,
+        }
+        recorder.record(sample)
+        if self.jsonl_path:
+            with open(self.jsonl_path, 'a') as f:
+                f.write(json.dumps(sample) + '\n')
+        return response
+
+
+def _allowed(request):
+    if request.user.is_active and request.user.is_staff:
+        return True
+    token = getattr(settings, 'PROFILING_TOKEN', PROFILING_TOKEN)
+    if token:
+        scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() == 'bearer' and hmac.compare_digest(credentials.encode(),
+                                                               token.encode()):
+            return True
+    return request.META.get('REMOTE_ADDR') in getattr(settings, 'PROFILING_ALLOWED_IPS',
+                                                      PROFILING_ALLOWED_IPS)
+
+
+def metrics(request):
+    """Per-view aggregates in the Prometheus text format."""
+    if not _allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(recorder.prometheus(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def samples(request):
+    """The most recent samples, one JSON object per line."""
+    if not _allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(recorder.jsonl(), content_type='application/x-ndjson')
@@ -0,0 +1,139 @@
+import re
+from django.db import connection
+from django.db.models import Case, Count, F, Q, Value, When, CharField
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Lower
+from .models import Category
+
+
+# Границы ценовых диапазонов фильтра (₼)
+PRICE_BUCKETS = (
+    (None, 50),
+    (50, 100),
+    (100, 200),
+    (200, None),
+)
+
+SQLITE_FTS_TABLE = 'main_product_fts'
+
+
+def price_bucket_label(low, high):
+    if low is None:
+        return f'0-{high}'
+    if high is None:
+        return f'{low}+'
+    return f'{low}-{high}'
+
+
+def _terms(query):
+    return re.findall(r'\w+', query.lower())
+
+
+def search_vector():
+    # Выражение должно совпадать с GIN индексом из миграции 0002
+    from django.contrib.postgres.search import SearchVector
+    return SearchVector('name', 'color', 'description', config='simple')
+
+
+def _postgres_filter(terms):
+    from django.contrib.postgres.search import SearchQuery
+    tsquery = ' & '.join(f"{term}:*" for term in terms)
+    return (
+        Q(search_document=SearchQuery(tsquery, config='simple', search_type='raw'))
+        | Q(name__trigram_word_similar=' '.join(terms))
+    )
+
+
+def _sqlite_filter(terms):
+    match = ' '.join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+    return Q(id__in=RawSQL(
+        f'SELECT rowid FROM {SQLITE_FTS_TABLE} WHERE {SQLITE_FTS_TABLE} MATCH %s',
+        [match],
+    ))
+
+
+def search_products(queryset, query):
+    """Narrow a Product queryset with the index-backed full-text search.
+
+    Name, color and description go through the full-text index, category
+    names are matched against the (small) category table.
+    """
+    terms = _terms(query)
+    if not terms:
+        return queryset
+
+    vendor = connection.vendor
+    if vendor == 'postgresql':
+        queryset = queryset.annotate(search_document=search_vector())
+        condition = _postgres_filter(terms)
+    elif vendor == 'sqlite':
+        condition = _sqlite_filter(terms)
+    else:
+        condition = Q()
+        for term in terms:
+            condition &= (Q(name__icontains=term) | Q(color__icontains=term)
+                          | Q(description__icontains=term))
+
+    # Категорий мало: id подставляются литералами, чтобы планировщик мог
+    # объединить индексы (BitmapOr) вместо подзапроса на каждую строку
+    category_ids = list(Category.objects.filter(
+        name__icontains=query.strip()
+    ).values_list('id', flat=True))
+    if category_ids:
+        condition |= Q(category_id__in=category_ids)
+    return queryset.filter(condition)
+
+
+def facet_counts(queryset):
+    """Color, in-stock size and price bucket counts in one UNION query.
+
+    Returns ``{'color': [(value, count), ...], 'size': [...], 'price': [...]}``.
+    """
+    base = queryset.order_by().values('id')
+    base = queryset.model.objects.filter(id__in=base)
+    text = CharField()
+
+    colors = base.annotate(
+        facet=Value('color', output_field=text),
+        value=Lower('color'),
+    ).values('facet', 'value').annotate(count=Count('id', distinct=True))
+
+    sizes = base.filter(product_sizes__stock__gt=0).annotate(
+        facet=Value('size', output_field=text),
+        value=F('product_sizes__size__name'),
+    ).values('facet', 'value').annotate(count=Count('id', distinct=True))
+
+    buckets = []
+    for low, high in PRICE_BUCKETS:
+        condition = Q()
+        if low is not None:
+            condition &= Q(price__gte=low)
+        if high is not None:
+            condition &= Q(price__lt=high)
+        buckets.append(When(condition, then=Value(price_bucket_label(low, high))))
+    prices = base.annotate(
+        facet=Value('price', output_field=text),
+        value=Case(*buckets, output_field=text),
+    ).values('facet', 'value').annotate(count=Count('id', distinct=True))
+
+    facets = {'color': [], 'size': [], 'price': []}
+    for row in colors.union(sizes, prices, all=True):
+        facets[row['facet']].append((row['value'], row['count']))
+
+    order = [price_bucket_label(low, high) for low, high in PRICE_BUCKETS]
+    facets['color'].sort()
+    facets['size'].sort()
+    facets['price'].sort(key=lambda item: order.index(item[0]))
+    return facets
+
+
+def rebuild_search_index():
+    """Resync the SQLite FTS stand-in after bulk writes that skip signals."""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SQLITE_FTS_TABLE}')
+        cursor.execute(
+            f'INSERT INTO {SQLITE_FTS_TABLE}(rowid, name, color, description) '
+            'SELECT id, name, color, description FROM main_product'
+        )
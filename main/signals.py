@@ -0,0 +1,90 @@
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from .cache import bump_catalog_version
+from .models import Category, Product, ProductImage, ProductSize, Size
+from .search import SQLITE_FTS_TABLE
+from .summary import invalidate_summary, refresh_category_summary
+
+
+# Сводки пересчитываются до сброса версии каталога, чтобы новые
+# фрагменты строились уже по ним
+@receiver(pre_save, sender=Product)
+def remember_category(sender, instance, raw=False, **kwargs):
+    if instance.pk and not raw:
+        instance._previous_category_id = Product.objects.filter(
+            pk=instance.pk
+        ).values_list('category_id', flat=True).first()
+
+
+def _deleted_with(origin, *models):
+    """Whether a cascade started by ``origin`` (instance or queryset) from one of ``models``."""
+    return isinstance(origin, models) or getattr(origin, 'model', None) in models
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def refresh_product_summary(sender, instance, raw=False, origin=None, **kwargs):
+    # Сводка удаляемой категории уходит вместе с ней
+    if raw or _deleted_with(origin, Category):
+        return
+    category_ids = {instance.category_id, getattr(instance, '_previous_category_id', None)}
+    for category_id in category_ids - {None}:
+        refresh_category_summary(category_id)
+
+
+@receiver(post_save, sender=ProductSize)
+@receiver(post_delete, sender=ProductSize)
+def refresh_size_summary(sender, instance, raw=False, origin=None, **kwargs):
+    # Размеры удаляемого товара пересчитает сигнал самого товара
+    if raw or _deleted_with(origin, Category, Product):
+        return
+    category_id = Product.objects.filter(pk=instance.product_id).values_list(
+        'category_id', flat=True
+    ).first()
+    if category_id:
+        refresh_category_summary(category_id)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_summary(sender, **kwargs):
+    invalidate_summary()
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Size)
+@receiver(post_delete, sender=Size)
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=ProductSize)
+@receiver(post_delete, sender=ProductSize)
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def invalidate_catalog_cache(sender, **kwargs):
+    # После коммита: иначе параллельный запрос закэширует под новой версией
+    # ещё старые строки, и их уже ничто не вытеснит
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    # На Postgres индекс строится по выражению и обновляется сам
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SQLITE_FTS_TABLE} WHERE rowid = %s', [instance.id])
+        cursor.execute(
+            f'INSERT INTO {SQLITE_FTS_TABLE}(rowid, name, color, description) '
+            'VALUES (%s, %s, %s, %s)',
+            [instance.id, instance.name, instance.color, instance.description],
+        )
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SQLITE_FTS_TABLE} WHERE rowid = %s', [instance.id])
@@ -0,0 +1,87 @@
+"""Per-category catalog summary: product count, price range, colors, sizes.
+
+``CategorySummary`` rows are recomputed one category at a time when its
+products or sizes change, and the whole set (every category with its
+summary) is read from one cache entry. Navigation and the filter modal of
+an unfiltered category render from it instead of aggregating products.
+"""
+from collections import Counter
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Max, Min
+from django.utils import timezone
+from .models import Category, CategorySummary, Product
+from .search import PRICE_BUCKETS, facet_counts, price_bucket_label
+from enf.routers import use_replicas
+
+CATALOG_SUMMARY_KEY = 'catalog:summary'
+
+
+def invalidate_summary():
+    # После коммита, иначе параллельный запрос закэширует старые строки
+    transaction.on_commit(lambda: cache.delete(CATALOG_SUMMARY_KEY))
+
+
+def refresh_category_summary(category_id):
+    products = Product.objects.filter(category_id=category_id)
+    stats = products.aggregate(product_count=Count('id'), min_price=Min('price'),
+                               max_price=Max('price'))
+    facets = facet_counts(products)
+    values = {
+        **stats,
+        'colors': facets['color'],
+        'sizes': facets['size'],
+        'price_buckets': facets['price'],
+        'updated_at': timezone.now(),
+    }
+    # Категория может удаляться каскадом вместе с товарами
+    if not CategorySummary.objects.filter(category_id=category_id).update(**values) \
+            and Category.objects.filter(pk=category_id).exists():
+        CategorySummary.objects.create(category_id=category_id, **values)
+    invalidate_summary()
+
+
+def get_catalog_summary():
+    """Every category with ``.summary`` loaded, from the cache."""
+    categories = cache.get(CATALOG_SUMMARY_KEY)
+    if categories is None:
+        # Кэшируется без срока: с отстающей реплики попала бы старая сводка
+        with use_replicas(False):
+            categories = _load_summary()
+        cache.set(CATALOG_SUMMARY_KEY, categories, None)
+    return categories
+
+
+def _load_summary():
+    categories = list(Category.objects.select_related('summary').order_by('id'))
+    missing = [category for category in categories if not hasattr(category, 'summary')]
+    if missing:
+        # Категории, созданные до таблицы сводок или без товаров
+        for category in missing:
+            refresh_category_summary(category.id)
+        categories = list(Category.objects.select_related('summary').order_by('id'))
+    return categories
+
+
+def summary_facets(categories):
+    """Facets and price range of the given categories, merged.
+
+    Same shape as ``facet_counts`` plus ``price_range`` as (min, max).
+    """
+    counters = {'color': Counter(), 'size': Counter(), 'price': Counter()}
+    prices = []
+    for category in categories:
+        summary = category.summary
+        counters['color'].update(dict(summary.colors))
+        counters['size'].update(dict(summary.sizes))
+        counters['price'].update(dict(summary.price_buckets))
+        prices.extend(price for price in (summary.min_price, summary.max_price)
+                      if price is not None)
+
+    order = [price_bucket_label(low, high) for low, high in PRICE_BUCKETS]
+    return {
+        'color': sorted(counters['color'].items()),
+        'size': sorted(counters['size'].items()),
+        'price': sorted(counters['price'].items(), key=lambda item: order.index(item[0])),
+        'price_range': (min(prices), max(prices)) if prices else None,
+    }
@@ -0,0 +1,23 @@
+from django import template
+from django.utils.html import format_html
+from .. import images
+
+register = template.Library()
+
+
+@register.simple_tag
+def srcset(field_file, sizes='100vw'):
+    """``srcset``/``sizes`` attributes for an ``<img>``, nothing without derivatives.
+
+    Usage: ``<img src="{{ product.main_image.url }}" {% srcset product.main_image "25vw" %}>``
+    """
+    value = images.srcset(field_file)
+    if not value:
+        return ''
+    return format_html('srcset="{}" sizes="{}"', value, sizes)
+
+
+@register.filter
+def thumbnail_url(field_file):
+    """URL of the smallest derivative, for icons and previews."""
+    return images.smallest_url(field_file)
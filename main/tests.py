@@ -1,3 +1,754 @@
-from django.test import TestCase
+import io
+import json
+import os
+import tempfile
+from decimal import Decimal
+from PIL import Image
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.template import Context, Template
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils import timezone
+from cart.models import Cart, StockReservation
+from enf.routers import (REPLICA_PIN_COOKIE, REPLICA_PIN_SECONDS, ReplicaMiddleware,
+                         use_replicas)
+from .benchmark import (BenchmarkFixture, QueryBudgetMixin, endpoints_for, isolated_caches,
+                        run_endpoint)
+from .cache import CATALOG_VERSION_KEY, bump_catalog_version, get_catalog_version
+from .images import derivative_name
+from .management.commands.explain_queries import HOT_QUERIES, SEQ_SCAN
+from .profiling import Recorder, recorder
+from .models import Category, CategorySummary, Product, ProductImage, ProductSize, Size
+from .search import search_products, facet_counts
+from .summary import CATALOG_SUMMARY_KEY, get_catalog_summary
 
-# Create your tests here.
+
+def make_product(category, name, color='black', price='10.00', **kwargs):
+    return Product.objects.create(
+        name=name, slug=kwargs.pop('slug', name.lower().replace(' ', '-')),
+        category=category, color=color, price=Decimal(price),
+        main_image='products/main/test.jpg', **kwargs
+    )
+
+
+def selects(ctx):
+    return [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('SELECT')]
+
+
+class CatalogSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.shirts = Category.objects.create(name='Shirts', slug='shirts')
+        cls.hats = Category.objects.create(name='Hats', slug='hats')
+        cls.small = Size.objects.create(name='S')
+        cls.large = Size.objects.create(name='L')
+        cls.linen = make_product(cls.shirts, 'Linen shirt', color='white',
+                                 price='40.00', description='Light summer fabric')
+        cls.oxford = make_product(cls.shirts, 'Oxford shirt', color='Blue',
+                                  price='120.00')
+        cls.cap = make_product(cls.hats, 'Cap', color='blue', price='15.00')
+        ProductSize.objects.create(product=cls.linen, size=cls.small, stock=3)
+        ProductSize.objects.create(product=cls.linen, size=cls.large, stock=0)
+        ProductSize.objects.create(product=cls.oxford, size=cls.large, stock=2)
+
+
+    def setUp(self):
+        cache.clear()
+
+
+    def search(self, query):
+        return set(search_products(Product.objects.all(), query))
+
+
+    def test_search_matches_prefixes_across_fields(self):
+        self.assertEqual(self.search('lin'), {self.linen})
+        self.assertEqual(self.search('summer'), {self.linen})
+        self.assertEqual(self.search('blue'), {self.oxford, self.cap})
+        self.assertEqual(self.search('shirt blue'), {self.oxford})
+
+
+    def test_search_matches_category_name(self):
+        self.assertEqual(self.search('hats'), {self.cap})
+
+
+    def test_index_follows_product_changes(self):
+        self.cap.name = 'Beanie'
+        self.cap.save()
+        self.assertEqual(self.search('beanie'), {self.cap})
+        self.assertEqual(self.search('cap'), set())
+        self.cap.delete()
+        self.assertEqual(self.search('beanie'), set())
+
+
+    def test_facet_counts_in_one_query(self):
+        with self.assertNumQueries(1):
+            facets = facet_counts(Product.objects.all())
+        self.assertEqual(facets['color'], [('blue', 2), ('white', 1)])
+        self.assertEqual(facets['size'], [('L', 1), ('S', 1)])
+        self.assertEqual(facets['price'], [('0-50', 2), ('100-200', 1)])
+
+
+    def test_catalog_search_view(self):
+        response = self.client.get(reverse('main:catalog_all'), {'q': 'oxford'},
+                                   HTTP_HX_REQUEST='true')
+        self.assertEqual(list(response.context['products']), [self.oxford])
+
+
+class CatalogPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Shirts', slug='shirts')
+        cls.products = [make_product(category, f'Shirt {i}') for i in range(7)]
+        # Одинаковое время создания проверяет разрешение ничьих по id
+        Product.objects.update(created_at=cls.products[0].created_at)
+
+
+    def setUp(self):
+        cache.clear()
+
+
+    def test_pages_cover_catalog_without_duplicates(self):
+        url = reverse('main:catalog_all') + '?page_size=3'
+        seen = []
+        while url:
+            response = self.client.get(url, HTTP_HX_REQUEST='true')
+            seen.extend(response.context['products'])
+            url = response.context['next_page_url']
+        self.assertEqual(seen, sorted(self.products, key=lambda p: -p.id))
+
+
+    def test_page_size_is_capped(self):
+        response = self.client.get(reverse('main:catalog_all'), {'page_size': 10000})
+        self.assertEqual(response.context['view'].get_page_size(), 96)
+
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(reverse('main:catalog_all'), {'cursor': '!!'},
+                                   HTTP_HX_REQUEST='true')
+        self.assertEqual(response.status_code, 400)
+
+
+class FragmentCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Shirts', slug='shirts')
+        cls.product = make_product(cls.category, 'Linen shirt')
+
+
+    def setUp(self):
+        cache.clear()
+
+
+    def get(self, url, params=None):
+        return self.client.get(url, params, HTTP_HX_REQUEST='true')
+
+
+    def test_htmx_fragment_served_from_cache(self):
+        url = reverse('main:product_detail', args=[self.product.slug])
+        first = self.get(url)
+        with CaptureQueriesContext(connection) as ctx:
+            second = self.get(url)
+        # Ключ фрагмента товара - его отметки времени, одним запросом
+        self.assertEqual(len(selects(ctx)), 1)
+        self.assertEqual(first.content, second.content)
+
+        url = reverse('main:catalog_all')
+        self.get(url)
+        with CaptureQueriesContext(connection) as ctx:
+            self.get(url)
+        self.assertEqual(selects(ctx), [])
+
+
+    def test_catalog_changes_invalidate_fragments(self):
+        url = reverse('main:catalog_all')
+        self.assertNotContains(self.get(url), 'Oxford')
+        with self.captureOnCommitCallbacks(execute=True):
+            make_product(self.category, 'Oxford shirt')
+        self.assertContains(self.get(url), 'Oxford')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.name = 'Tops'
+            self.category.save()
+        self.assertContains(self.get(reverse('main:index')), 'TOPS')
+
+
+    def test_version_is_bumped_after_commit(self):
+        version = get_catalog_version()
+        with self.captureOnCommitCallbacks() as callbacks:
+            make_product(self.category, 'Oxford shirt')
+            # Строки ещё не видны другим запросам - фрагменты старой версии верны
+            self.assertEqual(get_catalog_version(), version)
+        for callback in callbacks:
+            callback()
+        self.assertGreater(get_catalog_version(), version)
+
+
+    def test_lost_version_never_reuses_old_keys(self):
+        version = get_catalog_version()
+        cache.delete(CATALOG_VERSION_KEY)
+        self.assertGreater(get_catalog_version(), version)
+        version = get_catalog_version()
+        cache.delete(CATALOG_VERSION_KEY)
+        self.assertGreater(bump_catalog_version(), version)
+
+
+    def test_filter_params_are_part_of_key(self):
+        url = reverse('main:catalog_all')
+        make_product(self.category, 'Cap', color='red')
+        self.assertContains(self.get(url, {'color': 'red'}), 'Cap')
+        self.assertNotContains(self.get(url, {'color': 'blue'}), 'Cap')
+
+
+    def test_full_pages_are_not_cached(self):
+        url = reverse('main:index')
+        self.client.get(url)
+        # Навигация берётся из кэша сводок; без него страница строится заново
+        cache.delete(CATALOG_SUMMARY_KEY)
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(url)
+        self.assertEqual(len(selects(ctx)), 1)
+
+
+class ProductDetailQueryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Shirts', slug='shirts')
+        cls.product = make_product(category, 'Linen shirt')
+        for name in ('S', 'M', 'L', 'XL'):
+            ProductSize.objects.create(product=cls.product, stock=2,
+                                       size=Size.objects.create(name=name))
+        for i in range(3):
+            cls.product.images.create(image=f'products/extra/{i}.jpg')
+        for i in range(6):
+            make_product(category, f'Related {i}')
+
+
+    def setUp(self):
+        cache.clear()
+
+
+    def assertSelects(self, count, **headers):
+        url = reverse('main:product_detail', args=[self.product.slug])
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, **headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(selects(ctx)), count, '\n'.join(selects(ctx)))
+        return response
+
+
+    def test_htmx_detail_query_count(self):
+        # ключ кэша фрагмента, товар+категория, изображения, размеры+Size,
+        # похожие товары
+        response = self.assertSelects(5, HTTP_HX_REQUEST='true')
+        self.assertEqual(len(response.context['related_products']), 4)
+
+
+    def test_full_page_detail_query_count(self):
+        # base.html не выводит похожие товары, зато строит навигацию
+        self.assertSelects(4)
+
+
+class CategorySummaryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.shirts = Category.objects.create(name='Shirts', slug='shirts')
+        cls.hats = Category.objects.create(name='Hats', slug='hats')
+        cls.sizes = {name: Size.objects.create(name=name) for name in ('S', 'M')}
+
+
+    def setUp(self):
+        cache.clear()
+
+
+    def summary(self, category):
+        return CategorySummary.objects.get(category=category)
+
+
+    def test_summary_follows_products_and_sizes(self):
+        linen = make_product(self.shirts, 'Linen', color='White', price='30.00')
+        make_product(self.shirts, 'Oxford', color='blue', price='120.00')
+        size = ProductSize.objects.create(product=linen, size=self.sizes['M'], stock=3)
+        summary = self.summary(self.shirts)
+        self.assertEqual((summary.product_count, summary.min_price, summary.max_price),
+                         (2, Decimal('30.00'), Decimal('120.00')))
+        self.assertEqual(summary.colors, [['blue', 1], ['white', 1]])
+        self.assertEqual(summary.sizes, [['M', 1]])
+        self.assertEqual(summary.price_buckets, [['0-50', 1], ['100-200', 1]])
+
+        size.stock = 0
+        size.save()
+        self.assertEqual(self.summary(self.shirts).sizes, [])
+
+        linen.category = self.hats
+        linen.save()
+        self.assertEqual(self.summary(self.shirts).product_count, 1)
+        self.assertEqual(self.summary(self.hats).product_count, 1)
+
+        linen.delete()
+        self.assertEqual(self.summary(self.hats).product_count, 0)
+
+
+    def test_deleting_category_with_products(self):
+        make_product(self.hats, 'Cap')
+        hats_id = self.hats.id
+        self.hats.delete()
+        self.assertFalse(CategorySummary.objects.filter(category_id=hats_id).exists())
+
+
+    def test_navigation_and_filters_render_from_cached_summary(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            make_product(self.shirts, 'Linen', color='white', price='30.00')
+        get_catalog_summary()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('main:catalog', args=['shirts']),
+                                       {'show_filters': 'true'}, HTTP_HX_REQUEST='true')
+        # Только страница товаров: ни категорий, ни фасетов
+        self.assertEqual(len(selects(ctx)), 1)
+        self.assertNotIn('UNION', selects(ctx)[0])
+        self.assertEqual(response.context['facets']['color'], [('white', 1)])
+        self.assertContains(response, 'от 30.00')
+
+        # Поиск сужает выборку - фасеты считаются по ней
+        response = self.client.get(reverse('main:catalog', args=['shirts']),
+                                   {'show_filters': 'true', 'color': 'black'},
+                                   HTTP_HX_REQUEST='true')
+        self.assertEqual(response.context['facets']['color'], [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            make_product(self.shirts, 'Oxford', color='blue')
+        self.assertEqual(get_catalog_summary()[0].summary.product_count, 2)
+        self.assertEqual(self.client.get(reverse('main:catalog', args=['missing'])).status_code, 404)
+
+
+def make_upload(name='photo.jpg', size=(1200, 800)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, 'teal').save(buffer, 'JPEG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/jpeg')
+
+
+class ImageDerivativeTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.media_root = media.name
+        self.enterContext(override_settings(MEDIA_ROOT=self.media_root))
+        cache.clear()
+        self.category = Category.objects.create(name='Shirts', slug='shirts')
+
+
+    def upload(self, **kwargs):
+        return Product.objects.create(
+            name='Shirt', slug='shirt', category=self.category, color='black',
+            price=Decimal('10.00'), main_image=make_upload(**kwargs)
+        )
+
+
+    def open_derivative(self, name, width):
+        return Image.open(os.path.join(self.media_root, derivative_name(name, width)))
+
+
+    def test_upload_writes_webp_derivatives_next_to_original(self):
+        product = self.upload()
+        name = product.main_image.name
+        self.assertTrue(name.startswith('products/main/'))
+        self.assertEqual(Product.objects.get().main_image_widths, [320, 640, 1024])
+        image = self.open_derivative(name, 320)
+        self.assertEqual((image.format, image.size), ('WEBP', (320, 213)))
+        original = os.path.getsize(os.path.join(self.media_root, name))
+        self.assertLess(os.path.getsize(os.path.join(self.media_root, derivative_name(name, 320))),
+                        original)
+
+
+    def test_small_images_are_not_upscaled(self):
+        product = self.upload(size=(500, 500))
+        self.assertEqual(product.main_image_widths, [320])
+        image = ProductImage.objects.create(product=product, image=make_upload(size=(700, 300)))
+        self.assertEqual(ProductImage.objects.get().image_widths, [320, 640])
+        self.assertEqual(self.open_derivative(image.image.name, 640).size, (640, 274))
+
+
+    def test_broken_upload_is_saved_without_derivatives(self):
+        upload = SimpleUploadedFile('broken.jpg', b'not an image', content_type='image/jpeg')
+        with self.assertLogs('main.images', 'ERROR'):
+            product = Product.objects.create(
+                name='Shirt', slug='shirt', category=self.category, color='black',
+                price=Decimal('10.00'), main_image=upload
+            )
+        self.assertEqual(Product.objects.get().main_image_widths, [])
+        self.assertEqual(product.main_image.name, 'products/main/broken.jpg')
+
+
+    def test_srcset_tag(self):
+        product = self.upload()
+        template = Template('{% load images %}{% srcset product.main_image "50vw" %}'
+                            '|{{ product.main_image|thumbnail_url }}')
+        rendered = template.render(Context({'product': product}))
+        root = os.path.splitext(product.main_image.url)[0]
+        self.assertEqual(rendered,
+                         f'srcset="{root}.w320.webp 320w, {root}.w640.webp 640w, '
+                         f'{root}.w1024.webp 1024w" sizes="50vw"|{root}.w320.webp')
+
+        product.main_image_widths = []
+        self.assertEqual(template.render(Context({'product': product})),
+                         f'|{product.main_image.url}')
+
+
+    def test_catalog_cards_ship_derivatives(self):
+        product = self.upload()
+        response = self.client.get(reverse('main:catalog_all'), HTTP_HX_REQUEST='true')
+        self.assertContains(response, derivative_name(product.main_image.url, 320))
+
+
+    def test_regenerate_command(self):
+        product = self.upload()
+        Product.objects.update(main_image_widths=[])
+        os.remove(os.path.join(self.media_root, derivative_name(product.main_image.name, 640)))
+        out = io.StringIO()
+        call_command('regenerate_images', '--workers', '2', '--widths', '200', '640',
+                     stdout=out)
+        self.assertIn('Product.main_image: 1 images, 0 failed', out.getvalue())
+        self.assertEqual(Product.objects.get().main_image_widths, [200, 640])
+        self.assertEqual(self.open_derivative(product.main_image.name, 640).size, (640, 427))
+
+
+class CatalogFilterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Shirts', slug='shirts')
+        small, large = Size.objects.create(name='S'), Size.objects.create(name='L')
+        cls.black = make_product(category, 'Black tee', color='Black', price='10.00')
+        cls.white = make_product(category, 'White tee', color='white', price='50.00')
+        cls.red = make_product(category, 'Red tee', color='red', price='90.00')
+        ProductSize.objects.create(product=cls.black, size=small, stock=3)
+        ProductSize.objects.create(product=cls.black, size=large, stock=3)
+        ProductSize.objects.create(product=cls.white, size=large, stock=0)
+        ProductSize.objects.create(product=cls.red, size=small, stock=1)
+
+
+    def setUp(self):
+        cache.clear()
+
+
+    def products(self, params):
+        response = self.client.get(reverse('main:catalog_all'), params, HTTP_HX_REQUEST='true')
+        self.assertEqual(response.status_code, 200)
+        return {product.name for product in response.context['products']}, response
+
+
+    def test_price_range(self):
+        found, _ = self.products({'min_price': '20', 'max_price': '90'})
+        self.assertEqual(found, {'White tee', 'Red tee'})
+        # Перепутанные границы меняются местами
+        found, _ = self.products({'min_price': '60', 'max_price': '5.5'})
+        self.assertEqual(found, {'Black tee', 'White tee'})
+
+
+    def test_invalid_values_are_ignored(self):
+        found, response = self.products({'min_price': 'cheap', 'max_price': '-1', 'color': 'red'})
+        self.assertEqual(found, {'Red tee'})
+        self.assertEqual(response.context['filter_params']['min_price'], '')
+        self.assertEqual(response.context['filter_query'], 'color=red')
+
+
+    def test_multiple_colors(self):
+        found, _ = self.products({'color': ['BLACK', 'red']})
+        self.assertEqual(found, {'Black tee', 'Red tee'})
+        found, response = self.products({'color': 'black, White'})
+        self.assertEqual(found, {'Black tee', 'White tee'})
+        self.assertEqual(response.context['filter_params']['color'], 'black, White')
+
+
+    def test_sizes_in_stock_without_duplicates(self):
+        with CaptureQueriesContext(connection) as ctx:
+            found, response = self.products({'size': ['S', 'L']})
+        self.assertEqual([p.name for p in response.context['products']].count('Black tee'), 1)
+        # У белой футболки L есть, но не в наличии
+        self.assertEqual(found, {'Black tee', 'Red tee'})
+        product_query = next(q for q in selects(ctx) if 'FROM "main_product"' in q)
+        self.assertIn('EXISTS', product_query)
+        self.assertNotIn('DISTINCT', product_query)
+        self.assertContains(response, 'size=S&amp;size=L')
+
+
+class ExplainQueriesTests(TestCase):
+    def test_hot_queries_use_indexes(self):
+        out = io.StringIO()
+        call_command('explain_queries', '--fail', stdout=out)
+        self.assertIn(f'{len(HOT_QUERIES)} of {len(HOT_QUERIES)} queries use indexes',
+                      out.getvalue())
+
+
+    def test_sequential_scans_are_recognised(self):
+        self.assertEqual(SEQ_SCAN['postgresql'].findall(
+            'Limit\n  ->  Seq Scan on main_product\n        Filter: (price >= 10)'
+        ), ['main_product'])
+        self.assertEqual(SEQ_SCAN['sqlite'].findall('2 0 0 SCAN main_product'), ['main_product'])
+        self.assertEqual(SEQ_SCAN['sqlite'].findall(
+            '5 0 0 SCAN main_product USING INDEX product_created_id_idx'
+        ), [])
+
+
+class NonAtomicReadViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Shirts', slug='shirts')
+        cls.product = make_product(category, 'Linen shirt')
+
+
+    def setUp(self):
+        cache.clear()
+
+
+    def test_catalog_pages_skip_atomic_requests(self):
+        urls = [reverse('main:index'), reverse('main:catalog_all'),
+                reverse('main:catalog', args=['shirts']),
+                reverse('main:product_detail', args=[self.product.slug])]
+        for url in urls:
+            with self.subTest(url=url), CaptureQueriesContext(connection) as ctx:
+                self.assertEqual(self.client.get(url).status_code, 200)
+            # В тестах транзакция запроса - это SAVEPOINT внутри TestCase
+            self.assertFalse([q for q in ctx.captured_queries if 'SAVEPOINT' in q['sql']])
+
+
+    def test_writes_stay_atomic(self):
+        size = ProductSize.objects.create(product=self.product,
+                                          size=Size.objects.create(name='M'), stock=1)
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.post(reverse('cart:add_to_cart', args=[self.product.slug]),
+                             {'size_id': size.id, 'quantity': 1})
+        self.assertTrue(ctx.captured_queries[0]['sql'].startswith('SAVEPOINT'))
+
+
+@override_settings(REPLICA_DATABASES=['replica'],
+                   DATABASE_ROUTERS=['enf.routers.ReplicaRouter'])
+class ReplicaRoutingTests(TestCase):
+    """Routing decisions only: ``QuerySet.db`` asks the router without a query."""
+
+    def route(self, method, path, cookies=None):
+        request = getattr(RequestFactory(), method)(path)
+        request.COOKIES.update(cookies or {})
+        request.resolver_match = match = resolve(path)
+        seen = []
+
+        def view(request):
+            middleware.process_view(request, match.func, match.args, match.kwargs)
+            seen.append((Product.objects.all().db, Cart.objects.all().db))
+            return HttpResponse()
+
+        middleware = ReplicaMiddleware(view)
+        response = middleware(request)
+        return seen[0], response
+
+
+    def test_read_only_views_read_from_replica(self):
+        for path in (reverse('main:catalog_all'), reverse('orders:history'),
+                     reverse('users:order_detail', args=[1]),
+                     reverse('admin:main_product_changelist')):
+            with self.subTest(path=path):
+                (product_db, cart_db), response = self.route('get', path)
+                self.assertEqual((product_db, cart_db), ('replica', 'default'))
+                self.assertNotIn(REPLICA_PIN_COOKIE, response.cookies)
+        self.assertEqual(Product.objects.all().db, 'default')
+
+
+    def test_other_views_and_writes_use_default(self):
+        (product_db, _), _ = self.route('get', reverse('cart:cart_modal'))
+        self.assertEqual(product_db, 'default')
+        (product_db, _), response = self.route('post', reverse('orders:checkout'))
+        self.assertEqual(product_db, 'default')
+        self.assertEqual(Product.objects.all().select_for_update().db, 'default')
+        with use_replicas():
+            self.assertEqual(Product.objects.all().db, 'replica')
+            self.assertEqual(Product.objects.all().select_for_update().db, 'default')
+
+
+    def test_client_is_pinned_after_a_write(self):
+        _, response = self.route('post', reverse('orders:checkout'))
+        cookie = response.cookies[REPLICA_PIN_COOKIE]
+        self.assertEqual(cookie['max-age'], REPLICA_PIN_SECONDS)
+        (product_db, _), _ = self.route('get', reverse('orders:history'),
+                                        cookies={REPLICA_PIN_COOKIE: cookie.value})
+        self.assertEqual(product_db, 'default')
+
+
+@override_settings(PROFILING_SAMPLE_RATE=1)
+class ProfilingMiddlewareTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Shirts', slug='shirts')
+        make_product(category, 'Linen shirt')
+
+
+    def setUp(self):
+        cache.clear()
+        recorder.reset()
+        self.addCleanup(recorder.reset)
+
+
+    def test_sampled_request_is_recorded(self):
+        url = reverse('main:catalog_all')
+        self.client.get(url, HTTP_HX_REQUEST='true')
+        self.client.get(url, HTTP_HX_REQUEST='true')
+
+        first, second = [json.loads(line) for line in
+                         self.client.get(reverse('main:metrics_samples')).content.decode().splitlines()]
+        self.assertEqual((first['view'], first['status']), ('main:catalog_all', 200))
+        self.assertGreater(first['queries'], 0)
+        self.assertGreater(first['template_time'], 0)
+        # Второй раз фрагмент отдаётся из кэша
+        self.assertLess(second['queries'], first['queries'])
+        self.assertLess(second['cache_misses'], first['cache_misses'])
+
+        metrics = self.client.get(reverse('main:metrics')).content.decode()
+        self.assertIn('enf_request_duration_seconds_count{view="main:catalog_all"} 2', metrics)
+        self.assertIn('enf_request_duration_seconds{view="main:catalog_all",quantile="0.95"}', metrics)
+        self.assertIn(f'enf_db_queries_total{{view="main:catalog_all"}} '
+                      f'{first["queries"] + second["queries"]}', metrics)
+        self.assertNotIn('main:metrics', metrics)
+
+
+    @override_settings(PROFILING_SAMPLE_RATE=0)
+    def test_unsampled_requests_are_not_recorded(self):
+        self.client.get(reverse('main:index'))
+        self.assertEqual(self.client.get(reverse('main:metrics_samples')).content, b'')
+
+
+    def test_metrics_are_not_public(self):
+        response = self.client.get(reverse('main:metrics'), REMOTE_ADDR='203.0.113.5')
+        self.assertEqual(response.status_code, 403)
+
+
+    @override_settings(PROFILING_TOKEN='scrape-token')
+    def test_scraper_with_token_is_allowed_behind_proxy(self):
+        url = reverse('main:metrics')
+        # Адрес nginx контейнера, а не самого Prometheus
+        proxied = {'REMOTE_ADDR': '172.18.0.3'}
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer scrape-token',
+                                         **proxied).status_code, 200)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong',
+                                         **proxied).status_code, 403)
+
+
+    def test_buffers_are_bounded(self):
+        ring = Recorder(buffer_size=3, window=2)
+        for i in range(5):
+            ring.record({'view': 'main:index', 'duration': float(i), 'queries': 1,
+                         'db_time': 0.0, 'template_time': 0.0, 'cache_hits': 0,
+                         'cache_misses': 0})
+        self.assertEqual(len(ring.jsonl().splitlines()), 3)
+        self.assertEqual(list(ring.views['main:index']['recent']), [3.0, 4.0])
+        self.assertIn('enf_request_duration_seconds_count{view="main:index"} 5', ring.prometheus())
+
+
+class ConditionalGetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Shirts', slug='shirts')
+        cls.product = make_product(cls.category, 'Linen shirt')
+        cls.size = ProductSize.objects.create(product=cls.product, stock=5,
+                                              size=Size.objects.create(name='M'))
+        cls.product_url = reverse('main:product_detail', args=[cls.product.slug])
+        cls.catalog_url = reverse('main:catalog_all')
+
+
+    def setUp(self):
+        cache.clear()
+
+
+    def revalidate(self, url, etag, **headers):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, **headers)
+        return response, ctx
+
+
+    def test_unchanged_pages_are_not_modified_after_one_query(self):
+        for url in (self.product_url, self.catalog_url, f'{self.catalog_url}?size=M&min_price=5'):
+            first = self.client.get(url)
+            self.assertIn('HX-Request', first['Vary'])
+            self.assertIn('no-cache', first['Cache-Control'])
+            response, ctx = self.revalidate(url, first['ETag'])
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], first['ETag'])
+            self.assertEqual(len(selects(ctx)), 1)
+
+
+    def test_cached_fragment_is_not_modified_without_queries(self):
+        first = self.client.get(self.catalog_url, HTTP_HX_REQUEST='true')
+        response, ctx = self.revalidate(self.catalog_url, first['ETag'], HTTP_HX_REQUEST='true')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(selects(ctx), [])
+
+
+    def test_page_and_fragment_have_different_etags(self):
+        page = self.client.get(self.catalog_url)
+        fragment = self.client.get(self.catalog_url, HTTP_HX_REQUEST='true')
+        self.assertNotEqual(page['ETag'], fragment['ETag'])
+        response, _ = self.revalidate(self.catalog_url, fragment['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+
+    def test_stock_change_updates_product_etag(self):
+        etag = self.client.get(self.product_url)['ETag']
+        StockReservation.objects.reserve(Cart.objects.create(), self.size.id, 1)
+        response, _ = self.revalidate(self.product_url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+    def test_stock_change_updates_product_fragment(self):
+        first = self.client.get(self.product_url, HTTP_HX_REQUEST='true')
+        cart = Cart.objects.create()
+        # Размер остаётся в продаже - версия каталога не меняется
+        StockReservation.objects.reserve(cart, self.size.id, 1)
+        response, _ = self.revalidate(self.product_url, first['ETag'], HTTP_HX_REQUEST='true')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], first['ETag'])
+
+        StockReservation.objects.reserve(cart, self.size.id, 4)
+        response = self.client.get(self.product_url, HTTP_HX_REQUEST='true')
+        self.assertContains(response, 'disabled')
+
+
+    def test_catalog_changes_update_catalog_etag(self):
+        etag = self.client.get(self.catalog_url)['ETag']
+        self.product.price = Decimal('12.00')
+        self.product.save()
+        response, _ = self.revalidate(self.catalog_url, etag)
+        self.assertEqual(response.status_code, 200)
+
+        # UPDATE мимо сигналов версию не меняет, но двигает updated_at
+        etag = response['ETag']
+        Product.objects.filter(pk=self.product.pk).update(updated_at=timezone.now())
+        self.assertEqual(self.revalidate(self.catalog_url, etag)[0].status_code, 200)
+
+
+    def test_missing_product_is_404_with_etag(self):
+        response = self.client.get(reverse('main:product_detail', args=['missing']),
+                                   HTTP_IF_NONE_MATCH='"abc"')
+        self.assertEqual(response.status_code, 404)
+
+
+class BenchCacheTests(TestCase):
+    def test_harness_leaves_the_live_cache_alone(self):
+        cache.set('bench:sentinel', 1)
+        cache.delete(CATALOG_SUMMARY_KEY)
+        with isolated_caches():
+            fixture = BenchmarkFixture(products=4, sizes_per_product=2, images_per_product=1,
+                                       categories=1, orders=1).seed()
+            run_endpoint(fixture, endpoints_for('main')[0], repeat=1)
+        self.assertEqual(cache.get('bench:sentinel'), 1)
+        self.assertIsNone(cache.get(CATALOG_SUMMARY_KEY))
+        cache.delete('bench:sentinel')
+
+
+class MainQueryBudgetTests(QueryBudgetMixin, TestCase):
+    namespace = 'main'
+
+
+class AdminQueryBudgetTests(QueryBudgetMixin, TestCase):
+    namespace = 'admin'
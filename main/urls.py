@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import profiling, views
 
 app_name = 'main'
 
@@ -8,4 +8,6 @@ urlpatterns = [
     path('catalog/', views.CatalogView.as_view(), name='catalog_all'),
     path('catalog/<slug:category_slug>/', views.CatalogView.as_view(), name='catalog'),
     path('product/<slug:slug>', views.ProductDetailView.as_view(), name='product_detail'),
+    path('metrics/', profiling.metrics, name='metrics'),
+    path('metrics/samples.jsonl', profiling.samples, name='metrics_samples'),
 ]
\ No newline at end of file
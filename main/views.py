@@ -1,18 +1,60 @@
-from django.shortcuts import get_object_or_404
+from django.http import Http404
 from django.views.generic import TemplateView, DetailView
 from django.http import HttpResponse
 from django.template.response import TemplateResponse
-from .models import Category, Product, Size
-from django.db.models import Q
-
-
+from django.utils.decorators import method_decorator
+from django.utils.functional import SimpleLazyObject
+from datetime import timezone as dt_timezone
+from django.db import transaction
+from django.db.models import Count, Max, Min, OuterRef, Prefetch, Subquery
+from .forms import CatalogFilterForm
+from .models import Product, ProductImage, ProductSize
+from .search import search_products, facet_counts
+from .pagination import keyset_window, split_page
+from .cache import cache_fragment, catalog_etag, not_modified, set_conditional_headers
+from .summary import get_catalog_summary, summary_facets
+from enf.routers import read_from_replica
+
+
+def _timestamp(value):
+    # Одна и та же строка для времени из объекта и из агрегата базы
+    return value.astimezone(dt_timezone.utc).isoformat() if value else ''
+
+
+def _latest(*values):
+    return max((value for value in values if value), default=None)
+
+
+def product_etag_row(request, slug):
+    """``(updated_at, latest size, latest image)`` of the product, one query.
+
+    Keys the product fragment cache as well: stock moves that keep a size
+    on sale change no catalog version, only the size's ``updated_at``.
+    """
+    if not hasattr(request, 'product_etag_row'):
+        def latest(model):
+            return Subquery(model.objects.filter(product=OuterRef('pk')).order_by()
+                            .values('product').annotate(latest=Max('updated_at'))
+                            .values('latest'))
+
+        request.product_etag_row = Product.objects.filter(slug=slug).annotate(
+            size_updated=latest(ProductSize), image_updated=latest(ProductImage)
+        ).values_list('updated_at', 'size_updated', 'image_updated').first()
+    return request.product_etag_row
+
+
+# Страницы каталога только читают: ATOMIC_REQUESTS для них лишь добавлял
+# BEGIN/COMMIT (SAVEPOINT в тестах) к каждому запросу
+@method_decorator(transaction.non_atomic_requests, name='dispatch')
+@method_decorator(read_from_replica, name='dispatch')
+@method_decorator(cache_fragment, name='get')
 class IndexView(TemplateView):
     template_name = 'main/base.html'
 
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['categories'] = Category.objects.all()
+        context['categories'] = SimpleLazyObject(get_catalog_summary)
         context['current_category'] = None
         return context
     
@@ -24,51 +66,69 @@ class IndexView(TemplateView):
         return TemplateResponse(request, self.template_name, context)
     
 
+@method_decorator(transaction.non_atomic_requests, name='dispatch')
+@method_decorator(read_from_replica, name='dispatch')
+@method_decorator(cache_fragment, name='get')
 class CatalogView(TemplateView):
     template = 'main/base.html'
-
-    FILTER_MAPPING = {
-        'color': lambda queryset, value: queryset.filter(color__iexact=value),
-        'min_price': lambda queryset, value: queryset.filter(price_gte=value),
-        'max_price': lambda queryset, value: queryset.filter(price_lte=value),
-        'size': lambda queryset, value: queryset.filter(product_sizes__size__name=value),
-    }
+    page_size = 24
+    max_page_size = 96
 
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        category_slug = kwargs.get('category_slug')
-        categories = Category.objects.all()
-        products = Product.objects.all().order_by('-created_at')
-        current_category = None
+    def get_products(self, category_slug):
+        """Searched and filtered products; sets ``categories``, ``current_category``,
+        ``query`` and ``filters`` for ``get_context_data``."""
+        self.categories = SimpleLazyObject(get_catalog_summary)
+        products = Product.objects.all()
+        self.current_category = None
 
         if category_slug:
-            current_category = get_object_or_404(Category, slug=category_slug)
-            products = products.filter(category=current_category)
-
-        query = self.request.GET.get('q')
-        if query:
-            products = products.filter(
-                Q(name__icontains=query) | Q(description__icontains=query)
+            self.current_category = next(
+                (category for category in self.categories if category.slug == category_slug), None
             )
+            if self.current_category is None:
+                raise Http404('No category matches the given query.')
+            products = products.filter(category=self.current_category)
+
+        self.query = self.request.GET.get('q')
+        if self.query:
+            products = search_products(products, self.query)
+
+        self.filters = CatalogFilterForm(self.request.GET)
+        return self.filters.filter(products)
 
-        filter_params = {}
-        for param, filter_func in self.FILTER_MAPPING.items():
-            value = self.request.GET.get(param)
-            if value:
-                products = filter_func(products, value)
-                filter_params[param] = value
-            else:
-                filter_params[param] = ''
 
+    def get_context_data(self, products, rows, **kwargs):
+        context = super().get_context_data(**kwargs)
+        category_slug = kwargs.get('category_slug')
+        categories, query, filters = self.categories, self.query, self.filters
+        filter_params = filters.template_values()
         filter_params['q'] = query or ''
 
+        # Фасеты нужны только окну фильтров; без поиска и фильтров они
+        # берутся из готовых сводок категорий
+        if self.request.GET.get('show_filters') == 'true':
+            if query or filters.values:
+                context['facets'] = facet_counts(products)
+            else:
+                context['facets'] = summary_facets(
+                    [self.current_category] if self.current_category else categories
+                )
+
+        page, next_cursor = split_page(rows, self.get_page_size())
+        next_page_url = None
+        if next_cursor:
+            params = self.request.GET.copy()
+            params['cursor'] = next_cursor
+            next_page_url = f"{self.request.path}?{params.urlencode()}"
+
         context.update({
             'categories': categories,
-            'products': products,
+            'products': page,
+            'next_page_url': next_page_url,
             'current_category': category_slug,
             'filter_params': filter_params,
-            'sizes': Size.objects.all(),
+            'filter_query': filters.urlencode(),
             'search_query': query or ''
         })
 
@@ -80,9 +140,42 @@ class CatalogView(TemplateView):
         return context
     
 
+    def get_page_size(self):
+        try:
+            page_size = int(self.request.GET.get('page_size', self.page_size))
+        except ValueError:
+            page_size = self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+
     def get(self, request, *args, **kwargs):
-        context = self.get_context_data(**kwargs)
+        products = self.get_products(kwargs.get('category_slug'))
+        window = keyset_window(products, request.GET.get('cursor'), self.get_page_size())
+
+        # Клиент прислал ETag: одна агрегатная выборка по окну страницы
+        # вместо товаров, фасетов и шаблона
+        if request.headers.get('If-None-Match'):
+            stats = window.aggregate(updated=Max('updated_at'), count=Count('id'),
+                                     oldest=Min('created_at'))
+            etag = catalog_etag(request, _timestamp(stats['updated']), stats['count'],
+                                _timestamp(stats['oldest']))
+            response = not_modified(request, etag, stats['updated'])
+            if response is not None:
+                return response
+
+        rows = list(window)
+        # Те же значения, что дал бы агрегат, но из уже выбранных строк
+        updated = _latest(*(product.updated_at for product in rows))
+        oldest = min((product.created_at for product in rows), default=None)
+        etag = catalog_etag(request, _timestamp(updated), len(rows), _timestamp(oldest))
+        response = self.render_page(request, self.get_context_data(products, rows, **kwargs))
+        return set_conditional_headers(response, etag, updated)
+
+
+    def render_page(self, request, context):
         if request.headers.get('HX-Request'):
+            if request.GET.get('cursor'):
+                return TemplateResponse(request, 'main/product_list.html', context)
             if context.get('show_search'):
                 return TemplateResponse(request, 'main/search_input.html', context)
             elif context.get('reset_search'):
@@ -92,6 +185,9 @@ class CatalogView(TemplateView):
         return TemplateResponse(request, self.template, context)
     
 
+@method_decorator(transaction.non_atomic_requests, name='dispatch')
+@method_decorator(read_from_replica, name='dispatch')
+@method_decorator(cache_fragment(vary_on=product_etag_row), name='get')
 class ProductDetailView(DetailView):
     model = Product
     template_name = 'main/base.html'
@@ -99,20 +195,48 @@ class ProductDetailView(DetailView):
     slug_url_kwarg = 'slug'
 
 
+    def get_queryset(self):
+        # Товар с категорией одним запросом, изображения и размеры с
+        # названиями - по одному запросу на связь
+        return Product.objects.select_related('category').prefetch_related(
+            'images',
+            Prefetch('product_sizes',
+                     queryset=ProductSize.objects.select_related('size')),
+        )
+
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        product = self.get_object()
-        context['categories'] = Category.objects.all()
+        product = self.object
+        # HTMX фрагменту навигация не нужна - сводка читается только шаблоном
+        context['categories'] = SimpleLazyObject(get_catalog_summary)
         context['related_products'] = Product.objects.filter(
-            category=product.category
-        ).exclude(id=product.id)[:4]
+            category_id=product.category_id
+        ).exclude(id=product.id).order_by('-created_at', '-id')[:4]
         context['current_category'] = product.category.slug
         return context
     
 
     def get(self, request, *args, **kwargs):
-        self.object = self.get_object()
+        # Остатки меняют updated_at размера, поэтому ETag следует и за ними
+        if request.headers.get('If-None-Match'):
+            row = product_etag_row(request, kwargs[self.slug_url_kwarg])
+            if row is not None:
+                etag = catalog_etag(request, *map(_timestamp, row))
+                response = not_modified(request, etag, _latest(*row))
+                if response is not None:
+                    return response
+
+        self.object = product = self.get_object()
+        row = (
+            product.updated_at,
+            _latest(*(size.updated_at for size in product.product_sizes.all())),
+            _latest(*(image.updated_at for image in product.images.all())),
+        )
         context = self.get_context_data(**kwargs)
         if request.headers.get('HX-Request'):
-            return TemplateResponse(request, 'main/product_detail.html', context)
-        return TemplateResponse(request, self.template_name, context)
\ No newline at end of file
+            response = TemplateResponse(request, 'main/product_detail.html', context)
+        else:
+            response = TemplateResponse(request, self.template_name, context)
+        return set_conditional_headers(response, catalog_etag(request, *map(_timestamp, row)),
+                                       _latest(*row))
\ No newline at end of file
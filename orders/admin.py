@@ -1,5 +1,6 @@
 from django.contrib import admin
 from django.utils.safestring import mark_safe
+from main.images import smallest_url
 from .models import Order, OrderItem
 
 
@@ -9,12 +10,34 @@ class OrderItemInline(admin.TabularInline):
     fields = ('image_preview', 'product', 'size', 'quantity',
               'price', 'get_total_price')
     readonly_fields = ('image_preview', 'get_total_price')
+    # Выпадающие списки всех товаров/размеров - тысячи запросов на страницу
+    raw_id_fields = ('product', 'size')
     can_delete = False
 
 
+    def get_queryset(self, request):
+        # Превью и подписи строк из одного запроса, а не по запросу на строку
+        return super().get_queryset(request).select_related(
+            'product', 'size__size', 'size__product'
+        )
+
+
+    def get_readonly_fields(self, request, obj=None):
+        # Подпись raw id виджета - отдельный запрос на каждое поле строки;
+        # товар и размер оформленного заказа не меняются
+        if obj:
+            return self.readonly_fields + ('product', 'size')
+        return self.readonly_fields
+
+
+    def has_add_permission(self, request, obj=None):
+        # Без выбора товара новая строка заказа не сохранится
+        return obj is None and super().has_add_permission(request, obj)
+
+
     def image_preview(self, obj):
         if obj.product.main_image:
-            return mark_safe(f'<img src="{obj.product.main_image.url}" style="max-height: 100px; "max-width: 100px; object-fit: cover;" />')
+            return mark_safe(f'<img src="{smallest_url(obj.product.main_image)}" style="max-height: 100px; "max-width: 100px; object-fit: cover;" />')
         return mark_safe('<span style="color: gray;"> No Image</span>')
     image_preview.short_description = 'Image'
 
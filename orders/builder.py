@@ -0,0 +1,77 @@
+from decimal import Decimal
+from .models import Order, OrderItem
+
+
+class CartSnapshot:
+    """Cart lines read once with product and size joined.
+
+    Checkout renders, reserves, prices and bills from this one list, so the
+    cost of placing an order doesn't grow with the number of lines.
+    """
+
+    def __init__(self, cart):
+        self.cart = cart
+        self.items = list(cart.get_items().select_related(
+            'product', 'product_size__size'
+        ).order_by('-added_at'))
+        self.total_items = sum(item.quantity for item in self.items)
+        self.total_price = sum(
+            (self.unit_price(item) * item.quantity for item in self.items),
+            Decimal('0.00')
+        )
+        # Итоги корзины в шаблонах берутся из снимка, без агрегата
+        cart._totals = {'total_items': self.total_items,
+                        'subtotal': self.total_price}
+
+
+    def __bool__(self):
+        return bool(self.items)
+
+
+    @staticmethod
+    def unit_price(item):
+        return item.product.price or Decimal('0.00')
+
+
+    def order_items(self, order):
+        return [
+            OrderItem(order=order, product=item.product, size=item.product_size,
+                      quantity=item.quantity, price=self.unit_price(item))
+            for item in self.items
+        ]
+
+
+    def stripe_line_items(self):
+        return [{
+            'price_data': {
+                'currency': 'azn',
+                'product_data': {
+                    'name': f'{item.product.name} - {item.product_size.size.name}',
+                },
+                'unit_amount': int(self.unit_price(item) * 100),
+            },
+            'quantity': item.quantity,
+        } for item in self.items]
+
+
+def build_order(snapshot, user, cleaned_data, payment_provider):
+    """Create the order and all of its lines in two INSERTs."""
+    order = Order.objects.create(
+        user=user,
+        first_name=cleaned_data['first_name'],
+        last_name=cleaned_data['last_name'],
+        email=cleaned_data['email'],
+        company=cleaned_data['company'],
+        address1=cleaned_data['address1'],
+        address2=cleaned_data['address2'],
+        city=cleaned_data['city'],
+        country=cleaned_data['country'],
+        province=cleaned_data['province'],
+        postal_code=cleaned_data['postal_code'],
+        phone=cleaned_data['phone'],
+        special_instructions='',
+        total_price=snapshot.total_price,
+        payment_provider=payment_provider,
+    )
+    OrderItem.objects.bulk_create(snapshot.order_items(order))
+    return order
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-18 18:47
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0004_order_user_created_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('stripe_payment_intent_id__isnull', False)), fields=['stripe_payment_intent_id'], name='order_stripe_intent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('heleket_payment_id__isnull', False)), fields=['heleket_payment_id'], name='order_heleket_payment_idx'),
+        ),
+    ]
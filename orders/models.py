@@ -1,8 +1,40 @@
 from django.db import models
+from django.db.models import (DecimalField, ExpressionWrapper, F, OuterRef,
+                              Subquery, Sum, Value)
+from django.db.models.functions import Coalesce
 from django.conf import settings
+from main.images import derivative_url
 from main.models import Product, ProductSize
 
 
+class OrderQuerySet(models.QuerySet):
+    def with_summary(self):
+        """Annotate item count, items total and the first item's image and its widths.
+
+        Correlated subqueries keep it one query per page without the row
+        fan-out (and GROUP BY) a join to the items would need.
+        """
+        items = OrderItem.objects.filter(order=OuterRef('pk')).order_by()
+        money = DecimalField(max_digits=12, decimal_places=2)
+        return self.annotate(
+            item_count=Coalesce(Subquery(
+                items.values('order').annotate(n=Sum('quantity')).values('n')
+            ), 0),
+            items_total=Coalesce(Subquery(
+                items.values('order').annotate(total=Sum(ExpressionWrapper(
+                    F('price') * F('quantity'), output_field=money
+                ))).values('total'),
+                output_field=money,
+            ), Value(0), output_field=money),
+            thumbnail=Subquery(
+                items.order_by('id').values('product__main_image')[:1]
+            ),
+            thumbnail_widths=Subquery(
+                items.order_by('id').values('product__main_image_widths')[:1]
+            ),
+        )
+
+
 class Order(models.Model):
     STATUS_CHOICES = (
         ('pending', 'В ожидании'),
@@ -38,11 +70,34 @@ class Order(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = OrderQuerySet.as_manager()
+
+
+    class Meta:
+        indexes = [
+            # История заказов пользователя: последние сначала, keyset по id
+            models.Index(fields=['user', '-created_at', '-id'],
+                         name='order_user_created_idx'),
+            # Поиск заказа по платежу провайдера; у неоплаченных заказов id пустые
+            models.Index(fields=['stripe_payment_intent_id'], name='order_stripe_intent_idx',
+                         condition=models.Q(stripe_payment_intent_id__isnull=False)),
+            models.Index(fields=['heleket_payment_id'], name='order_heleket_payment_idx',
+                         condition=models.Q(heleket_payment_id__isnull=False)),
+        ]
+
 
     def __str__(self):
         return f"Order {self.id} by {self.email}"
 
 
+    @property
+    def thumbnail_url(self):
+        """Smallest derivative of the first item's photo; needs ``with_summary()``."""
+        if not self.thumbnail:
+            return None
+        return derivative_url(self.thumbnail, self.thumbnail_widths)
+
+
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='items')
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
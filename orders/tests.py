@@ -1,3 +1,186 @@
+from decimal import Decimal
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from cart.models import Cart, StockReservation
+from main.benchmark import QueryBudgetMixin
+from main.tests import selects
+from main.models import Category, Product, ProductSize, Size
+from payment.outbox import drain
+from payment.tests import HeleketStubMixin
+from users.models import CustomUser
+from .models import Order, OrderItem
 
-# Create your tests here.
+
+class CheckoutTests(HeleketStubMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('buyer@example.com', 'Buyer',
+                                                  'User', password='secret-pass')
+        category = Category.objects.create(name='Shirts', slug='shirts')
+        cls.product_sizes = []
+        for i in range(6):
+            product = Product.objects.create(
+                name=f'Shirt {i}', slug=f'shirt-{i}', category=category,
+                color='black', price=Decimal(10 + i), main_image='products/main/shirt.jpg'
+            )
+            cls.product_sizes.append(ProductSize.objects.create(
+                product=product, size=Size.objects.create(name=f'S{i}'), stock=5
+            ))
+
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+
+    def fill_cart(self, count):
+        for product_size in self.product_sizes[:count]:
+            self.client.post(reverse('cart:add_to_cart', args=[product_size.product.slug]),
+                             {'size_id': product_size.id, 'quantity': 2})
+
+
+    def checkout(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(reverse('orders:checkout'), {
+                'payment_provider': 'heleket', 'first_name': 'Buyer',
+                'last_name': 'User', 'email': self.user.email,
+            })
+        self.assertEqual(response.status_code, 302)
+        # Запрос к заглушке Heleket уходит из outbox уже после ответа
+        drain(workers=1)
+        self.client.get(response.url)
+        return len(ctx.captured_queries)
+
+
+    def test_order_built_from_cart(self):
+        self.fill_cart(3)
+        self.checkout()
+        order = Order.objects.get()
+        self.assertEqual(order.total_price, Decimal('66.00'))
+        self.assertEqual(order.items.count(), 3)
+        self.assertEqual(StockReservation.objects.filter(order=order).count(), 3)
+        self.assertEqual(Cart.objects.get().total_items, 0)
+
+
+    def test_checkout_queries_do_not_grow_with_cart(self):
+        self.fill_cart(1)
+        small = self.checkout()
+        Order.objects.all().delete()
+        self.fill_cart(6)
+        self.assertEqual(self.checkout(), small)
+
+
+class OrderHistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('buyer@example.com', 'Buyer', 'User')
+        category = Category.objects.create(name='Shirts', slug='shirts')
+        product = Product.objects.create(
+            name='Shirt', slug='shirt', category=category, color='black',
+            price=Decimal('10.00'), main_image='products/main/shirt.jpg',
+            main_image_widths=[320, 640]
+        )
+        product_size = ProductSize.objects.create(
+            product=product, size=Size.objects.create(name='M'), stock=5
+        )
+        cls.orders = []
+        for i in range(12):
+            order = Order.objects.create(user=cls.user, first_name='Buyer', last_name='User',
+                                         email=cls.user.email, total_price='30.00')
+            for quantity in (1, 2):
+                OrderItem.objects.create(order=order, product=product, size=product_size,
+                                         quantity=quantity, price=Decimal('10.00'))
+            cls.orders.append(order)
+
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+
+    def test_pages_cover_history_with_summaries(self):
+        url = reverse('orders:history') + '?page_size=5'
+        seen = []
+        while url:
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(url, HTTP_HX_REQUEST='true')
+            # пользователь и одна страница заказов со сводкой, сессия из кэша
+            self.assertEqual(len(selects(ctx)), 2, '\n'.join(selects(ctx)))
+            seen.extend(response.context['orders'])
+            url = response.context['next_page_url']
+        self.assertEqual([order.id for order in seen], [order.id for order in reversed(self.orders)])
+        self.assertEqual({(order.item_count, order.items_total, order.thumbnail) for order in seen},
+                         {(3, Decimal('30.00'), 'products/main/shirt.jpg')})
+        # Превью из самой узкой копии, а не из оригинала
+        self.assertContains(response, 'products/main/shirt.w320.webp')
+        self.assertNotContains(response, 'products/main/shirt.jpg')
+
+
+    def test_json_history(self):
+        response = self.client.get(reverse('orders:history'), {'page_size': 2},
+                                   HTTP_ACCEPT='application/json')
+        data = response.json()
+        self.assertEqual([order['id'] for order in data['orders']],
+                         [self.orders[-1].id, self.orders[-2].id])
+        self.assertEqual(data['orders'][0]['item_count'], 3)
+        self.assertIn('cursor=', data['next'])
+
+
+    def test_profile_queries_do_not_grow_with_history(self):
+        def profile_selects():
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(reverse('users:profile'), HTTP_HX_REQUEST='true')
+            return response, len(selects(ctx))
+
+        response, many = profile_selects()
+        self.assertEqual(response.context['latest_order'].id, self.orders[-1].id)
+        self.assertEqual(len(response.context['orders']), 5)
+        Order.objects.exclude(id=self.orders[0].id).delete()
+        response, one = profile_selects()
+        self.assertEqual(many, one)
+
+
+class OrderAdminTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = CustomUser.objects.create_superuser('staff@example.com', 'Staff', 'User',
+                                                        password='staff-password-123')
+        category = Category.objects.create(name='Shirts', slug='shirts')
+        cls.order = Order.objects.create(user=cls.staff, first_name='Staff', last_name='User',
+                                         email=cls.staff.email, total_price='40.00')
+        for i in range(4):
+            product = Product.objects.create(
+                name=f'Shirt {i}', slug=f'shirt-{i}', category=category, color='black',
+                price=Decimal('10.00'), main_image='products/main/shirt.jpg'
+            )
+            OrderItem.objects.create(
+                order=cls.order, product=product, quantity=1, price=Decimal('10.00'),
+                size=ProductSize.objects.create(product=product, stock=5,
+                                                size=Size.objects.create(name=f'S{i}')),
+            )
+
+
+    def setUp(self):
+        self.client.force_login(self.staff)
+
+
+    def test_change_page_queries_do_not_grow_with_items(self):
+        def change_page_selects():
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(reverse('admin:orders_order_change',
+                                                   args=[self.order.id]))
+            self.assertEqual(response.status_code, 200)
+            return len(selects(ctx))
+
+        # Первый запрос прогревает кэши сессии и content types
+        change_page_selects()
+        many = change_page_selects()
+        OrderItem.objects.filter(order=self.order).exclude(
+            id=self.order.items.order_by('id').values('id')[:1]
+        ).delete()
+        self.assertEqual(change_page_selects(), many)
+
+
+class OrdersQueryBudgetTests(QueryBudgetMixin, TestCase):
+    namespace = 'orders'
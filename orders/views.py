@@ -1,18 +1,19 @@
-from django.conf import settings
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse, QueryDict
 from django.template.response import TemplateResponse
 from django.views.generic import View
 from .forms import OrderForm
-from .models import Order, OrderItem
+from .builder import CartSnapshot, build_order
+from .models import Order
 from cart.views import CartMixin
-from cart.models import Cart
-from main.models import ProductSize
-from django.shortcuts import get_object_or_404
-from payment.views import create_stripe_checkout_session, create_heleket_payment
-from decimal import Decimal
+from cart.models import StockReservation
+from main.pagination import paginate_keyset
+from django.urls import reverse
+from payment.outbox import enqueue_payment
+from payment.views import payment_payload
+from enf.routers import read_from_replica
 import logging
 
 logger = logging.getLogger(__name__)
@@ -22,22 +23,25 @@ logger = logging.getLogger(__name__)
 class CheckoutView(CartMixin, View):
     def get(self, request):
         cart = self.get_cart(request)
-        logger.debug(f"Checkout view: session_key={request.session.session_key}, cart_id={cart.id}, total_items={cart.total_items}, subtotal={cart.subtotal}")
+        snapshot = CartSnapshot(cart)
+        logger.debug("Checkout view: session_key=%s, cart_id=%s, total_items=%s, subtotal=%s",
+                     request.session.session_key, cart.id, snapshot.total_items,
+                     snapshot.total_price)
 
-        if cart.total_items == 0:
+        if not snapshot:
             logger.warning("Cart is empty, redirecting to cart page")
             if request.headers.get('HX-Request'):
                 return TemplateResponse(request, 'orders/empty_cart.html', {'message': 'Your cart is empty'})
             return redirect('cart:cart_modal')
 
-        total_price = cart.subtotal
-        logger.debug(f"Total price: {total_price}")
+        total_price = snapshot.total_price
+        logger.debug("Total price: %s", total_price)
 
         form = OrderForm(user=request.user)
         context = {
             'form': form,
             'cart': cart,
-            'cart_items': cart.items.select_related('product', 'product_size__size').order_by('-added_at'),
+            'cart_items': snapshot.items,
             'total_price': total_price,
         }
 
@@ -47,119 +51,121 @@ class CheckoutView(CartMixin, View):
 
     def post(self, request):
         cart = self.get_cart(request)
+        # Одно чтение корзины на весь checkout: проверки, резерв, заказ, оплата
+        snapshot = CartSnapshot(cart)
         payment_provider = request.POST.get('payment_provider')
-        logger.debug(f"Checkout POST: session_key={request.session.session_key}, cart_id={cart.id}, total_items={cart.total_items}, payment_provider={payment_provider}")
+        logger.debug("Checkout POST: session_key=%s, cart_id=%s, total_items=%s, payment_provider=%s",
+                     request.session.session_key, cart.id, snapshot.total_items,
+                     payment_provider)
 
-        if cart.total_items == 0:
+        if not snapshot:
             logger.warning("Cart is empty, redirecting to cart page")
             if request.headers.get('HX-Request'):
                 return TemplateResponse(request, 'orders/empty_cart.html', {'message': 'Your cart is empty'})
             return redirect('cart:cart_modal')
 
-        if not payment_provider or payment_provider not in ['stripe', 'heleket']:
-            logger.error(f"Invalid or missing payment provider: {payment_provider}")
+        total_price = snapshot.total_price
+
+        def render_checkout(form, error_message):
             context = {
-                'form': OrderForm(user=request.user),
+                'form': form,
                 'cart': cart,
-                'cart_items': cart.items.select_related('product', 'product_size__size').order_by('-added_at'),
-                'total_price': cart.subtotal,
-                'error_message': 'Please select a valid payment provider (Stripe or Heleket).',
+                'cart_items': snapshot.items,
+                'total_price': total_price,
+                'error_message': error_message,
             }
             if request.headers.get('HX-Request'):
                 return TemplateResponse(request, 'orders/checkout_content.html', context)
             return render(request, 'orders/checkout.html', context)
 
-        total_price = cart.subtotal
+        if not payment_provider or payment_provider not in ['stripe', 'heleket']:
+            logger.error("Invalid or missing payment provider: %s", payment_provider)
+            return render_checkout(OrderForm(user=request.user),
+                                   'Please select a valid payment provider (Stripe or Heleket).')
+
         form_data = request.POST.copy()
         if not form_data.get('email'):
             form_data['email'] = request.user.email
         form = OrderForm(form_data, user=request.user)
 
         if form.is_valid():
-            order = Order.objects.create(
-                user=request.user,
-                first_name=form.cleaned_data['first_name'],
-                last_name=form.cleaned_data['last_name'],
-                email=form.cleaned_data['email'],
-                company=form.cleaned_data['company'],
-                address1=form.cleaned_data['address1'],
-                address2=form.cleaned_data['address2'],
-                city=form.cleaned_data['city'],
-                country=form.cleaned_data['country'],
-                province=form.cleaned_data['province'],
-                postal_code=form.cleaned_data['postal_code'],
-                phone=form.cleaned_data['phone'],
-                special_instructions='',
-                total_price=total_price,
-                payment_provider=payment_provider,
-            )
-
-            for item in cart.items.select_related('product', 'product_size'):
-                logger.debug(f"Processing cart item: product={item.product.name}, size={item.product_size.size.name}, quantity={item.quantity}")
-                OrderItem.objects.create(
-                    order=order,
-                    product=item.product,
-                    size=item.product_size,
-                    quantity=item.quantity,
-                    price=item.product.price or Decimal('0.00')
-                )
-
-            try:
-                logger.info(f"Creating payment session for provider: {payment_provider}")
-                if payment_provider == 'stripe':
-                    logger.debug("Creating Stripe checkout session")
-                    checkout_session = create_stripe_checkout_session(order, request)
-                    cart.clear()
-                    if request.headers.get('HX-Request'):
-                        response = HttpResponse(status=200)
-                        response['HX-Redirect'] = checkout_session.url
-                        logger.info(f"HX-Redirect to Stripe: {checkout_session.url}")
-                        return response
-                    return redirect(checkout_session.url)
-                elif payment_provider == 'heleket':
-                    payment = create_heleket_payment(order, request)
-                    cart.clear()
-                    if request.headers.get('HX-Request'):
-                        response = HttpResponse(status=200)
-                        response['HX-Redirect'] = payment['url']
-                        return response
-                    return redirect(payment['url'])
-            except Exception as e:
-                logger.error(f"Error creating payment: {str(e)}", exc_info=True)
-                order.delete()
-                context = {
-                    'form': form,
-                    'cart': cart,
-                    'cart_items': cart.items.select_related('product', 'product_size__size').order_by('-added_at'),
-                    'total_price': total_price,
-                    'error_message': f'Payment processing error: {str(e)}',
-                }
-                if request.headers.get('HX-Request'):
-                    return TemplateResponse(request, 'orders/checkout_content.html', context)
-                return render(request, 'orders/checkout.html', context)
-        else:
-            logger.warning(f"Form validation error: {form.errors}")
-            context = {
-                'form': form,
-                'cart': cart,
-                'cart_items': cart.items.select_related('product', 'product_size__size').order_by('-added_at'),
-                'total_price': total_price,
-                'error_message': 'Please correct the errors in the form.',
-            }
+            # Истёкшие резервы корзины берутся заново до создания заказа
+            sold_out = StockReservation.objects.hold_cart(cart, snapshot.items)
+            if sold_out:
+                names = ', '.join(f'{item.product.name} ({item.product_size.size.name})'
+                                  for item in sold_out)
+                return render_checkout(form, f'Not enough stock left for: {names}.')
+
+            order = build_order(snapshot, request.user, form.cleaned_data, payment_provider)
+            logger.debug("Order %s created with %s items", order.id, len(snapshot.items))
+            # Резерв переходит к заказу; корзина очищается, когда ссылка на оплату готова
+            StockReservation.objects.attach_to_order(cart, order)
+            # Провайдер вызывается после коммита, не удерживая транзакцию и воркер
+            enqueue_payment(order, payment_payload(order, request, snapshot))
+
+            status_url = reverse('payment:payment_status', args=[order.id])
             if request.headers.get('HX-Request'):
-                return TemplateResponse(request, 'orders/checkout_content.html', context)
-            return render(request, 'orders/checkout.html', context)
+                response = HttpResponse(status=200)
+                response['HX-Redirect'] = status_url
+                return response
+            return redirect(status_url)
+        else:
+            logger.warning("Form validation error: %s", form.errors)
+            return render_checkout(form, 'Please correct the errors in the form.')
+
+
+ORDER_HISTORY_PAGE_SIZE = 10
+ORDER_HISTORY_MAX_PAGE_SIZE = 50
 
 
+def order_history_page(request, user, page_size=ORDER_HISTORY_PAGE_SIZE):
+    """One keyset page of the user's orders with summaries: ``(orders, next_url)``."""
+    try:
+        page_size = int(request.GET.get('page_size', page_size))
+    except ValueError:
+        page_size = ORDER_HISTORY_PAGE_SIZE
+    page_size = max(1, min(page_size, ORDER_HISTORY_MAX_PAGE_SIZE))
+
+    orders, next_cursor = paginate_keyset(
+        Order.objects.filter(user=user).with_summary(),
+        cursor=request.GET.get('cursor'),
+        page_size=page_size,
+    )
+    next_page_url = None
+    if next_cursor:
+        params = QueryDict(mutable=True)
+        params.update({'cursor': next_cursor, 'page_size': page_size})
+        next_page_url = f"{reverse('orders:history')}?{params.urlencode()}"
+    return orders, next_page_url
+
+
+@read_from_replica
 @login_required(login_url='/users/login/')
 def order_history(request):
     """Display user's order history"""
-    orders = Order.objects.filter(user=request.user).order_by('-created_at')
-    
+    orders, next_page_url = order_history_page(request, request.user)
+
+    if 'application/json' in request.headers.get('Accept', ''):
+        return JsonResponse({
+            'orders': [{
+                'id': order.id,
+                'created_at': order.created_at.isoformat(),
+                'status': order.status,
+                'total_price': str(order.total_price),
+                'item_count': order.item_count,
+                'items_total': str(order.items_total),
+                'thumbnail': order.thumbnail_url,
+            } for order in orders],
+            'next': next_page_url,
+        })
+
     context = {
-        'orders': orders
+        'orders': orders,
+        'next_page_url': next_page_url,
     }
     
     if request.headers.get('HX-Request'):
+        if request.GET.get('cursor'):
+            return TemplateResponse(request, 'users/partials/order_history_rows.html', context)
         return TemplateResponse(request, 'users/partials/order_history.html', context)
-    return render(request, 'users/partials/order_history.html', context)
\ No newline at end of file
+    return render(request, 'users/partials/order_history.html', context)
@@ -1,3 +1,22 @@
 from django.contrib import admin
+from .models import PaymentRequest, WebhookEvent
 
-# Register your models here.
+
+@admin.register(PaymentRequest)
+class PaymentRequestAdmin(admin.ModelAdmin):
+    list_display = ('order', 'provider', 'status', 'attempts', 'created_at',
+                    'updated_at')
+    list_filter = ('provider', 'status')
+    list_select_related = ('order',)
+    raw_id_fields = ('order',)
+    readonly_fields = ('payload', 'redirect_url', 'error', 'attempts')
+
+
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ('event_id', 'provider', 'event_type', 'received_at',
+                    'processed_at', 'attempts')
+    list_filter = ('provider', 'event_type')
+    search_fields = ('event_id',)
+    readonly_fields = ('provider', 'event_id', 'event_type', 'payload',
+                       'received_at', 'processed_at', 'attempts', 'error')
@@ -0,0 +1,116 @@
+"""Heleket API client.
+
+One ``requests.Session`` per process keeps TLS connections to the API alive
+between checkouts; the adapter retries connection errors and 5xx answers
+and every call has a connect/read timeout. Requests and webhooks are signed
+with ``md5(base64(json) + api_key)`` as described in the Heleket docs.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+HELEKET_BASE_URL = getattr(settings, 'HELEKET_BASE_URL', 'https://api.heleket.com/v1')
+# (connect, read) в секундах
+HELEKET_TIMEOUT = getattr(settings, 'HELEKET_TIMEOUT', (3.05, 10))
+HELEKET_RETRIES = getattr(settings, 'HELEKET_RETRIES', 3)
+HELEKET_POOL_SIZE = getattr(settings, 'HELEKET_POOL_SIZE', 10)
+
+
+class HeleketError(Exception):
+    pass
+
+
+def _encode(data):
+    # Как json_encode в PHP: без пробелов, юникод как есть, "/" экранирован
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).replace('/', '\\/')
+
+
+class HeleketClient:
+    def __init__(self, merchant_id, api_key, base_url=HELEKET_BASE_URL,
+                 timeout=HELEKET_TIMEOUT, retries=HELEKET_RETRIES,
+                 pool_size=HELEKET_POOL_SIZE):
+        self.merchant_id = merchant_id
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+        # POST тоже повторяем: order_id делает создание платежа идемпотентным
+        retry = Retry(total=retries, backoff_factor=0.3,
+                      status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=frozenset({'GET', 'POST'}),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+
+    def sign(self, data):
+        encoded = base64.b64encode(_encode(data).encode()).decode()
+        return hashlib.md5((encoded + self.api_key).encode()).hexdigest()
+
+
+    def verify(self, data):
+        """Check the ``sign`` field of a webhook body (a parsed dict)."""
+        data = dict(data)
+        signature = data.pop('sign', None)
+        if not signature:
+            return False
+        return hmac.compare_digest(signature, self.sign(data))
+
+
+    def request(self, path, data):
+        body = _encode(data)
+        try:
+            response = self.session.post(
+                f'{self.base_url}/{path}', data=body.encode(), timeout=self.timeout,
+                headers={'merchant': self.merchant_id, 'sign': self.sign(data),
+                         'Content-Type': 'application/json'},
+            )
+            result = response.json()
+        except (requests.RequestException, ValueError) as e:
+            raise HeleketError(f'Heleket request failed: {e}') from e
+        if response.status_code != 200 or result.get('state') != 0:
+            raise HeleketError(f"Heleket error {response.status_code}: "
+                               f"{result.get('message') or result.get('errors')}")
+        return result['result']
+
+
+    def create_payment(self, amount, currency, order_id, **extra):
+        return self.request('payment', {
+            'amount': str(amount), 'currency': currency,
+            'order_id': str(order_id), **extra,
+        })
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Process-wide client, so every checkout reuses the same connection pool."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = HeleketClient(
+                    settings.HELEKET_MERCHANT_ID, settings.HELEKET_API_KEY,
+                    getattr(settings, 'HELEKET_BASE_URL', HELEKET_BASE_URL),
+                )
+    return _client
+
+
+def reset_client():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.session.close()
+        _client = None
@@ -0,0 +1,29 @@
+import time
+from django.core.management.base import BaseCommand
+from payment.outbox import PAYMENT_WORKERS, drain
+from payment.webhooks import WEBHOOK_BATCH_SIZE, process_events
+
+
+class Command(BaseCommand):
+    help = ('Send waiting payment requests from the outbox to the providers '
+            'and apply stored webhook events; with --loop keeps polling as a worker')
+
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true')
+        parser.add_argument('--interval', type=float, default=2.0)
+        parser.add_argument('--batch', type=int, default=100)
+        parser.add_argument('--workers', type=int, default=PAYMENT_WORKERS)
+        parser.add_argument('--webhook-batch', type=int, default=WEBHOOK_BATCH_SIZE)
+
+
+    def handle(self, *args, **options):
+        while True:
+            sent = drain(options['batch'], options['workers'])
+            applied = process_events(options['webhook_batch'])
+            if sent or applied:
+                self.stdout.write(f'Processed {sent} payment requests, {applied} webhook events')
+            if not options['loop']:
+                break
+            if not (sent or applied):
+                time.sleep(options['interval'])
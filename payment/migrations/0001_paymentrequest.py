@@ -0,0 +1,31 @@
+# Generated by Django 5.2.8 on 2026-10-18 18:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('orders', '0003_alter_order_options_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentRequest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('provider', models.CharField(max_length=20)),
+                ('payload', models.JSONField(default=dict)),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('sending', 'Отправляется'), ('ready', 'Готово'), ('failed', 'Ошибка')], db_index=True, default='pending', max_length=20)),
+                ('redirect_url', models.TextField(blank=True)),
+                ('error', models.TextField(blank=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='payment_request', to='orders.order')),
+            ],
+        ),
+    ]
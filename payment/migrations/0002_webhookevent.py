@@ -0,0 +1,31 @@
+# Generated by Django 5.2.8 on 2026-10-18 18:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment', '0001_paymentrequest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('provider', models.CharField(max_length=20)),
+                ('event_id', models.CharField(max_length=255)),
+                ('event_type', models.CharField(max_length=100)),
+                ('payload', models.JSONField()),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('processed_at__isnull', True)), fields=['id'], name='webhook_unprocessed_idx')],
+                'constraints': [models.UniqueConstraint(fields=('provider', 'event_id'), name='unique_webhook_event')],
+            },
+        ),
+    ]
@@ -1,3 +1,65 @@
 from django.db import models
 
-# Create your models here.
+
+class PaymentRequest(models.Model):
+    """Outbox row for a provider call checkout has committed to.
+
+    The checkout transaction only writes this row; the HTTP call to the
+    provider is made after commit by ``payment.outbox``, so no worker or
+    database connection waits on the provider.
+    """
+    STATUS_CHOICES = (
+        ('pending', 'В очереди'),
+        ('sending', 'Отправляется'),
+        ('ready', 'Готово'),
+        ('failed', 'Ошибка'),
+    )
+
+    order = models.OneToOneField('orders.Order', on_delete=models.CASCADE,
+                                 related_name='payment_request')
+    provider = models.CharField(max_length=20)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES,
+                              default='pending', db_index=True)
+    redirect_url = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+    def __str__(self):
+        return f"{self.provider} payment for order {self.order_id} ({self.status})"
+
+
+class WebhookEvent(models.Model):
+    """Append-only log of verified provider webhooks, one row per event id.
+
+    The webhook view only inserts here and acks; ``payment.webhooks``
+    applies the events in batches. A redelivered event hits the unique
+    constraint and is dropped by the same INSERT.
+    """
+    provider = models.CharField(max_length=20)
+    event_id = models.CharField(max_length=255)
+    event_type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['provider', 'event_id'],
+                                    name='unique_webhook_event'),
+        ]
+        indexes = [
+            # Очередь воркера - только необработанные события
+            models.Index(fields=['id'], name='webhook_unprocessed_idx',
+                         condition=models.Q(processed_at__isnull=True)),
+        ]
+
+
+    def __str__(self):
+        return f"{self.provider} {self.event_type} {self.event_id}"
@@ -0,0 +1,132 @@
+"""Payment outbox: provider calls made after the checkout transaction.
+
+Checkout writes a ``PaymentRequest`` and returns. Once the transaction has
+committed the request is handed to a small in-process thread pool; the
+``drain_payments`` command picks up whatever that pool missed (restarts,
+provider errors) and can run as a separate worker.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import partial
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from cart.models import StockReservation
+from orders.models import Order
+from .models import PaymentRequest
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_WORKERS = getattr(settings, 'PAYMENT_WORKERS', 4)
+PAYMENT_MAX_ATTEMPTS = getattr(settings, 'PAYMENT_MAX_ATTEMPTS', 3)
+# Через сколько секунд зависший 'sending' снова можно забрать
+PAYMENT_SENDING_TIMEOUT = getattr(settings, 'PAYMENT_SENDING_TIMEOUT', 120)
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=PAYMENT_WORKERS,
+                                       thread_name_prefix='payment')
+    return _executor
+
+
+def enqueue_payment(order, payload):
+    payment = PaymentRequest.objects.create(
+        order=order, provider=order.payment_provider, payload=payload
+    )
+    transaction.on_commit(partial(get_executor().submit, _process_in_thread, payment.pk))
+    return payment
+
+
+def claimable():
+    stale = timezone.now() - timedelta(seconds=PAYMENT_SENDING_TIMEOUT)
+    return PaymentRequest.objects.filter(
+        Q(status='pending') | Q(status='sending', updated_at__lt=stale)
+    )
+
+
+def claim(queryset, limit=None):
+    """Mark requests as being sent in a short transaction of their own.
+
+    Rows another worker has locked are skipped, so each request is sent by
+    exactly one worker.
+    """
+    with transaction.atomic():
+        locked = queryset.select_for_update(skip_locked=True).order_by('created_at')
+        if limit:
+            locked = locked[:limit]
+        ids = list(locked.values_list('id', flat=True))
+        PaymentRequest.objects.filter(id__in=ids).update(
+            status='sending', attempts=F('attempts') + 1, updated_at=timezone.now()
+        )
+    return list(PaymentRequest.objects.filter(id__in=ids).select_related('order'))
+
+
+def send(payment):
+    """Call the provider; runs with no transaction or row lock held."""
+    from .views import PAYMENT_PROVIDERS
+
+    try:
+        url = PAYMENT_PROVIDERS[payment.provider](payment.order, payment.payload)
+    except Exception as e:
+        logger.warning("Payment request %s attempt %s failed: %s", payment.pk, payment.attempts, e)
+        if payment.attempts >= PAYMENT_MAX_ATTEMPTS:
+            fail(payment, str(e))
+        else:
+            PaymentRequest.objects.filter(pk=payment.pk).update(
+                status='pending', error=str(e), updated_at=timezone.now()
+            )
+        return False
+
+    PaymentRequest.objects.filter(pk=payment.pk).update(
+        status='ready', redirect_url=url, error='', updated_at=timezone.now()
+    )
+    return True
+
+
+def fail(payment, error):
+    with transaction.atomic():
+        PaymentRequest.objects.filter(pk=payment.pk).update(
+            status='failed', error=error, updated_at=timezone.now()
+        )
+        Order.objects.filter(pk=payment.order_id).update(status='cancelled')
+        StockReservation.objects.release_order(payment.order)
+
+
+def process(pk):
+    for payment in claim(claimable().filter(pk=pk)):
+        send(payment)
+
+
+def drain(limit=100, workers=PAYMENT_WORKERS):
+    """Send up to ``limit`` waiting requests; returns how many were claimed."""
+    payments = claim(claimable(), limit)
+    if workers > 1 and len(payments) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_send_in_thread, payments))
+    else:
+        for payment in payments:
+            send(payment)
+    return len(payments)
+
+
+def _process_in_thread(pk):
+    try:
+        process(pk)
+    except Exception:
+        logger.exception("Payment request %s could not be processed", pk)
+    finally:
+        # У каждого потока своё соединение, его нужно закрыть самим
+        connection.close()
+
+
+def _send_in_thread(payment):
+    try:
+        return send(payment)
+    finally:
+        connection.close()
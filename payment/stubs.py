@@ -0,0 +1,140 @@
+"""Local stand-ins for the payment providers' HTTP APIs.
+
+Used by the payment tests, and handy in development: point
+``STRIPE_API_BASE`` / ``HELEKET_BASE_URL`` at a stub started with
+``python -m payment.stubs heleket 8765``.
+"""
+import json
+import sys
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class StubServer:
+    """Threaded HTTP/1.1 server that records requests and answers with JSON."""
+
+    def __init__(self, status=200, port=0):
+        self.status = status
+        self.requests = []
+        # Адреса клиентов: по ним видно, переиспользуется ли соединение
+        self.connections = set()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                stub.connections.add(self.client_address)
+                headers, data = dict(self.headers), stub.parse(body)
+                stub.requests.append((self.path, headers, data))
+                status, payload = stub.respond(self.path, data, headers)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.httpd.server_port}'
+
+
+    def parse(self, body):
+        return json.loads(body or b'{}')
+
+
+    def respond(self, path, data, headers):
+        raise NotImplementedError
+
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class StripeStub(StubServer):
+    """``POST /v1/checkout/sessions`` of the Stripe API.
+
+    Idempotency keys behave as in Stripe: a replay with the same parameters
+    gets the first response, one with different parameters an error.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.idempotent = {}
+
+
+    def parse(self, body):
+        return parse_qs(body.decode())
+
+
+    def respond(self, path, data, headers):
+        if self.status != 200:
+            return self.status, {'error': {'type': 'invalid_request_error',
+                                           'message': 'Stub failure'}}
+        key = headers.get('Idempotency-Key')
+        if key in self.idempotent:
+            params, response = self.idempotent[key]
+            if params != data:
+                return 400, {'error': {
+                    'type': 'idempotency_error',
+                    'message': 'Keys for idempotent requests can only be used '
+                               'with the same parameters they were first used with.',
+                }}
+            return response
+        session_id = f'cs_test_{len(self.idempotent) + 1}'
+        response = 200, {'id': session_id, 'object': 'checkout.session',
+                         'url': f'https://checkout.stripe.test/{session_id}',
+                         'payment_intent': f'pi_test_{len(self.idempotent) + 1}'}
+        if key:
+            self.idempotent[key] = (data, response)
+        return response
+
+
+class HeleketStub(StubServer):
+    """``POST /payment`` of the Heleket API."""
+
+    def respond(self, path, data, headers):
+        if self.status != 200:
+            return self.status, {'state': 1, 'message': 'Stub failure'}
+        payment_uuid = str(uuid.uuid4())
+        return 200, {'state': 0, 'result': {
+            'uuid': payment_uuid, 'order_id': data.get('order_id'),
+            'amount': data.get('amount'), 'currency': data.get('currency'),
+            'url': f'https://pay.heleket.test/{payment_uuid}',
+            'payment_status': 'check', 'status': 'check',
+        }}
+
+
+STUBS = {'stripe': StripeStub, 'heleket': HeleketStub}
+
+
+if __name__ == '__main__':
+    name, port = sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    stub = STUBS[name](port=port)
+    print(f'{name} stub listening on {stub.url}')
+    stub.httpd.serve_forever()
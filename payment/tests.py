@@ -1,3 +1,319 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import json
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+import stripe
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from cart.models import Cart, StockReservation
+from main.benchmark import QueryBudgetMixin
+from main.models import Category, Product, ProductSize, Size
+from orders.models import Order
+from users.models import CustomUser
+from .heleket import HeleketClient, HeleketError, get_client, reset_client
+from .models import PaymentRequest, WebhookEvent
+from .outbox import drain
+from .stubs import HeleketStub, StripeStub
+from .views import create_stripe_checkout_session
+from .webhooks import process_events
 
-# Create your tests here.
+
+class FakeStripe(StripeStub):
+    """Stripe stub with the stripe client pointed at it."""
+
+    def start(self):
+        super().start()
+        self.old = stripe.api_base, stripe.api_key
+        stripe.api_base, stripe.api_key = self.url, 'sk_test_fake'
+        return self
+
+
+    def stop(self):
+        stripe.api_base, stripe.api_key = self.old
+        super().stop()
+
+
+class HeleketStubMixin:
+    """Runs a Heleket stub and points the process-wide client at it."""
+
+    def setUp(self):
+        super().setUp()
+        self.heleket = HeleketStub().start()
+        self.addCleanup(self.heleket.stop)
+        self.enterContext(override_settings(
+            HELEKET_BASE_URL=self.heleket.url,
+            HELEKET_MERCHANT_ID='merchant-uuid', HELEKET_API_KEY='payment-key',
+        ))
+        reset_client()
+        self.addCleanup(reset_client)
+
+
+class PaymentOutboxTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('buyer@example.com', 'Buyer',
+                                                  'User', password='secret-pass')
+        category = Category.objects.create(name='Shirts', slug='shirts')
+        cls.product = Product.objects.create(
+            name='Shirt', slug='shirt', category=category, color='black',
+            price=Decimal('12.50'), main_image='products/main/shirt.jpg'
+        )
+        cls.product_size = ProductSize.objects.create(
+            product=cls.product, size=Size.objects.create(name='M'), stock=5
+        )
+
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('cart:add_to_cart', args=[self.product.slug]),
+                         {'size_id': self.product_size.id, 'quantity': 2})
+
+
+    def checkout(self):
+        return self.client.post(reverse('orders:checkout'), {
+            'payment_provider': 'stripe', 'first_name': 'Buyer',
+            'last_name': 'User', 'email': self.user.email,
+        })
+
+
+    def test_stripe_is_called_after_checkout_returns(self):
+        with FakeStripe() as fake:
+            response = self.checkout()
+            order = Order.objects.get()
+            self.assertRedirects(response, reverse('payment:payment_status', args=[order.id]),
+                                 fetch_redirect_response=False)
+            self.assertEqual(fake.requests, [])
+            self.assertEqual(order.payment_request.status, 'pending')
+
+            self.assertEqual(drain(workers=1), 1)
+            path, headers, params = fake.requests[0]
+            self.assertEqual(path, '/v1/checkout/sessions')
+            self.assertEqual(headers['Idempotency-Key'], f'checkout-order-{order.id}')
+            self.assertEqual(params['line_items[0][price_data][unit_amount]'], ['1250'])
+            self.assertEqual(params['line_items[0][quantity]'], ['2'])
+
+        response = self.client.get(response.url)
+        self.assertRedirects(response, 'https://checkout.stripe.test/cs_test_1',
+                             fetch_redirect_response=False)
+        self.assertEqual(Cart.objects.get().total_items, 0)
+        order.refresh_from_db()
+        self.assertEqual(order.stripe_payment_intent_id, 'pi_test_1')
+
+
+    def test_retry_replays_the_same_checkout_session_request(self):
+        with FakeStripe() as fake:
+            self.checkout()
+            payment = PaymentRequest.objects.get()
+            # Сессия создана, но ответ до outbox не дошёл; повтор - позже
+            lost = create_stripe_checkout_session(payment.order, payment.payload)
+            later = timezone.now() + timedelta(minutes=2)
+            with mock.patch('django.utils.timezone.now', return_value=later):
+                self.assertEqual(drain(workers=1), 1)
+            (_, _, sent), (_, _, replayed) = fake.requests
+            self.assertEqual(sent, replayed)
+
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.redirect_url), ('ready', lost.url))
+
+
+    def test_pending_payment_shows_waiting_page(self):
+        response = self.checkout()
+        self.assertContains(self.client.get(response.url), 'every 1s')
+
+
+    def test_failed_provider_call_cancels_order_and_frees_stock(self):
+        with FakeStripe(status=400) as fake:
+            self.checkout()
+            for _ in range(3):
+                drain(workers=1)
+            self.assertEqual(len(fake.requests), 3)
+
+        payment = PaymentRequest.objects.get()
+        self.assertEqual((payment.status, payment.attempts), ('failed', 3))
+        self.assertEqual(Order.objects.get().status, 'cancelled')
+        self.assertFalse(StockReservation.objects.exists())
+        self.product_size.refresh_from_db()
+        self.assertEqual(self.product_size.stock, 5)
+        # Корзина не очищена - можно оформить заново
+        self.assertEqual(Cart.objects.get().total_items, 2)
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+class StripeWebhookTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = CustomUser.objects.create_user('buyer@example.com', 'Buyer', 'User')
+        cls.orders = [
+            Order.objects.create(user=user, first_name='Buyer', last_name='User',
+                                 email=user.email, total_price='10.00')
+            for _ in range(4)
+        ]
+
+
+    def deliver(self, event_id, order, event_type='checkout.session.completed',
+                secret='whsec_test'):
+        payload = json.dumps({
+            'id': event_id, 'object': 'event', 'type': event_type,
+            'data': {'object': {'metadata': {'order_id': str(order.id)},
+                                'payment_intent': f'pi_{order.id}'}},
+        })
+        timestamp = int(time.time())
+        signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(),
+                             hashlib.sha256).hexdigest()
+        return self.client.post(reverse('payment:stripe_webhook'), payload,
+                                content_type='application/json',
+                                HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}')
+
+
+    def test_webhook_only_stores_event(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.deliver('evt_1', self.orders[0])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([q['sql'].split()[0] for q in ctx.captured_queries
+                          if not q['sql'].startswith(('SAVEPOINT', 'RELEASE'))], ['INSERT'])
+        self.orders[0].refresh_from_db()
+        self.assertEqual(self.orders[0].status, 'pending')
+
+
+    def test_redelivery_is_deduplicated(self):
+        self.deliver('evt_1', self.orders[0])
+        self.assertEqual(self.deliver('evt_1', self.orders[0]).status_code, 200)
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+
+
+    def test_bad_signature_is_rejected(self):
+        self.assertEqual(self.deliver('evt_1', self.orders[0], secret='wrong').status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+
+    def test_events_applied_in_one_batch(self):
+        for i, order in enumerate(self.orders[:3]):
+            self.deliver(f'evt_{i}', order)
+        self.deliver('evt_expired', self.orders[3], 'checkout.session.expired')
+        self.deliver('evt_other', self.orders[3], 'payment_intent.created')
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(process_events(), 5)
+        batch_queries = len(ctx.captured_queries)
+        statuses = dict(Order.objects.values_list('id', 'status'))
+        self.assertEqual([statuses[order.id] for order in self.orders],
+                         ['processing'] * 3 + ['cancelled'])
+        self.orders[1].refresh_from_db()
+        self.assertEqual(self.orders[1].stripe_payment_intent_id, f'pi_{self.orders[1].id}')
+        self.assertFalse(WebhookEvent.objects.filter(processed_at__isnull=True).exists())
+
+        # Повторная обработка ничего не делает, число запросов не зависит от числа событий
+        self.assertEqual(process_events(), 0)
+        WebhookEvent.objects.all().delete()
+        self.deliver('evt_single', self.orders[0])
+        with CaptureQueriesContext(connection) as ctx:
+            process_events()
+        self.assertLessEqual(len(ctx.captured_queries), batch_queries)
+
+
+    def test_payment_after_cancel_is_not_lost(self):
+        order = self.orders[0]
+        Order.objects.filter(id=order.id).update(status='cancelled')
+        self.deliver('evt_paid', order)
+        with self.assertLogs('payment.webhooks', 'WARNING') as logs:
+            process_events()
+        order.refresh_from_db()
+        self.assertEqual((order.status, order.stripe_payment_intent_id),
+                         ('processing', f'pi_{order.id}'))
+        self.assertIn(str(order.id), logs.output[0])
+        self.assertFalse(WebhookEvent.objects.filter(processed_at__isnull=True).exists())
+
+
+class HeleketTests(HeleketStubMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('buyer@example.com', 'Buyer',
+                                                  'User', password='secret-pass')
+        category = Category.objects.create(name='Shirts', slug='shirts')
+        product = Product.objects.create(
+            name='Shirt', slug='shirt', category=category, color='black',
+            price=Decimal('12.50'), main_image='products/main/shirt.jpg'
+        )
+        cls.product_size = ProductSize.objects.create(
+            product=product, size=Size.objects.create(name='M'), stock=5
+        )
+
+
+    def place_order(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('cart:add_to_cart', args=[self.product_size.product.slug]),
+                         {'size_id': self.product_size.id, 'quantity': 2})
+        response = self.client.post(reverse('orders:checkout'), {
+            'payment_provider': 'heleket', 'first_name': 'Buyer',
+            'last_name': 'User', 'email': self.user.email,
+        })
+        drain(workers=1)
+        self.client.get(response.url)
+        return Order.objects.latest('id')
+
+
+    def notify(self, order, status, sign=True):
+        data = {'type': 'payment', 'uuid': order.heleket_payment_id,
+                'order_id': str(order.id), 'status': status, 'amount': '25.00'}
+        if sign:
+            data['sign'] = get_client().sign(data)
+        return self.client.post(reverse('payment:heleket_webhook'), json.dumps(data),
+                                content_type='application/json')
+
+
+    def test_payment_created_through_signed_api_call(self):
+        order = self.place_order()
+        path, headers, data = self.heleket.requests[0]
+        self.assertEqual(path, '/payment')
+        self.assertEqual(headers['merchant'], 'merchant-uuid')
+        self.assertEqual(headers['sign'], get_client().sign(data))
+        self.assertEqual((data['amount'], data['order_id']), ('25.00', str(order.id)))
+        self.assertTrue(order.payment_request.redirect_url.startswith('https://pay.heleket.test/'))
+        self.assertTrue(order.heleket_payment_id)
+
+
+    def test_connections_are_reused(self):
+        client = get_client()
+        for order_id in range(3):
+            client.create_payment('10.00', 'AZN', order_id)
+        self.assertEqual(len(self.heleket.requests), 3)
+        self.assertEqual(len(self.heleket.connections), 1)
+
+
+    def test_server_errors_are_retried_then_raised(self):
+        self.heleket.status = 503
+        client = HeleketClient('merchant-uuid', 'payment-key', self.heleket.url, retries=1)
+        with self.assertRaises(HeleketError):
+            client.create_payment('10.00', 'AZN', 1)
+        self.assertEqual(len(self.heleket.requests), 2)
+
+
+    def test_webhook_requires_valid_signature(self):
+        order = self.place_order()
+        self.assertEqual(self.notify(order, 'paid', sign=False).status_code, 400)
+        self.assertEqual(self.notify(order, 'paid').status_code, 200)
+        self.assertEqual(WebhookEvent.objects.get().provider, 'heleket')
+
+
+    def test_status_notifications_update_orders(self):
+        paid, failed = self.place_order(), self.place_order()
+        self.notify(paid, 'process')
+        self.notify(paid, 'paid')
+        self.notify(failed, 'cancel')
+        self.assertEqual(process_events(), 3)
+
+        statuses = dict(Order.objects.values_list('id', 'status'))
+        self.assertEqual((statuses[paid.id], statuses[failed.id]), ('processing', 'cancelled'))
+        self.assertFalse(StockReservation.objects.exists())
+        self.product_size.refresh_from_db()
+        self.assertEqual(self.product_size.stock, 3)
+
+
+class PaymentQueryBudgetTests(QueryBudgetMixin, TestCase):
+    namespace = 'payment'
@@ -14,4 +14,7 @@ urlpatterns = [
     path('heleket/success/', views.heleket_success, name='heleket_success'),
     path('heleket/cancel/', views.heleket_cancel, name='heleket_cancel'),
     path('heleket/processing/', views.heleket_processing, name='heleket_processing'),
+
+    # Ожидание ссылки на оплату из outbox
+    path('status/<int:order_id>/', views.payment_status, name='payment_status'),
 ]
\ No newline at end of file
@@ -7,108 +7,136 @@ from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotAll
 from django.template.response import TemplateResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
+from django.contrib.auth.decorators import login_required
+from django.urls import reverse
+from django.utils import timezone
 from orders.models import Order
+from cart.models import STOCK_CHECKOUT_TTL, StockReservation
 from cart.views import CartMixin
+from .heleket import get_client
+from .models import PaymentRequest
+from .webhooks import record_event
 from decimal import Decimal
 import json
-import hashlib
-import base64
 
 # stripe login
 # stripe listen --forward-to localhost:8000/payment/stripe/webhook/
 
-HELEKET_API_KEY = settings.HELEKET_API_KEY
-HELEKET_BASE_URL = 'https://api.heleket.com/v1'
-HELEKET_SECRET_KEY = settings.HELEKET_SECRET_KEY
-
 stripe.api_key = settings.STRIPE_SECRET_KEY
-stripe_endpoint_secret = settings.STRIPE_WEBHOOK_SECRET
-
-
-def create_stripe_checkout_session(order, request):
-    cart = CartMixin().get_cart(request)
-    line_items = []
-    for item in cart.items.select_related('product', 'product_size'):
-        line_items.append({
-            'price_data': {
-                'currency': 'azn',
-                'product_data': {
-                    'name': f'{item.product.name} - {item.product_size.size.name}',
-                },
-                'unit_amount': int(item.product.price * 100),
-            },
-            'quantity': item.quantity,
-        })
-    
-    try:
-        checkout_session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=line_items,
-            mode='payment',
-            success_url=request.build_absolute_uri('/payment/stripe/success/') + '?session_id={CHECKOUT_SESSION_ID}',
-            cancel_url=request.build_absolute_uri('/payment/stripe/cancel/') + f'order_id={order.id}',
-            metadata={
-                'order_id': order.id
-            }
-        )
-        order.stripe_payment_intent_id = checkout_session.payment_intent
-        order.payment_provider = 'stripe'
-        order.save()
-        return checkout_session
-    except Exception as e:
-        raise
+# Можно направить на stripe-mock или локальный фейковый сервер
+stripe.api_base = getattr(settings, 'STRIPE_API_BASE', stripe.api_base)
+
+
+def payment_payload(order, request, snapshot):
+    """Everything a provider call needs, computed while we still have the request."""
+    if order.payment_provider == 'stripe':
+        return {
+            'line_items': snapshot.stripe_line_items(),
+            'success_url': request.build_absolute_uri(reverse('payment:stripe_success'))
+                           + '?session_id={CHECKOUT_SESSION_ID}',
+            'cancel_url': request.build_absolute_uri(reverse('payment:stripe_cancel'))
+                          + f'?order_id={order.id}',
+            # Сессия оплаты живёт не дольше резерва товара. Считается один раз:
+            # повтор с тем же idempotency key обязан слать те же параметры
+            'expires_at': int(timezone.now().timestamp()) + STOCK_CHECKOUT_TTL,
+        }
+    return {
+        'success_url': request.build_absolute_uri(reverse('payment:heleket_success'))
+                       + f'?order_id={order.id}',
+        'cancel_url': request.build_absolute_uri(reverse('payment:heleket_cancel'))
+                      + f'?order_id={order.id}',
+        'callback_url': request.build_absolute_uri(reverse('payment:heleket_webhook')),
+    }
+
+
+def create_stripe_checkout_session(order, payload):
+    checkout_session = stripe.checkout.Session.create(
+        payment_method_types=['card'],
+        line_items=payload['line_items'],
+        mode='payment',
+        success_url=payload['success_url'],
+        cancel_url=payload['cancel_url'],
+        metadata={
+            'order_id': order.id
+        },
+        # Запросы, поставленные в outbox до появления expires_at в payload
+        expires_at=payload.get('expires_at',
+                               int(timezone.now().timestamp()) + STOCK_CHECKOUT_TTL),
+        # Повторная отправка из outbox не создаст вторую сессию
+        idempotency_key=f'checkout-order-{order.id}',
+    )
+    Order.objects.filter(pk=order.pk).update(
+        stripe_payment_intent_id=checkout_session.payment_intent,
+    )
+    return checkout_session
 
 
 @csrf_exempt
 @require_POST
 def stripe_webhook(request):
+    """Verify, store and ack; the event is applied by ``payment.webhooks``."""
     payload = request.body
     sig_header = request.META.get('HTTP_STRIPE_SIGNATURE')
-    event = None
 
     try:
         event = stripe.Webhook.construct_event(
-            payload, sig_header, stripe_endpoint_secret
+            payload, sig_header, settings.STRIPE_WEBHOOK_SECRET
         )
     except ValueError as e:
         return HttpResponse(status=400)
     except stripe.error.SignatureVerificationError as e:
         return HttpResponse(status=400)
-    
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        order_id = session['metadata'].get('order_id')
-        try:
-            order = Order.objects.get(id=order_id)
-            order.status = 'processing'
-            order.stripe_payment_intent_id = session.get('payment_intent')
-            order.save()
-        except Order.DoesNotExist:
-            return HttpResponse(status=400)
-        
+
+    record_event('stripe', event['id'], event['type'], json.loads(payload))
     return HttpResponse(status=200)
 
-def create_heleket_payment(order, request):
-    """Create Heleket payment integration"""
-    # Heleket API integration
-    heleket_data = {
-        'amount': float(order.total_price),
-        'currency': 'AZN',  # Azerbaijani Manat
-        'order_id': order.id,
-        'success_url': request.build_absolute_uri('/payment/heleket/success/'),
-        'cancel_url': request.build_absolute_uri('/payment/heleket/cancel/'),
-        'callback_url': request.build_absolute_uri('/payment/heleket/webhook/'),
-        'description': f'Order #{order.id} - 7Days.com'
-    }
-    
-    # В реальной интеграции здесь будет API запрос к Heleket
+def create_heleket_payment(order, payload):
+    """Create the invoice through the Heleket API."""
+    result = get_client().create_payment(
+        amount=order.total_price,
+        currency='AZN',  # Azerbaijani Manat
+        order_id=order.id,
+        url_success=payload['success_url'],
+        url_return=payload['cancel_url'],
+        url_callback=payload['callback_url'],
+        # Счёт живёт не дольше резерва товара
+        lifetime=STOCK_CHECKOUT_TTL,
+    )
+    Order.objects.filter(pk=order.pk).update(heleket_payment_id=result['uuid'])
     return {
-        'url': request.build_absolute_uri('/payment/heleket/processing/'),
-        'payment_id': f'heleket_{order.id}',
-        'data': heleket_data
+        'url': result['url'],
+        'payment_id': result['uuid'],
     }
 
 
+# Вызов провайдера из outbox: (order, payload) -> URL страницы оплаты
+PAYMENT_PROVIDERS = {
+    'stripe': lambda order, payload: create_stripe_checkout_session(order, payload).url,
+    'heleket': lambda order, payload: create_heleket_payment(order, payload)['url'],
+}
+
+
+@login_required(login_url='/users/login/')
+def payment_status(request, order_id):
+    """Waiting page polled until the outbox has the provider URL."""
+    payment = get_object_or_404(
+        PaymentRequest.objects.select_related('order'),
+        order_id=order_id, order__user=request.user
+    )
+    if payment.status == 'ready':
+        CartMixin().get_cart(request).clear()
+        if request.headers.get('HX-Request'):
+            response = HttpResponse(status=200)
+            response['HX-Redirect'] = payment.redirect_url
+            return response
+        return redirect(payment.redirect_url)
+
+    context = {'payment': payment, 'order': payment.order}
+    if request.headers.get('HX-Request'):
+        return TemplateResponse(request, 'payment/payment_status_content.html', context)
+    return render(request, 'payment/payment_status.html', context)
+
+
 def stripe_success(request):
     session_id = request.GET.get('session_id')
     if session_id:
@@ -143,22 +171,17 @@ def stripe_cancel(request):
 
 
 def heleket_success(request):
-    """Heleket success callback"""
+    """Heleket success redirect; the order is marked paid by the webhook."""
     order_id = request.GET.get('order_id')
     if order_id:
-        try:
-            order = get_object_or_404(Order, id=order_id)
-            order.status = 'processing'
-            order.payment_provider = 'heleket'
-            order.save()
-            
-            cart = CartMixin().get_cart(request)
-            cart.clear()
-            
-            context = {'order': order}
-            return render(request, 'payment/heleket_success.html', context)
-        except Exception as e:
-            return redirect('main:index')
+        order = get_object_or_404(Order, id=order_id)
+        cart = CartMixin().get_cart(request)
+        cart.clear()
+
+        context = {'order': order}
+        if request.headers.get('HX-Request'):
+            return TemplateResponse(request, 'payment/heleket_success_content.html', context)
+        return render(request, 'payment/heleket_success.html', context)
     return redirect('main:index')
 
 
@@ -170,19 +193,31 @@ def heleket_cancel(request):
         order.status = 'cancelled'
         order.save()
         context = {'order': order}
+        if request.headers.get('HX-Request'):
+            return TemplateResponse(request, 'payment/heleket_cancel_content.html', context)
         return render(request, 'payment/heleket_cancel.html', context)
     return redirect('orders:checkout')
 
 
+@csrf_exempt
+@require_POST
 def heleket_webhook(request):
-    """Heleket webhook handler"""
-    if request.method == 'POST':
-        # Здесь будет обработка webhook'а от Heleket
-        # Проверка подписи, обновление статуса заказа и т.д.
-        pass
+    """Verify the body signature, store the event and ack."""
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return HttpResponse(status=400)
+    if not isinstance(data, dict) or not get_client().verify(data):
+        return HttpResponse(status=400)
+
+    # Heleket шлёт уведомление на каждую смену статуса одного счёта
+    record_event('heleket', f"{data.get('uuid')}:{data.get('status')}",
+                 data.get('type', 'payment'), data)
     return HttpResponse(status=200)
 
 
 def heleket_processing(request):
     """Heleket processing page"""
+    if request.headers.get('HX-Request'):
+        return TemplateResponse(request, 'payment/heleket_processing_content.html')
     return render(request, 'payment/heleket_processing.html')
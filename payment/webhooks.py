@@ -0,0 +1,162 @@
+"""Webhook ingestion: store the verified event, ack, apply it later in batches.
+
+Handlers are registered per ``(provider, event_type)`` and receive every
+pending event of that type in the batch at once, so a burst of webhooks
+costs a few set-based UPDATEs instead of a read-modify-save per event.
+Handlers must be idempotent: an event is applied at most once, but the
+order it describes may already be past that state.
+"""
+import logging
+from functools import partial
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, CharField, F, Value, When
+from django.utils import timezone
+from cart.models import StockReservation
+from orders.models import Order
+from .models import WebhookEvent
+from .outbox import get_executor
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_BATCH_SIZE = getattr(settings, 'WEBHOOK_BATCH_SIZE', 100)
+WEBHOOK_MAX_ATTEMPTS = getattr(settings, 'WEBHOOK_MAX_ATTEMPTS', 5)
+
+WEBHOOK_HANDLERS = {}
+
+
+def handles(provider, event_type):
+    def register(func):
+        WEBHOOK_HANDLERS[(provider, event_type)] = func
+        return func
+    return register
+
+
+def record_event(provider, event_id, event_type, payload):
+    """One INSERT; duplicates are ignored by the unique constraint."""
+    WebhookEvent.objects.bulk_create([
+        WebhookEvent(provider=provider, event_id=event_id,
+                     event_type=event_type, payload=payload)
+    ], ignore_conflicts=True)
+    transaction.on_commit(partial(get_executor().submit, _process_in_thread))
+
+
+def _order_id(event):
+    return event.payload['data']['object'].get('metadata', {}).get('order_id')
+
+
+def _mark_paid(payment_ids, field):
+    """Move paid orders to processing, storing the provider's payment id in ``field``.
+
+    ``payment_ids`` maps order ids to payment ids. An order cancelled before
+    the customer paid the still-open session is paid all the same: the money
+    is taken, so the order must not be left cancelled. Its holds are already
+    released, so such orders are logged for a manual stock check.
+    """
+    late = list(Order.objects.filter(id__in=payment_ids, status='cancelled')
+                .values_list('id', flat=True))
+    if late:
+        logger.warning("Payment received for cancelled orders %s, check their stock by hand", late)
+    Order.objects.filter(id__in=payment_ids, status__in=('pending', 'cancelled')).update(
+        status='processing',
+        **{field: Case(
+            *[When(id=order_id, then=Value(payment_id))
+              for order_id, payment_id in payment_ids.items()],
+            default=F(field),
+            output_field=CharField(),
+        )},
+    )
+    StockReservation.objects.filter(order_id__in=payment_ids).delete()
+
+
+@handles('stripe', 'checkout.session.completed')
+def stripe_checkout_completed(events):
+    intents = {int(_order_id(event)): event.payload['data']['object'].get('payment_intent')
+               for event in events if _order_id(event)}
+    if not intents:
+        return
+    _mark_paid(intents, 'stripe_payment_intent_id')
+
+
+@handles('stripe', 'checkout.session.expired')
+def stripe_checkout_expired(events):
+    order_ids = [int(_order_id(event)) for event in events if _order_id(event)]
+    if not order_ids:
+        return
+    Order.objects.filter(id__in=order_ids, status='pending').update(status='cancelled')
+    StockReservation.objects.release(StockReservation.objects.filter(order_id__in=order_ids))
+
+
+HELEKET_PAID = {'paid', 'paid_over'}
+HELEKET_FAILED = {'cancel', 'fail', 'system_fail', 'wrong_amount'}
+
+
+@handles('heleket', 'payment')
+def heleket_payment_status(events):
+    paid = {int(event.payload['order_id']): event.payload.get('uuid')
+            for event in events if event.payload.get('status') in HELEKET_PAID}
+    failed = [int(event.payload['order_id']) for event in events
+              if event.payload.get('status') in HELEKET_FAILED]
+    # Промежуточные статусы (process, check, confirm_check) ничего не меняют
+    if paid:
+        _mark_paid(paid, 'heleket_payment_id')
+    if failed:
+        Order.objects.filter(id__in=failed, status='pending').update(status='cancelled')
+        StockReservation.objects.release(StockReservation.objects.filter(order_id__in=failed))
+
+
+def _apply(events):
+    by_handler = {}
+    for event in events:
+        handler = WEBHOOK_HANDLERS.get((event.provider, event.event_type))
+        if handler:
+            by_handler.setdefault(handler, []).append(event)
+    for handler, handler_events in by_handler.items():
+        handler(handler_events)
+
+
+def process_events(limit=WEBHOOK_BATCH_SIZE):
+    """Apply up to ``limit`` pending events; returns how many were taken.
+
+    The batch is locked with SKIP LOCKED, so several workers can drain the
+    table side by side. If the batch fails as a whole, events are retried
+    one by one so a single bad event can't block the rest.
+    """
+    with transaction.atomic():
+        events = list(WebhookEvent.objects.select_for_update(skip_locked=True).filter(
+            processed_at__isnull=True, attempts__lt=WEBHOOK_MAX_ATTEMPTS
+        ).order_by('id')[:limit])
+        if not events:
+            return 0
+
+        try:
+            with transaction.atomic():
+                _apply(events)
+            done = [event.id for event in events]
+        except Exception:
+            logger.exception("Webhook batch of %s failed, applying one by one", len(events))
+            done = []
+            for event in events:
+                try:
+                    with transaction.atomic():
+                        _apply([event])
+                    done.append(event.id)
+                except Exception as e:
+                    WebhookEvent.objects.filter(pk=event.pk).update(
+                        attempts=F('attempts') + 1, error=str(e)
+                    )
+
+        WebhookEvent.objects.filter(id__in=done).update(
+            processed_at=timezone.now(), attempts=F('attempts') + 1, error=''
+        )
+    return len(events)
+
+
+def _process_in_thread():
+    try:
+        while process_events() == WEBHOOK_BATCH_SIZE:
+            pass
+    except Exception:
+        logger.exception("Webhook processing failed")
+    finally:
+        connection.close()
@@ -1,3 +1,6 @@
 from django.test import TestCase
+from main.benchmark import QueryBudgetMixin
 
-# Create your tests here.
+
+class UsersQueryBudgetTests(QueryBudgetMixin, TestCase):
+    namespace = 'users'
@@ -11,5 +11,5 @@ urlpatterns = [
     path('edit-account-details/', views.edit_account_details, name='edit_account_details'),
     path('update-account-details/', views.update_account_details, name='update_account_details'),
     path('order/<int:order_id>/', views.order_detail, name='order_detail'),
-    path('logout/', views.logout, name='logout'),
+    path('logout/', views.logout_view, name='logout'),
 ]
\ No newline at end of file
@@ -10,6 +10,10 @@ from .models import CustomUser
 from django.contrib import messages
 from main.models import Product
 from orders.models import Order
+from enf.routers import read_from_replica
+
+
+PROFILE_RECENT_ORDERS = 5
 
 
 def register(request):
@@ -48,9 +52,11 @@ def profile_view(request):
     else:
         form = CustomUserUpdateForm(instance=request.user)
 
-    # Получаем заказы пользователя
-    orders = Order.objects.filter(user=request.user).order_by('-created_at')
-    latest_order = orders.first() if orders.exists() else None
+    # Последние заказы со сводкой одним запросом; остальные - в истории заказов
+    orders = list(Order.objects.filter(user=request.user).with_summary().order_by(
+        '-created_at', '-id'
+    )[:PROFILE_RECENT_ORDERS])
+    latest_order = orders[0] if orders else None
     
     recommended_products = Product.objects.all().order_by('id')[:3]
 
@@ -92,10 +98,11 @@ def update_account_details(request):
         else:
             return TemplateResponse(request, 'users/partials/edit_account_details.html', {'user': request.user, 'form': form})
     if request.headers.get('HX-Request'):
-        return HttpResponse(headers={'HX-Redirect': reverse('user:profile')})
+        return HttpResponse(headers={'HX-Redirect': reverse('users:profile')})
     return redirect('users:profile')
 
 
+@read_from_replica
 @login_required(login_url='/users/login')
 def order_detail(request, order_id):
     """Display order details for a specific order"""